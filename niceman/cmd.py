@@ -14,6 +14,7 @@ Wrapper for command and function calls, allowing for dry runs and output handlin
 
 import subprocess
 import sys
+import time
 import logging
 import os
 import shutil
@@ -27,6 +28,7 @@ from os.path import abspath, isabs
 
 from .dochelpers import exc_str
 from .support.exceptions import CommandError
+from .support.profiler import profiler
 from .support.protocol import NullProtocol, DryRunProtocol, \
     ExecutionTimeProtocol, ExecutionTimeExternalsProtocol
 from .utils import on_windows
@@ -248,6 +250,7 @@ class Runner(object):
                     if isinstance(cmd, string_types)
                     else cmd)
 
+            start = time.time()
             try:
                 proc = subprocess.Popen(cmd, stdout=outputstream,
                                         stderr=errstream,
@@ -280,6 +283,7 @@ class Runner(object):
                 out = tuple(map(decode_if_not_None, out))
 
             status = proc.poll()
+            profiler.record_subprocess(cmd, time.time() - start)
 
             # needs to be done after we know status
             if not log_online:
@@ -19,6 +19,7 @@ from six import viewvalues
 
 from niceman.utils import attrib
 from niceman.resource.session import get_local_session
+from niceman.support.profiler import profiled
 
 import logging
 lgr = logging.getLogger('niceman.distributions')
@@ -131,6 +132,53 @@ class Distribution(SpecObject):
         """
         return
 
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+
+def merge_spec_objects(objects):
+    """Merge spec objects describing the same entity
+
+    Objects (e.g. distributions, packages, or environments) of the same class
+    with the same values of all non-list attributes are merged into the first
+    of them, by merging their list attributes (e.g. packages or files)
+    recursively.  Other (not attrs based) items, e.g. files, are deduplicated.
+
+    Parameters
+    ----------
+    objects : list
+
+    Returns
+    -------
+    list
+      Merged objects in the order of their first occurrence
+    """
+    merged = collections.OrderedDict()
+    for obj in objects:
+        if not attr.has(obj.__class__):
+            merged.setdefault(obj, obj)
+            continue
+        values = attr.asdict(obj, recurse=False)
+        key = (obj.__class__,) + tuple(
+            (name, _hashable(value))
+            for name, value in sorted(values.items())
+            if not isinstance(value, list))
+        target = merged.get(key)
+        if target is None:
+            merged[key] = obj
+            continue
+        for name, value in values.items():
+            if isinstance(value, list):
+                # in-place since some (e.g. packages) are frozen
+                target_value = getattr(target, name)
+                target_value[:] = merge_spec_objects(target_value + value)
+    return list(viewvalues(merged))
+
+
 # So this one is no longer "distributions/" module specific
 # TODO: move up! and strip Spec suffix
 @attr.s
@@ -162,11 +210,14 @@ class DistributionTracer(object):
     # Default to being able to handle directories
     HANDLES_DIRS = True
 
-    def __init__(self, session=None):
+    def __init__(self, session=None, cache=True):
         # will be (re)used to run external commands, and let's hardcode LC_ALL
         # codepage just in case since we might want to comprehend error
         # messages
         self._session = session or get_local_session()
+        # either results cached by previous runs (e.g. for environments which
+        # did not change) could be used and stored
+        self._use_cache = cache
         # to ease _init within derived classes which should not be parametrized
         # more anyways
         self._init()
@@ -191,6 +242,7 @@ class DistributionTracer(object):
     #  In principle could be RFed to be more scalable, where there is a "Package
     #  manager", which provides similar "assign file to a package" functionality
     #  and identifying packages as already known to the manager.
+    @profiled
     def identify_packages_from_files(self, files):
         """Identifies "packages" for a given collection of files
 
@@ -218,6 +270,7 @@ class DistributionTracer(object):
         # TODO: probably that _get_packagefields should create packagespecs
         # internally and just return them.  But we should make them hashable
         file_to_package_dict = self._get_packagefields_for_files(files)
+        first_files = []  # first file of each package, might be a directory
         for f in files:
             # Stores the file
             if f not in file_to_package_dict:
@@ -238,13 +291,21 @@ class DistributionTracer(object):
                         pkg = self._create_package(**pkgfields)
                         if pkg:
                             found_packages[pkgfields_hashable] = pkg
-                            # we store only non-directories within 'files'
-                            if not self._session.isdir(f):
-                                pkg.files.append(f)
+                            pkg.files.append(f)
+                            first_files.append(f)
                             nb_pkg_files += 1
                         else:
                             unknown_files.add(f)
 
+        # we store only non-directories within 'files'
+        dirs = set(
+            f for f, st in self._session.stat_many(
+                first_files, follow_symlinks=True).items()
+            if st is not None and st.type == 'dir')
+        if dirs:
+            for pkg in viewvalues(found_packages):
+                pkg.files = [f for f in pkg.files if f not in dirs]
+
         lgr.debug(
             "%s: %d packages with %d files, and %d other files",
             self.__class__.__name__,
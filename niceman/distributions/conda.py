@@ -9,16 +9,25 @@
 """Orchestrator sub-class to provide management of the localhost environment."""
 import json
 import os
+import re
+import threading
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from pipes import quote
 
 import attr
 import yaml
+from six import iteritems
+from niceman import cfg
 from niceman.resource.session import get_local_session
 
 from niceman.distributions import Distribution, piputils
 from niceman.dochelpers import exc_str
+from niceman.support.cache import FingerprintCache
 from niceman.support.exceptions import CommandError
-from niceman.utils import attrib, PathRoot, is_subpath, make_tempfile
+from niceman.support.profiler import profiled
+from niceman.utils import attrib, PathRoot, PathTrie, is_subpath, \
+    make_tempfile
 
 from .base import SpecObject
 from .base import DistributionTracer
@@ -89,6 +98,91 @@ def get_miniconda_url(conda_platform, python_version):
     return "https://repo.continuum.io/miniconda/Miniconda%s-latest-%s.sh" \
                     % (python_version[0], platform)
 
+
+# Where a JSON document could start after a malformed one: at the beginning
+# of a line, or right after the closing brace of the previous document
+_JSON_DOCUMENT_START = re.compile(r'^\{|(?<=\})\{', re.MULTILINE)
+
+
+def iter_concatenated_json(content, on_error=None):
+    """Parse a concatenation of JSON documents (e.g. files dumped by cat)
+
+    Documents are decoded one at a time as the iteration proceeds.
+
+    Parameters
+    ----------
+    content : str
+    on_error : callable, optional
+      Called with the exception for a malformed (e.g. partial) document,
+      which is then skipped up to where the next one seems to start.  If
+      not provided, the exception is raised
+
+    Yields
+    ------
+    object
+      Decoded JSON documents
+    """
+    decoder = json.JSONDecoder()
+    end = len(content)
+    idx = 0
+    while True:
+        # skip whitespace (e.g. trailing newlines) between the documents
+        while idx < end and content[idx].isspace():
+            idx += 1
+        if idx == end:
+            return
+        try:
+            obj, idx = decoder.raw_decode(content, idx)
+        except ValueError as exc:
+            if on_error is None:
+                raise
+            on_error(exc)
+            match = _JSON_DOCUMENT_START.search(content, idx + 1)
+            if not match:
+                return
+            idx = match.start()
+            continue
+        yield obj
+
+
+def parse_conda_history(content):
+    """Parse (a tail of) a conda-meta/history transaction log
+
+    Every revision in the log lists the packages linked ("+") into the
+    environment and unlinked ("-") from it, e.g.::
+
+        ==> 2018-06-01 12:00:00 <==
+        # cmd: conda install numpy
+        -defaults::numpy-1.14.2-py36hdbf6ddf_1
+        +defaults::numpy-1.14.3-py36hcd700cb_1
+
+    Parameters
+    ----------
+    content : str
+
+    Returns
+    -------
+    (set, set)
+      Packages (as name-version-build, the name of their conda-meta record)
+      linked and unlinked by all the revisions, once applied in order
+    """
+    linked = set()
+    unlinked = set()
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line[0] not in '+-':
+            continue
+        # strip the channel, if recorded
+        dist = line[1:].split('::')[-1]
+        if line[0] == '+':
+            linked.add(dist)
+        elif dist in linked:
+            linked.remove(dist)
+        else:
+            unlinked.add(dist)
+    return linked, unlinked
+
+
 @attr.s
 class CondaPackage(Package):
     name = attrib(default=attr.NOTHING)
@@ -182,32 +276,55 @@ class CondaDistribution(Distribution):
                 # NOTE: miniconda.sh makes parent directories automatically
                 session.execute_command("bash -b %s/miniconda.sh -b -p %s" %
                                         (tmp_dir, self.path))
-            ## Update root version of conda
-            session.execute_command(
-               "%s/bin/conda install -y conda=%s python=%s" %
-               (self.path, self.conda_version,
-                self.get_simple_python_version(self.python_version)))
+            ## Update root version of conda, unless it matches already
+            if not self._is_root_up_to_date(session):
+                session.execute_command(
+                   "%s/bin/conda install -y conda=%s python=%s" %
+                   (self.path, self.conda_version,
+                    self.get_simple_python_version(self.python_version)))
 
             # Loop through non-root packages, creating the conda-env config
+            # and, if requested, an explicit list of the packages to
+            # install from their url without solving the dependencies
+            explicit = cfg.getboolean('conda', 'explicit install',
+                                      default=False)
+            env_configs = []
             for env in self.environments:
-                export_contents = self.create_conda_export(env)
-                with make_tempfile(export_contents) as local_config:
+                remote_explicit = None
+                if explicit:
+                    explicit_contents = self.create_conda_explicit_list(env)
+                    if explicit_contents:
+                        remote_explicit = os.path.join(
+                            tmp_dir, env.name + '.explicit')
+                        with make_tempfile(explicit_contents) as local_list:
+                            session.put(local_list, remote_explicit)
+                remote_config = None
+                export_contents = self.create_conda_export(
+                    env, skip_explicit=bool(remote_explicit))
+                if not remote_explicit or any(
+                        p.get("installer") or not p.get("url")
+                        for p in env.packages):
                     remote_config = os.path.join(tmp_dir, env.name)
-                    session.put(local_config, remote_config)
-                    if not session.isdir(env.path):
-                        try:
-                            session.execute_command(
-                                "%s/bin/conda-env create -p %s -f %s " %
-                                (self.path, env.path, remote_config))
-                        except CommandError:
-                            # Some conda versions seg fault so try to update
-                            session.execute_command(
-                                "%s/bin/conda-env update -p %s -f %s " %
-                                (self.path, env.path, remote_config))
-                    else:
-                        session.execute_command(
-                            "%s/bin/conda-env update -p %s -f %s " %
-                            (self.path, env.path, remote_config))
+                    with make_tempfile(export_contents) as local_config:
+                        session.put(local_config, remote_config)
+                env_configs.append((env, remote_config, remote_explicit))
+
+            # The environments are independent, so could be installed
+            # concurrently
+            jobs = min(cfg.get_as_dtype('conda', 'install jobs', int,
+                                        default=1),
+                       len(env_configs))
+            if jobs > 1:
+                pool = ThreadPool(jobs)
+                try:
+                    pool.map(lambda env_config: self._install_environment(
+                        session, *env_config), env_configs)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for env_config in env_configs:
+                    self._install_environment(session, *env_config)
 
         finally:
             if tmp_dir:
@@ -216,6 +333,97 @@ class CondaDistribution(Distribution):
 
         return
 
+    def _is_root_up_to_date(self, session):
+        """Return whether the root has the conda and python versions already
+        """
+        try:
+            out, _ = session.execute_command(
+                '%s/bin/conda info --json' % self.path)
+            details = json.loads(out)
+        except (CommandError, ValueError) as exc:
+            lgr.debug("Could not retrieve conda info in path %s: %s",
+                      self.path, exc_str(exc))
+            return False
+        return details.get('conda_version') == self.conda_version \
+            and self.get_simple_python_version(
+                details.get('python_version') or '') == \
+            self.get_simple_python_version(self.python_version)
+
+    def _fetch_packages(self, session, explicit_list):
+        """Download the packages of an explicit list into the package cache
+
+        The packages are downloaded in parallel, and kept only if their md5
+        matches the one in the list.  Conda then uses them instead of
+        downloading them one after another.
+        """
+        jobs = cfg.get_as_dtype('conda', 'download jobs', int, default=4)
+        try:
+            session.execute_command(
+                "mkdir -p {pkgs} && grep -v '^@' {list} "
+                "| xargs -P {jobs} -n 1 sh -c {script}".format(
+                    pkgs=self._pkgs_dir, list=explicit_list, jobs=jobs,
+                    script=quote(
+                        self._FETCH_PACKAGE_SCRIPT % self._pkgs_dir)))
+        except CommandError as exc:
+            lgr.warning("Could not download all the packages in %s, conda "
+                        "will retry: %s", explicit_list, exc_str(exc))
+
+    # Download a package given as url#md5 (as $0) into the package cache,
+    # unless it is there already
+    _FETCH_PACKAGE_SCRIPT = """\
+cd %s || exit 1
+url="${0%%#*}"; f="$(basename "$url")"
+case "$0" in *#*) md5="${0##*#}";; *) md5=;; esac
+check() { [ -z "$md5" ] || echo "$md5  $1" | md5sum -c --status; }
+[ -e "$f" ] && check "$f" && exit 0
+curl -sSfL -o "$f.part" "$url" && check "$f.part" && mv "$f.part" "$f" \\
+  || { rm -f "$f.part"; exit 1; }
+"""
+
+    @property
+    def _pkgs_dir(self):
+        return '%s/pkgs' % self.path
+
+    def _install_environment(self, session, env, config, explicit_list=None):
+        """Create (or update) an environment
+
+        Parameters
+        ----------
+        session : Session
+        env : CondaEnvironment
+        config : str or None
+          Path to the conda-env config of the environment (with only the
+          packages missing from `explicit_list` if one is given)
+        explicit_list : str, optional
+          Path to the explicit list of the packages to install without
+          solving their dependencies
+        """
+        # All the environments use the package cache of the root, so
+        # packages common to them are downloaded once.  The variable is set
+        # within the command, since not every session can pass env
+        pkgs_env = 'env CONDA_PKGS_DIRS=%s ' % quote(self._pkgs_dir)
+        if explicit_list:
+            self._fetch_packages(session, explicit_list)
+            session.execute_command(
+                "%s%s/bin/conda %s -y -p %s --file %s" %
+                (pkgs_env, self.path,
+                 'install' if session.isdir(env.path) else 'create',
+                 env.path, explicit_list))
+        if not config:
+            return
+        if not session.isdir(env.path):
+            try:
+                session.execute_command(
+                    "%s%s/bin/conda-env create -p %s -f %s " %
+                    (pkgs_env, self.path, env.path, config))
+                return
+            except CommandError:
+                # Some conda versions seg fault so try to update
+                pass
+        session.execute_command(
+            "%s%s/bin/conda-env update -p %s -f %s " %
+            (pkgs_env, self.path, env.path, config))
+
     @staticmethod
     def get_simple_python_version(python_version):
         # Get the simple python version from the conda info string
@@ -236,7 +444,26 @@ class CondaDistribution(Distribution):
                        else "%s" % name)
 
     @staticmethod
-    def create_conda_export(env):
+    def create_conda_explicit_list(env):
+        """Return the explicit list of the conda packages with a url
+
+        Conda installs the packages of such a list (starting with @EXPLICIT)
+        without solving their dependencies, and checks their md5 if given.
+
+        Returns
+        -------
+        str or None
+          None if none of the packages have a url
+        """
+        lines = ["%s#%s" % (p["url"], p["md5"]) if p.get("md5") else p["url"]
+                 for p in env.packages
+                 if p.get("installer") is None and p.get("url")]
+        if not lines:
+            return None
+        return "@EXPLICIT\n" + "".join(line + "\n" for line in lines)
+
+    @staticmethod
+    def create_conda_export(env, skip_explicit=False):
         # Collect the environment into a dictionary in the same manner as
         # https://github.com/conda/conda/blob/master/conda_env/env.py
         d = {}
@@ -245,10 +472,12 @@ class CondaDistribution(Distribution):
         d["name"] = name
         # Collect channels
         d["channels"] = [c["name"] for c in env.channels]
-        # Collect packages (dependencies) with no installer
+        # Collect packages (dependencies) with no installer, but those
+        # installed from the explicit list if asked to skip them
         d["dependencies"] = [CondaDistribution.format_conda_package(**p)
                              for p in env.packages
-                             if p.get("installer") is None]
+                             if p.get("installer") is None
+                             and not (skip_explicit and p.get("url"))]
         #            p.get("name"), p.get("version"), p.get("build"))
         # Collect pip-installed dependencies
         pip_deps = [CondaDistribution.format_pip_package(**p)
@@ -266,8 +495,24 @@ class CondaTracer(DistributionTracer):
     """conda distributions tracer
     """
 
+    # Increment whenever the structure of the cached environment details
+    # changes
+    _CACHE_VERSION = 1
+
     def _init(self):
-        self._get_conda_env_path = PathRoot(self._is_conda_env_path)
+        self._get_conda_env_path = PathRoot(self._is_conda_env_path,
+                                            self._are_conda_env_paths)
+        # path -> conda info, which is the same for all the environments
+        # of a conda installation, so also stored for their root_prefix
+        self._conda_info = {}
+        self._conda_info_lock = threading.Lock()
+        self._cache = FingerprintCache(
+            cfg.getpath('conda', 'cache dir',
+                        default=os.path.join(cfg.dirs.user_cache_dir,
+                                             'conda')),
+            max_size=cfg.get_as_dtype('conda', 'cache size', int,
+                                      default=50 * 2 ** 20)
+        ) if self._use_cache else None
 
     def _get_packagefields_for_files(self, files):
         raise NotImplementedError("TODO")
@@ -275,49 +520,77 @@ class CondaTracer(DistributionTracer):
     def _create_package(self, *fields):
         raise NotImplementedError("TODO")
 
-    def _get_conda_meta_files(self, conda_path):
+    # Fields of the conda-meta records used to describe the packages
+    _PACKAGE_DETAILS_FIELDS = ('name', 'version', 'build', 'schannel',
+                               'channel', 'size', 'md5', 'url')
+
+    def _read_conda_meta(self, conda_path, dists=None):
+        """Read all conda-meta/*.json records of an environment at once
+
+        Parameters
+        ----------
+        conda_path : str
+        dists : list of str, optional
+          Read only the records of these packages (as name-version-build)
+
+        Returns
+        -------
+        str
+          Content of all the records concatenated
+        """
+        records = ' '.join('%s/conda-meta/%s.json' % (conda_path, dist)
+                           for dist in dists) \
+            if dists is not None else '%s/conda-meta/*.json' % conda_path
         try:
-            out, _ = self._session.execute_command(
-                'ls %s/conda-meta/*.json'
-                % conda_path
-            )
-            return iter(out.splitlines())
-        except Exception as exc:  # Empty conda environment (unusual situation)
+            # as cat, but every record ends with a newline, so the next one
+            # starts on its own line even if the previous one is partial
+            out, _ = self._session.execute_command('awk 1 %s' % records)
+        except CommandError as exc:
+            # Some records could still have been read
+            out = exc.stdout or ''
             lgr.warning("Could not retrieve conda-meta files in path %s: %s",
                         conda_path, exc_str(exc))
-            return iter(())
+        return out
 
-    def _get_conda_package_details(self, conda_path):
+    @profiled
+    def _get_conda_package_details(self, conda_path, dists=None):
         packages = {}
         file_to_package_map = {}
-        for meta_file in self._get_conda_meta_files(conda_path):
+        if dists is not None and not dists:
+            return packages, file_to_package_map
+
+        def log_warning(exc):
+            lgr.warning("Could not retrieve conda info in path %s: %s",
+                        conda_path,
+                        exc_str(exc))
+
+        for details in iter_concatenated_json(
+                self._read_conda_meta(conda_path, dists),
+                on_error=log_warning):
             try:
-                out, err = self._session.execute_command(
-                    'cat %s' % meta_file
-                )
-                details = json.loads(out)
-#                print meta_file
-#                print(json.dumps(details, indent=4))
-                if "name" in details:
-                    lgr.debug("Found conda package %s", details["name"])
-                    # Packages are recorded in the conda environment as
-                    # name=version=build
-                    conda_package_name = \
-                        ("%s=%s=%s" % (details["name"], details["version"],
-                                       details["build"]))
-                    packages[conda_package_name] = details
-                    # Now map the package files to the package
-                    for f in details["files"]:
-                        full_path = os.path.normpath(
-                            os.path.join(conda_path, f))
-                        file_to_package_map[full_path] = conda_package_name
+                if "name" not in details:
+                    continue
+                lgr.debug("Found conda package %s", details["name"])
+                # Packages are recorded in the conda environment as
+                # name=version=build
+                conda_package_name = \
+                    ("%s=%s=%s" % (details["name"], details["version"],
+                                   details["build"]))
+                # Do not keep the rest of the (possibly large) record
+                packages[conda_package_name] = dict(
+                    (f, details[f]) for f in self._PACKAGE_DETAILS_FIELDS
+                    if f in details)
+                # Now map the package files to the package
+                for f in details.get("files", []):
+                    full_path = os.path.normpath(
+                        os.path.join(conda_path, f))
+                    file_to_package_map[full_path] = conda_package_name
             except Exception as exc:
-                lgr.warning("Could not retrieve conda info in path %s: %s",
-                            conda_path,
-                            exc_str(exc))
+                log_warning(exc)
 
         return packages, file_to_package_map
 
+    @profiled
     def _get_conda_pip_package_details(self, env_export, conda_path):
         dependencies = env_export.get("dependencies", [])
 
@@ -334,13 +607,18 @@ class CondaTracer(DistributionTracer):
         if not pip_pkgs:
             return {}, {}
 
-        pip = conda_path + "/bin/pip"
-        packages, file_to_package_map = piputils.get_package_details(
-            self._session, pip, pip_pkgs)
+        details = piputils.get_installed_package_details(
+            self._session, conda_path, pip_pkgs)
+        if details is None:
+            pip = conda_path + "/bin/pip"
+            details = piputils.get_package_details(
+                self._session, pip, pip_pkgs)
+        packages, file_to_package_map = details
         for entry in packages.values():
             entry["installer"] = "pip"
         return packages, file_to_package_map
 
+    @profiled
     def _get_conda_env_export(self, root_prefix, conda_path):
         export = {}
         try:
@@ -363,7 +641,20 @@ class CondaTracer(DistributionTracer):
                             exc_str(exc))
         return export
 
+    def _get_known_conda_info(self, conda_path):
+        with self._conda_info_lock:
+            if conda_path in self._conda_info:
+                return self._conda_info[conda_path]
+            # environments under envs/ of a known root share its conda
+            envs_dir = os.path.dirname(os.path.normpath(conda_path))
+            if os.path.basename(envs_dir) == 'envs':
+                return self._conda_info.get(os.path.dirname(envs_dir))
+
+    @profiled
     def _get_conda_info(self, conda_path):
+        details = self._get_known_conda_info(conda_path)
+        if details is not None:
+            return details
         details = {}
         try:
             out, err = self._session.execute_command(
@@ -374,17 +665,182 @@ class CondaTracer(DistributionTracer):
         except Exception as exc:
             lgr.warning("Could not retrieve conda info in path %s: %s",
                         conda_path, exc_str(exc))
+        with self._conda_info_lock:
+            self._conda_info[conda_path] = details
+            if details.get('root_prefix'):
+                self._conda_info.setdefault(details['root_prefix'], details)
+        return details
+
+    def _get_conda_env_fingerprint(self, conda_path):
+        """Return a fingerprint of the state of a conda environment
+
+        The fingerprint consists of the sizes and modification times of
+        conda-meta/history, conda-meta/*.json records and site-packages/
+        (which changes whenever pip installs or removes packages).
+
+        Returns
+        -------
+        str or None
+          None if the environment could not be inspected
+        """
+        try:
+            out, _ = self._session.execute_command(
+                "stat -c '%%n %%s %%Y' %s/conda-meta/history "
+                "%s/conda-meta/*.json %s/lib/python*/site-packages"
+                % ((conda_path,) * 3)
+            )
+        except CommandError as exc:
+            # some of the paths might just be missing
+            out = exc.stdout
+        return out or None
+
+    @staticmethod
+    def _parse_conda_env_fingerprint(fingerprint):
+        """Return path -> (size, mtime) of conda-meta/ and of the rest"""
+        conda_meta_stats, other_stats = {}, {}
+        for line in fingerprint.splitlines():
+            path, size, mtime = line.rsplit(' ', 2)
+            stats = conda_meta_stats if '/conda-meta/' in path \
+                else other_stats
+            stats[path] = int(size), mtime
+        return conda_meta_stats, other_stats
+
+    @profiled
+    def _update_conda_env_details(self, conda_path, details,
+                                  old_fingerprint, fingerprint):
+        """Update details on the packages of a conda environment which changed
+
+        Only the records of the packages linked by the revisions appended
+        to conda-meta/history since the details were gathered are read,
+        and pip packages are refreshed only if site-packages changed.
+
+        Returns
+        -------
+        (root_prefix, packages, file_to_package_map) or None
+          None if the details could not be updated, e.g. because the
+          environment changed in a way not recorded in its history
+        """
+        old_stats, old_site_stats = \
+            self._parse_conda_env_fingerprint(old_fingerprint)
+        stats, site_stats = self._parse_conda_env_fingerprint(fingerprint)
+
+        root_path, packages, file_to_pkg = details
+        if stats != old_stats:
+            history = '%s/conda-meta/history' % conda_path
+            if history not in old_stats or history not in stats:
+                return None
+            old_size, size = old_stats[history][0], stats[history][0]
+            if size <= old_size:
+                # rewritten, or the records changed on their own
+                return None
+            try:
+                out, _ = self._session.execute_command(
+                    'tail -c +%d %s' % (old_size + 1, history))
+            except CommandError as exc:
+                lgr.debug("Could not read the history of conda environment "
+                          "%s: %s", conda_path, exc_str(exc))
+                return None
+            linked, unlinked = parse_conda_history(out)
+            lgr.debug("Conda environment %s changed: %d packages linked, "
+                      "%d unlinked", conda_path, len(linked), len(unlinked))
+            linked_packages, linked_file_to_pkg = \
+                self._get_conda_package_details(conda_path, sorted(linked))
+            if len(linked_packages) != len(linked):
+                # some were unlinked since, without a record in the history
+                return None
+            # Packages are recorded as name=version=build
+            outdated = {'='.join(dist.rsplit('-', 2))
+                        for dist in linked | unlinked}
+            packages = {name: pkg for name, pkg in iteritems(packages)
+                        if name not in outdated}
+            file_to_pkg = {f: name for f, name in iteritems(file_to_pkg)
+                           if name not in outdated}
+            packages.update(linked_packages)
+            file_to_pkg.update(linked_file_to_pkg)
+
+        if site_stats != old_site_stats:
+            # site-packages changed, so could have the pip packages
+            pip_names = {name for name, pkg in iteritems(packages)
+                         if pkg.get('installer') == 'pip'}
+            packages = {name: pkg for name, pkg in iteritems(packages)
+                        if name not in pip_names}
+            file_to_pkg = {f: name for f, name in iteritems(file_to_pkg)
+                           if name not in pip_names}
+            env_export = self._get_conda_env_export(root_path, conda_path)
+            pip_packages, pip_file_to_pkg = \
+                self._get_conda_pip_package_details(env_export, conda_path)
+            packages.update(pip_packages)
+            file_to_pkg.update(pip_file_to_pkg)
+        return root_path, packages, file_to_pkg
+
+    @profiled
+    def _get_conda_env_details(self, conda_path):
+        """Return details on the packages of a conda environment
+
+        The details are loaded from the cache, if the environment did not
+        change since they were stored, or updated from the history of the
+        environment if only packages were (un)installed since.
+
+        Returns
+        -------
+        (root_prefix, packages, file_to_package_map) or None
+          None if the root of the environment could not be determined
+        """
+        fingerprint = key = None
+        if self._cache:
+            key = ('conda', self._CACHE_VERSION, conda_path)
+            fingerprint = self._get_conda_env_fingerprint(conda_path)
+        if fingerprint:
+            cached_fingerprint, details = self._cache.lookup(key)
+            if details is not None and cached_fingerprint == fingerprint:
+                lgr.debug("Loaded details of conda environment %s from the "
+                          "cache", conda_path)
+                return details
+            if details is not None:
+                details = self._update_conda_env_details(
+                    conda_path, details, cached_fingerprint, fingerprint)
+            if details is not None:
+                lgr.debug("Updated cached details of conda environment %s",
+                          conda_path)
+                self._cache.set(key, fingerprint, details)
+                return details
+
+        # Find the root path for the environment
+        conda_info = self._get_conda_info(conda_path)
+        root_path = conda_info.get('root_prefix')
+        if not root_path:
+            lgr.warning("Could not find root path for conda environment %s"
+                        % conda_path)
+            return None
+        # Retrieve the environment details
+        env_export = self._get_conda_env_export(
+           root_path, conda_path)
+        (conda_package_details, file_to_pkg) = \
+            self._get_conda_package_details(conda_path)
+        (conda_pip_package_details, file_to_pip_pkg) = \
+            self._get_conda_pip_package_details(env_export, conda_path)
+        # Join our conda and pip packages
+        conda_package_details.update(conda_pip_package_details)
+        file_to_pkg.update(file_to_pip_pkg)
+
+        details = root_path, conda_package_details, file_to_pkg
+        if fingerprint:
+            self._cache.set(key, fingerprint, details)
         return details
 
     def _is_conda_env_path(self, path):
         return self._session.exists('%s/conda-meta' % path)
 
+    def _are_conda_env_paths(self, paths):
+        stats = self._session.stat_many(
+            ['%s/conda-meta' % path for path in paths], follow_symlinks=True)
+        return [path for path in paths if stats.get('%s/conda-meta' % path)]
+
     def _is_conda_root_path(self, path):
         return all(map(self._session.exists, ('%s/%s' % (path, d) for d in
                                               ('bin', 'envs', 'conda-meta'))))
 
     def identify_distributions(self, paths):
-        conda_paths = set()
         root_to_envs = defaultdict(list)
         # Start with all paths being set as unknown
         unknown_files = set(paths)
@@ -392,57 +848,65 @@ class CondaTracer(DistributionTracer):
         found_package_count = 0
         total_file_count = len(unknown_files)
 
-        # First, loop through all the files and identify conda paths
-        for path in paths:
-            conda_path = self._get_conda_env_path(path)
-            if conda_path:
-                if conda_path not in conda_paths:
-                    conda_paths.add(conda_path)
+        # First, identify conda paths of all the files at once
+        conda_paths = set(
+            filter(None, self._get_conda_env_path.find_many(paths).values()))
+
+        # Extract details of the environments concurrently, since those
+        # might be many within a single (shared) conda installation
+        conda_paths = sorted(conda_paths)
+        jobs = min(cfg.get_as_dtype('conda', 'jobs', int, default=4),
+                   len(conda_paths))
+        if jobs > 1:
+            pool = ThreadPool(jobs)
+            try:
+                all_env_details = pool.map(self._get_conda_env_details,
+                                           conda_paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            all_env_details = list(map(self._get_conda_env_details,
+                                       conda_paths))
+
+        # Bucket the files by environment in a single pass, with the files
+        # found in multiple environments assigned to the first one
+        env_index = PathTrie()
+        file_to_env_pkg = {}
+        for conda_path, env_details in zip(conda_paths, all_env_details):
+            if not env_details:
+                continue
+            env_index.add(conda_path)
+            for path, pkg in iteritems(env_details[2]):
+                file_to_env_pkg.setdefault(path, (conda_path, pkg))
+
+        pkg_to_found_files = defaultdict(list)
+        for path in list(unknown_files):
+            if path not in file_to_env_pkg:
+                continue
+            # The file was found so remove from unknown file set
+            unknown_files.remove(path)
+            conda_path, pkg = file_to_env_pkg[path]
+            # Make relative paths if it is within the conda path
+            env_path, rel_path = env_index.find(path)
+            if env_path != conda_path:
+                path_prefix = conda_path + os.path.sep
+                if path.startswith(path_prefix):
+                    rel_path = path[len(path_prefix):]
+                else:
+                    rel_path = path
+            pkg_to_found_files[conda_path, pkg].append(rel_path)
 
         # Loop through conda_paths, find packages and create the
         # environments
-        for idx, conda_path in enumerate(conda_paths):
+        for conda_path, env_details in zip(conda_paths, all_env_details):
             # Start with an empty channels list
             channels = []
             found_channel_names = set()
 
-            # Find the root path for the environment
-            # TODO: cache/memoize for those paths which have been considered
-            # since will be asked again below
-            conda_info = self._get_conda_info(conda_path)
-            root_path = conda_info.get('root_prefix')
-            if not root_path:
-                lgr.warning("Could not find root path for conda environment %s"
-                            % conda_path)
+            if not env_details:
                 continue
-            # Retrieve the environment details
-            env_export = self._get_conda_env_export(
-               root_path, conda_path)
-            (conda_package_details, file_to_pkg) = \
-                self._get_conda_package_details(conda_path)
-            (conda_pip_package_details, file_to_pip_pkg) = \
-                self._get_conda_pip_package_details(env_export, conda_path)
-            # Join our conda and pip packages
-            conda_package_details.update(conda_pip_package_details)
-            file_to_pkg.update(file_to_pip_pkg)
-
-            # Initialize a map from packages to files that defaults to []
-            pkg_to_found_files = defaultdict(list)
-
-            # Get the conda path prefix to calculate relative paths
-            path_prefix = conda_path + os.path.sep
-            # Loop through unknown files, assigning them to packages if found
-            for path in set(unknown_files):  # Clone the set
-                if path in file_to_pkg:
-                    # The file was found so remove from unknown file set
-                    unknown_files.remove(path)
-                    # Make relative paths if it is begins with the conda path
-                    if path.startswith(path_prefix):
-                        rel_path = path[len(path_prefix):]
-                    else:
-                        rel_path = path
-                    # And add to the package
-                    pkg_to_found_files[file_to_pkg[path]].append(rel_path)
+            root_path, conda_package_details, _ = env_details
 
             packages = []
             # Create the packages in the environment
@@ -474,7 +938,7 @@ class CondaTracer(DistributionTracer):
                     url=details.get("url"),
                     location=location,
                     editable=details.get("editable"),
-                    files=pkg_to_found_files[package_name]
+                    files=pkg_to_found_files[conda_path, package_name]
                 )
                 packages.append(package)
 
@@ -7,6 +7,7 @@
 #
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 """Support for Debian(-based) distribution(s)."""
+import io
 import os
 import re
 
@@ -20,7 +21,9 @@ from six.moves import map
 
 import pytz
 
+from niceman import cfg
 from niceman import utils
+from niceman.resource.shell import ShellSession
 from niceman.utils import attrib
 
 from email.utils import mktime_tz, parsedate_tz
@@ -32,7 +35,9 @@ import requests
 from niceman.support.distributions.debian import \
     parse_apt_cache_show_pkgs_output, parse_apt_cache_policy_pkgs_output, \
     parse_apt_cache_policy_source_info, get_apt_release_file_names, \
-    get_spec_from_release_file, parse_dpkgquery_line
+    get_spec_from_release_file, parse_dpkgquery_line, \
+    parse_dpkg_info_lists_output, parse_dpkg_diversions, parse_dpkg_status, \
+    APTListsIndex
 
 # Pick a conservative max command-line
 from niceman.utils import get_cmd_batch_len, execute_command_batch, \
@@ -48,6 +53,8 @@ from .base import Distribution
 from .base import TypedList
 from .base import _register_with_representer
 from ..support.exceptions import CommandError
+from ..support.exceptions import SessionRuntimeError
+from ..support.profiler import profiled
 #
 # Models
 #
@@ -83,6 +90,7 @@ class DEBPackage(Package):
     source_name = attrib(hash=False)
     source_version = attrib(hash=False)
     size = attrib(hash=False)
+    installed_size = attrib(hash=False)
     md5 = attrib(hash=False)
     sha1 = attrib(hash=False)
     sha256 = attrib(hash=False)
@@ -302,7 +310,6 @@ class DebTracer(DistributionTracer):
     # The Debian tracer is not designed to handle directories
     HANDLES_DIRS = False
 
-    # TODO: (Low Priority) handle cases from dpkg-divert
     def _init(self):
         # TODO: we might want a generic helper for collections of things
         # where we could match based on the set of attrs which matter
@@ -310,6 +317,12 @@ class DebTracer(DistributionTracer):
         self._apt_source_names = set()
         self._all_apt_sources = {}
         self._source_line_to_name_map = {}
+        # path -> list of packagefields, loaded on first use.  False if it
+        # could not be loaded and we need to resort to dpkg-query
+        self._dpkg_file_index = None
+        # "name" and "name:arch" -> record from /var/lib/dpkg/status
+        self._dpkg_status = None
+        self._apt_lists_index = None
 
     def identify_distributions(self, files):
         if not files:
@@ -352,7 +365,92 @@ class DebTracer(DistributionTracer):
         #   of origins etc
         yield dist, remaining_files
 
+    @profiled
     def _get_packagefields_for_files(self, files):
+        file_index = self._get_dpkg_file_index()
+        if file_index is None:
+            return self._get_packagefields_for_files_dpkgquery(files)
+        file_to_package_dict = {}
+        owned_files = [f for f in files if file_index.get(f)]
+        # Directories are commonly shared among packages, so stat all the
+        # files with multiple owners at once
+        shared_stats = self._session.stat_many(
+            [f for f in owned_files if len(file_index[f]) > 1],
+            follow_symlinks=True)
+        for f in owned_files:
+            pkgs = file_index[f]
+            if len(pkgs) > 1:
+                # otherwise the same treatment as in _parse_dpkgquery_line
+                st = shared_stats.get(f)
+                if st is not None and st.type == 'dir':
+                    continue
+                lgr.warning("File %s belongs to multiple packages (%s)", f,
+                            ", ".join(p['name'] for p in pkgs))
+            pkg = dict(pkgs[0])
+            lgr.debug("Identified file %r to belong to package %s", f, pkg)
+            file_to_package_dict[f] = pkg
+        return file_to_package_dict
+
+    def _get_dpkg_file_index(self):
+        """Return a mapping of paths to the packagefields of packages owning them
+
+        The mapping is built from /var/lib/dpkg/info/*.list files (with
+        diversions applied) which are read from the session in bulk, only
+        once per tracer.
+
+        Returns
+        -------
+        dict or None
+          None if the dpkg database could not be read in bulk
+        """
+        if self._dpkg_file_index is None:
+            try:
+                self._dpkg_file_index = self._load_dpkg_file_index()
+            except CommandError as exc:
+                lgr.debug("Could not read dpkg file lists, will use "
+                          "dpkg-query: %s", exc)
+                self._dpkg_file_index = False
+        return self._dpkg_file_index or None
+
+    def _load_dpkg_file_index(self):
+        out, _ = self._session.execute_command(
+            ['find', '/var/lib/dpkg/info', '-name', '*.list',
+             '-exec', 'grep', '-H', '', '{}', '+'])
+        out = utils.to_unicode(out, "utf-8")
+        file_index = defaultdict(list)
+        # Share the same fields among all the files of a package
+        pkgs = {}
+        for name, architecture, path in parse_dpkg_info_lists_output(out):
+            key = (name, architecture)
+            if key not in pkgs:
+                pkgs[key] = {'name': name} if architecture is None \
+                    else {'name': name, 'architecture': architecture}
+            file_index[path].append(pkgs[key])
+        if not file_index:
+            raise CommandError(msg="No files listed in /var/lib/dpkg/info")
+        try:
+            diversions = parse_dpkg_diversions(
+                utils.to_unicode(
+                    self._session.read('/var/lib/dpkg/diversions'), "utf-8"))
+        except (CommandError, SessionRuntimeError) as exc:
+            lgr.debug("Could not read dpkg diversions: %s", exc)
+            diversions = {}
+        # Files shipped by a package at a diverted path are installed under
+        # the path they were diverted to.  Only the diverting package (if any)
+        # keeps owning the original path
+        for divert_from, (divert_to, divert_by) in diversions.items():
+            owners = file_index.pop(divert_from, [])
+            diverted = [p for p in owners if p['name'] != divert_by]
+            if diverted:
+                file_index[divert_to].extend(diverted)
+            kept = [p for p in owners if p['name'] == divert_by]
+            if kept:
+                file_index[divert_from] = kept
+        lgr.debug("Loaded dpkg file index for %d packages with %d paths",
+                  len(pkgs), len(file_index))
+        return dict(file_index)
+
+    def _get_packagefields_for_files_dpkgquery(self, files):
         # Call dpkg query in batches
         exec_gen = execute_command_batch(
             self._session, ['dpkg-query', '-S'], files,
@@ -402,7 +500,8 @@ class DebTracer(DistributionTracer):
         # Store the package details as dicts so that we can easily add to them
         pkg_dicts = [attr.asdict(pkg) for pkg in packages]
 
-        # Use dpkg -s <pkg> to get arch and version
+        # Use /var/lib/dpkg/status (or dpkg -s <pkg>) to get arch, version
+        # and installed size
         self._get_pkgs_arch_and_version(pkg_dicts)
 
         # Use apt-cache show <pkg> to get details
@@ -454,10 +553,52 @@ class DebTracer(DistributionTracer):
                     date=date,
                     archive_uri=src_vals.get("archive_uri"))
 
+    @profiled
     def _get_pkgs_arch_and_version(self, pkg_dicts):
+        results = self._get_dpkg_status()
+        if results is None:
+            results = self._get_dpkg_status_dpkg_s(pkg_dicts)
+        # Loop through each package and find the respective dpkg results
+        # Note: "architecture" is in the dict, but may be null
+        for p in pkg_dicts:
+            r = results.get(p["name"] if not p["architecture"]
+                            else "%(name)s:%(architecture)s" % p)
+            if not r:
+                lgr.warning("Was unable to get dpkg status for %s" %
+                            p["name"])
+                continue
+            # Update the dictionary with found results
+            p["architecture"] = r["architecture"]
+            p["version"] = r["version"]
+            if r.get("installed-size"):
+                p["installed_size"] = r["installed-size"]
+
+    def _get_dpkg_status(self):
+        """Return a lookup table of installed packages from /var/lib/dpkg/status
+
+        The status file is read from the session only once per tracer.
+
+        Returns
+        -------
+        dict or None
+          None if the status file could not be read
+        """
+        if self._dpkg_status is None:
+            try:
+                out = self._session.read('/var/lib/dpkg/status')
+            except (CommandError, SessionRuntimeError) as exc:
+                lgr.debug("Could not read dpkg status file, will use "
+                          "dpkg -s: %s", exc)
+                self._dpkg_status = False
+            else:
+                out = utils.to_unicode(out, "utf-8")
+                self._dpkg_status = self.create_lookup_from_apt_cache_show(
+                    parse_dpkg_status(io.StringIO(out)))
+        return self._dpkg_status if self._dpkg_status is not False else None
+
+    def _get_dpkg_status_dpkg_s(self, pkg_dicts):
         # Convert package names to name:arch format
         # Use "dpkg -s pkg" to get the installed version and arch
-        # Note: "architecture" is in the dict, but may be null
         queries = [(p["name"] if not p["architecture"]
                     else "%(name)s:%(architecture)s" % p)
                    for p in pkg_dicts]
@@ -471,18 +612,7 @@ class DebTracer(DistributionTracer):
         # Combine sequence of lists
         results = itertools.chain.from_iterable(results)
         # Turn dpkg -s results into a lookup table by package name
-        results = self.create_lookup_from_apt_cache_show(results)
-        # Loop through each package and find the respective dpkg results
-        for p in pkg_dicts:
-            r = results.get(p["name"] if not p["architecture"]
-                            else "%(name)s:%(architecture)s" % p)
-            if not r:
-                lgr.warning("Was unable to run dpkg -s for %s" %
-                            p["name"])
-                continue
-            # Update the dictionary with found results
-            p["architecture"] = r["architecture"]
-            p["version"] = r["version"]
+        return self.create_lookup_from_apt_cache_show(results)
 
     @staticmethod
     def create_lookup_from_apt_cache_show(cmd_results):
@@ -492,20 +622,22 @@ class DebTracer(DistributionTracer):
             lookup_results["%(package)s:%(architecture)s" % r] = r
         return lookup_results
 
+    @profiled
     def _get_pkgs_details_from_apt_cache_show(self, pkg_dicts):
-        # Convert package names to name:arch=version format
-        queries = ["%(name)s:%(architecture)s=%(version)s" % p
-                   for p in pkg_dicts]
-        # Call "apt-cache show" in batches
-        exec_gen = execute_command_batch(self._session, ['apt-cache', 'show'],
-                                         queries)
-        # Parse and accumulate "apt-cache show" results
-        results = (parse_apt_cache_show_pkgs_output(out)
-                   for (out, _, _) in exec_gen)
-        # Combine sequence of lists
-        results = itertools.chain.from_iterable(results)
-        # Turn apt-cache show results into a lookup table by package name
-        results = self.create_lookup_from_apt_cache_show(results)
+        results = {}
+        apt_lists_index = self._get_apt_lists_index()
+        if apt_lists_index is not None:
+            for p in pkg_dicts:
+                r = apt_lists_index.get(p["name"], p["architecture"],
+                                        p["version"])
+                if r:
+                    results["%(name)s:%(architecture)s" % p] = r
+        # Use apt-cache for the ones which are not in the lists, e.g.
+        # installed from local .deb files
+        missing = [p for p in pkg_dicts
+                   if "%(name)s:%(architecture)s" % p not in results]
+        if missing:
+            results.update(self._get_apt_cache_show_lookup(missing))
         # Loop through each package and find the respective apt-cache results
         for p in pkg_dicts:
             r = results.get("%(name)s:%(architecture)s" % p)
@@ -519,6 +651,46 @@ class DebTracer(DistributionTracer):
                 if f in r:
                     p[f] = r[f]
 
+    def _get_apt_cache_show_lookup(self, pkg_dicts):
+        # Convert package names to name:arch=version format
+        queries = ["%(name)s:%(architecture)s=%(version)s" % p
+                   for p in pkg_dicts]
+        # Call "apt-cache show" in batches
+        exec_gen = execute_command_batch(self._session, ['apt-cache', 'show'],
+                                         queries)
+        # Parse and accumulate "apt-cache show" results
+        results = (parse_apt_cache_show_pkgs_output(out)
+                   for (out, _, _) in exec_gen)
+        # Combine sequence of lists
+        results = itertools.chain.from_iterable(results)
+        # Turn apt-cache show results into a lookup table by package name
+        return self.create_lookup_from_apt_cache_show(results)
+
+    def _get_apt_lists_index(self):
+        """Return an index over the APT lists if those are accessible locally
+
+        Returns
+        -------
+        APTListsIndex or None
+          None if the session is not local, so apt-cache should be used
+        """
+        if self._apt_lists_index is None:
+            self._apt_lists_index = False
+            if isinstance(self._session, ShellSession):
+                try:
+                    self._apt_lists_index = APTListsIndex(
+                        cache_file=cfg.getpath(
+                            'debian', 'apt lists index',
+                            default=os.path.join(cfg.dirs.user_cache_dir,
+                                                 'apt_lists_index.pickle'))
+                    ).load()
+                except (IOError, OSError, ValueError) as exc:
+                    lgr.debug("Could not index APT lists, will use "
+                              "apt-cache: %s", exc)
+        return self._apt_lists_index \
+            if self._apt_lists_index is not False else None
+
+    @profiled
     def _get_pkgs_install_date(self, pkg_dicts):
         # Convert package names to dpkg list filenames
         queries = [self._pkg_name_to_dpkg_list_file(p["name"])
@@ -550,6 +722,7 @@ class DebTracer(DistributionTracer):
         query = "/var/lib/dpkg/info/" + name + ".list"
         return query
 
+    @profiled
     def _get_pkgs_versions_and_sources(self, pkg_dicts):
         # Convert package names to name:arch format
         queries = ["%(name)s:%(architecture)s" % p for p in pkg_dicts]
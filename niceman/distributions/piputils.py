@@ -9,11 +9,19 @@
 """Utilities for working with pip.
 """
 import itertools
+import json
 import os
 import re
 
+from six.moves.urllib.parse import unquote
+from six.moves.urllib.parse import urlparse
+
+from niceman.support.exceptions import CommandError
 from niceman.utils import execute_command_batch
 
+import logging
+lgr = logging.getLogger('niceman.distributions.piputils')
+
 
 def parse_pip_show(out):
     pip_info = {}
@@ -189,3 +197,190 @@ def get_package_details(session, which_pip, packages=None):
     for pkg in details:
         details[pkg]["editable"] = pkg_to_editloc[pkg] is not None
     return details, file_to_pkg
+
+
+# Marks the beginning of a file in the output of _SITE_PACKAGES_SCRIPT
+_FILE_MARKER = "==> niceman file: "
+
+# Dumps metadata of the packages within site-packages under the prefix ($1),
+# also of egg-info directories the .egg-link files (editable packages) point
+# to, and the files telling if the prefix is a virtualenv with access to the
+# global site-packages
+_SITE_PACKAGES_SCRIPT = """\
+dump() { [ -f "$1" ] && printf '\\n%s%s\\n' "$M" "$1" && cat "$1"; }
+M='""" + _FILE_MARKER + """'
+for sp in "$1"/lib/python*/site-packages; do
+    for f in "$sp"/*.dist-info/METADATA "$sp"/*.dist-info/RECORD \\
+             "$sp"/*.dist-info/direct_url.json "$sp"/*.egg-info \\
+             "$sp"/*.egg-info/PKG-INFO "$sp"/*.egg-info/installed-files.txt \\
+             "$sp"/*.egg-link; do
+        dump "$f"
+        case "$f" in *.egg-link)
+            for g in "$(head -n 1 "$f")"/*.egg-info/PKG-INFO; do
+                dump "$g"
+            done;;
+        esac
+    done
+done
+for f in "$1"/pyvenv.cfg "$1"/lib/python*/orig-prefix.txt \\
+         "$1"/lib/python*/no-global-site-packages.txt; do
+    dump "$f"
+done
+true
+"""
+
+
+def _read_site_packages(session, prefix):
+    """Return a dict of paths to the content of package metadata files"""
+    out, _ = session.execute_command(
+        ["sh", "-c", _SITE_PACKAGES_SCRIPT, "sh", prefix])
+    files = {}
+    for entry in out.split("\n" + _FILE_MARKER)[1:]:
+        path, _, content = entry.partition("\n")
+        files[path] = content
+    return files
+
+
+def _has_global_site_packages(files):
+    """Tell if a virtualenv has access to the global site-packages"""
+    for path, content in files.items():
+        if os.path.basename(path) == "pyvenv.cfg":
+            return bool(re.search(
+                r"^\s*include-system-site-packages\s*=\s*true\s*$",
+                content, flags=re.MULTILINE | re.IGNORECASE))
+    # virtualenv < 20 records the lack of access in a separate file
+    basenames = set(os.path.basename(path) for path in files)
+    return "orig-prefix.txt" in basenames \
+        and "no-global-site-packages.txt" not in basenames
+
+
+def parse_pkg_info(content):
+    """Return name and version from PKG-INFO or METADATA of a package"""
+    fields = {}
+    for line in content.splitlines():
+        if not line.strip():  # the end of headers
+            break
+        tag, sep, value = line.partition(":")
+        if sep and not tag.startswith((" ", "\t")):
+            fields.setdefault(tag.strip().lower(), value.strip())
+    return fields.get("name"), fields.get("version")
+
+
+def parse_record(content):
+    """Return paths listed within RECORD of a package"""
+    re_path = re.compile(r'^(?:"((?:[^"]|"")*)"|([^,]*))')
+    paths = []
+    for line in content.splitlines():
+        quoted, plain = re_path.match(line).groups()
+        path = quoted.replace('""', '"') if quoted is not None else plain
+        if path:
+            paths.append(path)
+    return paths
+
+
+def _canonical_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def get_installed_package_details(session, prefix, packages=None):
+    """Get package details from the metadata of packages within a prefix
+
+    This is similar to `get_package_details`, but metadata (.dist-info and
+    .egg-info, including .egg-link'ed ones of editable packages) within
+    site-packages under `prefix` are read directly without running pip.
+
+    Parameters
+    ----------
+    session : Session instance
+        Session in which to execute the command.
+    prefix : str
+        Path to the virtualenv or conda environment.
+    packages : list of str, optional
+        Package names.  If not given, all packages are used.
+
+    Returns
+    -------
+    A tuple of two dicts as returned by `get_package_details`, or None if
+    the metadata could not be read or `prefix` is a virtualenv which also
+    has access to global site-packages (so pip should be used).
+    """
+    try:
+        files = _read_site_packages(session, prefix)
+    except CommandError as exc:
+        lgr.debug("Could not read metadata of packages in %s: %s",
+                  prefix, exc)
+        return None
+    if _has_global_site_packages(files):
+        lgr.debug("%s has access to global site-packages", prefix)
+        return None
+
+    # metadata directory (or file) -> package details, along with the
+    # files of the package relative to site-packages
+    dists = {}
+
+    def add_dist(meta_path, content, location, editable=False):
+        name, version = parse_pkg_info(content)
+        if name:
+            dists[meta_path] = {"name": name, "version": version,
+                                "location": location, "editable": editable,
+                                "site_packages": location, "files": []}
+
+    for path, content in files.items():
+        meta_path, basename = os.path.split(path)
+        site_packages = os.path.dirname(meta_path)
+        if basename in ("METADATA", "PKG-INFO") \
+                and os.path.basename(site_packages) == "site-packages":
+            add_dist(meta_path, content, site_packages)
+        elif path.endswith(".egg-info") and os.path.basename(
+                os.path.dirname(path)) == "site-packages":
+            add_dist(path, content, meta_path)
+        elif path.endswith(".egg-link"):
+            location = content.splitlines()[0].strip() if content else ""
+            for egg_path, egg_content in files.items():
+                if os.path.dirname(os.path.dirname(egg_path)) == location \
+                        and egg_path.endswith(".egg-info/PKG-INFO"):
+                    add_dist(path, egg_content, location, editable=True)
+
+    for path, content in files.items():
+        meta_path, basename = os.path.split(path)
+        dist = dists.get(meta_path)
+        if not dist:
+            continue
+        if basename == "RECORD":
+            dist["files"] = parse_record(content)
+        elif basename == "installed-files.txt":
+            # listed relative to the .egg-info directory
+            dist["files"] = [
+                os.path.relpath(os.path.join(meta_path, f),
+                                dist["site_packages"])
+                for f in content.splitlines() if f.strip()]
+        elif basename == "direct_url.json":
+            try:
+                direct_url = json.loads(content)
+            except ValueError:
+                continue
+            url = urlparse(direct_url.get("url", ""))
+            if direct_url.get("dir_info", {}).get("editable") \
+                    and url.scheme == "file":
+                dist["location"] = unquote(url.path)
+                dist["editable"] = True
+
+    wanted = None
+    if packages is not None:
+        wanted = dict((_canonical_name(p), p) for p in packages)
+    details = {}
+    file_to_pkg = {}
+    for dist in dists.values():
+        name = _canonical_name(dist["name"])
+        if wanted is not None:
+            if name not in wanted:
+                continue
+            pkg = wanted[name]
+        else:
+            pkg = dist["name"].lower()
+        site_packages = dist.pop("site_packages")
+        for path in dist.pop("files"):
+            file_to_pkg[os.path.normpath(
+                os.path.join(site_packages, path))] = pkg
+        details[pkg] = dist
+    return details, file_to_pkg
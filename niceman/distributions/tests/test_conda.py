@@ -24,11 +24,14 @@ import attr
 from niceman.formats.niceman import NicemanProvenance
 from niceman.tests.utils import create_pymodule
 from niceman.tests.utils import skip_if_no_network, assert_is_subset_recur
+from niceman.utils import PathRoot
+from niceman.utils import swallow_logs
 
 import json
 
 from niceman.distributions.conda import CondaTracer, CondaDistribution, \
-    CondaEnvironment, get_conda_platform_from_python, get_miniconda_url
+    CondaEnvironment, get_conda_platform_from_python, get_miniconda_url, \
+    iter_concatenated_json, parse_conda_history
 
 
 def test_get_conda_platform_from_python():
@@ -259,6 +262,171 @@ def test_conda_init_install_and_detect():
                 assert pkg.installer is None
 
 
+def test_install_packages_concurrently():
+    import threading
+    from niceman import cfg
+    dist = CondaDistribution(
+        name="conda",
+        path="/conda",
+        conda_version="4.5.4",
+        python_version="3.6.5.final.0",
+        platform="linux-64",
+        environments=[
+            CondaEnvironment(name="env%d" % i, path="/conda/envs/env%d" % i)
+            for i in range(3)])
+    commands = []
+    threads = set()
+
+    def execute_command(command, env=None):
+        commands.append((command, env))
+        if "info --json" in command:
+            return json.dumps({"conda_version": "4.5.4",
+                               "python_version": "3.6.5.final.0"}), ""
+        if "conda-env" in command:
+            threads.add(threading.current_thread().name)
+        return "", ""
+
+    session = mock.MagicMock()
+    session.mktmpdir.return_value = "/tmp/install"
+    session.isdir.side_effect = lambda path: path == "/conda/envs/env0"
+    session.execute_command.side_effect = execute_command
+    with mock.patch.object(cfg, "get_as_dtype", return_value=3):
+        dist.install_packages(session)
+    # within the pool
+    assert threads and threading.current_thread().name not in threads
+    # the root is up to date already
+    assert not [c for c, _ in commands if "conda install" in c]
+    env_commands = sorted(c for c in commands if "conda-env" in c[0])
+    pkgs_env = "env CONDA_PKGS_DIRS=/conda/pkgs "
+    assert env_commands == [
+        (pkgs_env + "/conda/bin/conda-env create -p /conda/envs/env1 "
+         "-f /tmp/install/env1 ", None),
+        (pkgs_env + "/conda/bin/conda-env create -p /conda/envs/env2 "
+         "-f /tmp/install/env2 ", None),
+        (pkgs_env + "/conda/bin/conda-env update -p /conda/envs/env0 "
+         "-f /tmp/install/env0 ", None)]
+
+    # otherwise it is updated
+    dist.conda_version = "4.5.11"
+    del commands[:]
+    dist.install_packages(session)
+    assert ("/conda/bin/conda install -y conda=4.5.11 python=3.6.5", None) \
+        in commands
+
+
+def test_install_packages_explicit():
+    from niceman import cfg
+    packages = [
+        {"name": "xz", "version": "5.2.3", "build": "0",
+         "url": "https://conda.anaconda.org/conda-forge/linux-64/"
+                "xz-5.2.3-0.tar.bz2",
+         "md5": "f4e0d30b3caf631be7973cba1cf6f601"},
+        {"name": "local", "version": "1.0", "build": "0"},
+        {"name": "rpaths", "installer": "pip", "version": "0.13"}]
+    dist = CondaDistribution(
+        name="conda",
+        path="/conda",
+        conda_version="4.5.4",
+        python_version="3.6.5.final.0",
+        platform="linux-64",
+        environments=[
+            CondaEnvironment(name="env1", path="/conda/envs/env1",
+                             packages=packages),
+            CondaEnvironment(name="env2", path="/conda/envs/env2",
+                             packages=packages[:1])])
+    commands = []
+    put = {}
+
+    def put_file(src, dest):
+        with open(src) as f:
+            put[dest] = f.read()
+
+    session = mock.MagicMock()
+    session.mktmpdir.return_value = "/tmp/install"
+    session.isdir.side_effect = lambda path: path == "/conda"
+    session.execute_command.side_effect = \
+        lambda command, env=None: commands.append(command) or ("", "")
+    session.put.side_effect = put_file
+    with mock.patch.object(cfg, "getboolean", return_value=True):
+        dist.install_packages(session)
+
+    assert put["/tmp/install/env1.explicit"] == \
+        put["/tmp/install/env2.explicit"] == \
+        "@EXPLICIT\n%(url)s#%(md5)s\n" % packages[0]
+    # only what could not be installed from the explicit list is solved
+    assert yaml.safe_load(put["/tmp/install/env1"])["dependencies"] == \
+        ["local=1.0=0", {"pip": ["rpaths==0.13"]}]
+    assert "/tmp/install/env2" not in put
+    env_commands = [c for c in commands
+                    if isinstance(c, str) and "/conda/envs/" in c]
+    pkgs_env = "env CONDA_PKGS_DIRS=/conda/pkgs "
+    assert env_commands == [
+        pkgs_env + "/conda/bin/conda create -y -p /conda/envs/env1 "
+        "--file /tmp/install/env1.explicit",
+        pkgs_env + "/conda/bin/conda-env create -p /conda/envs/env1 "
+        "-f /tmp/install/env1 ",
+        pkgs_env + "/conda/bin/conda create -y -p /conda/envs/env2 "
+        "--file /tmp/install/env2.explicit"]
+    # packages were downloaded beforehand
+    assert len([c for c in commands
+                if isinstance(c, str) and "xargs -P 4" in c]) == 2
+
+
+@pytest.mark.parametrize("explicit", [False, True])
+def test_install_packages_docker_session(explicit):
+    # DockerSession cannot pass env to the commands it executes
+    from niceman import cfg
+    from niceman.resource.docker_container import DockerSession
+    dist = CondaDistribution(
+        name="conda",
+        path="/conda",
+        conda_version="4.5.4",
+        python_version="3.6.5.final.0",
+        platform="linux-64",
+        environments=[
+            CondaEnvironment(
+                name="env1", path="/conda/envs/env1",
+                packages=[
+                    {"name": "xz", "version": "5.2.3", "build": "0",
+                     "url": "https://conda.anaconda.org/conda-forge/"
+                            "linux-64/xz-5.2.3-0.tar.bz2",
+                     "md5": "f4e0d30b3caf631be7973cba1cf6f601"},
+                    {"name": "rpaths", "installer": "pip",
+                     "version": "0.13"}])])
+    commands = []
+    dirs = {"/conda", "/tmp/install"}
+
+    def exec_create(container, cmd):
+        commands.append(cmd)
+        return {"Id": len(commands) - 1}
+
+    def exec_start(exec_id, stream):
+        cmd = commands[exec_id]
+        if cmd == ["mktemp", "-d"]:
+            return [b"/tmp/install\n"]
+        if cmd[:2] == ["bash", "-c"] and cmd[2].startswith("test -"):
+            path = cmd[2].split()[2]
+            return [b"Found\n"] if path in dirs else []
+        if "info --json" in cmd:
+            return [json.dumps({"conda_version": "4.5.4",
+                                "python_version": "3.6.5.final.0"})
+                    .encode()]
+        return []
+
+    client = mock.MagicMock()
+    client.exec_create.side_effect = exec_create
+    client.exec_start.side_effect = exec_start
+    client.exec_inspect.return_value = {"ExitCode": 0}
+    session = DockerSession(client, {"Id": "container"})
+    with mock.patch.object(cfg, "getboolean", return_value=explicit):
+        dist.install_packages(session)
+    pkgs_env = "env CONDA_PKGS_DIRS=/conda/pkgs "
+    assert pkgs_env + "/conda/bin/conda-env create -p /conda/envs/env1 " \
+        "-f /tmp/install/env1 " in commands
+    assert (pkgs_env + "/conda/bin/conda create -y -p /conda/envs/env1 "
+            "--file /tmp/install/env1.explicit" in commands) == explicit
+
+
 def test_get_conda_env_export_exceptions():
     # Mock to capture logs
     def log_warning(msg, *args):
@@ -287,3 +455,242 @@ def test_get_conda_env_export_exceptions():
         mock.patch.object(lgr, "warning", log_warning):
         tracer._get_conda_env_export("", "/conda")
         assert "unknown" in log_warning.val
+
+
+def test_iter_concatenated_json():
+    assert list(iter_concatenated_json('')) == []
+    assert list(iter_concatenated_json(
+        '{"name": "a"}\n{"name": "b",\n "files": []}\n\n[1]')) == \
+        [{"name": "a"}, {"name": "b", "files": []}, [1]]
+    # malformed documents are skipped, if requested
+    errors = []
+    content = '{"name": "a"}{"name": "b",\n  "files": [\n{\n  "name": "c"\n}'
+    assert list(iter_concatenated_json(content, on_error=errors.append)) == \
+        [{"name": "a"}, {"name": "c"}]
+    assert len(errors) == 1
+    with pytest.raises(ValueError):
+        list(iter_concatenated_json(content))
+
+
+def test_parse_conda_history():
+    assert parse_conda_history("") == (set(), set())
+    assert parse_conda_history("""\
+==> 2018-06-01 12:00:00 <==
+# cmd: conda install numpy
+-defaults::numpy-1.14.2-py36_1
++defaults::numpy-1.14.3-py36_1
++pkg-with-dashes-1.0-0
+==> 2018-06-02 12:00:00 <==
+# cmd: conda remove pkg-with-dashes
+-pkg-with-dashes-1.0-0
+-conda-forge::other-2.0-1
+""") == ({"numpy-1.14.3-py36_1"},
+         {"numpy-1.14.2-py36_1", "other-2.0-1"})
+
+
+def test_get_conda_package_details(tmpdir):
+    meta_dir = tmpdir.mkdir("conda-meta")
+    for name in "pkg1", "pkg2":
+        meta_dir.join("%s-1.0-0.json" % name).write(json.dumps({
+            "name": name, "version": "1.0", "build": "0",
+            "schannel": "defaults", "files": ["lib/%s.py" % name],
+            "link": {"source": "/some/huge/record"}}, indent=2))
+    meta_dir.join("history").write("")
+    conda_path = str(tmpdir)
+    tracer = CondaTracer()
+    with mock.patch.object(tracer._session, "execute_command",
+                           wraps=tracer._session.execute_command) as exec_:
+        packages, file_to_pkg = tracer._get_conda_package_details(conda_path)
+    # all the records were read at once
+    assert exec_.call_count == 1
+    assert packages == {
+        "pkg%d=1.0=0" % i: {"name": "pkg%d" % i, "version": "1.0",
+                            "build": "0", "schannel": "defaults"}
+        for i in (1, 2)}
+    assert file_to_pkg == {
+        os.path.join(conda_path, "lib", "pkg%d.py" % i): "pkg%d=1.0=0" % i
+        for i in (1, 2)}
+
+    # empty environment
+    meta_dir.remove()
+    assert tracer._get_conda_package_details(conda_path) == ({}, {})
+
+
+def test_get_conda_package_details_bad_records(tmpdir):
+    meta_dir = tmpdir.mkdir("conda-meta")
+    records = {
+        "pkg1": {"name": "pkg1", "version": "1.0", "build": "0",
+                 "files": ["lib/pkg1.py"]},
+        # no version
+        "pkg2": {"name": "pkg2", "build": "0", "files": ["lib/pkg2.py"]},
+        # no files
+        "pkg4": {"name": "pkg4", "version": "1.0", "build": "0"},
+        "pkg5": {"name": "pkg5", "version": "1.0", "build": "0",
+                 "files": ["lib/pkg5.py"]},
+    }
+    for name, record in records.items():
+        meta_dir.join("%s-1.0-0.json" % name).write(
+            json.dumps(record, indent=2))
+    # partially written
+    meta_dir.join("pkg3-1.0-0.json").write(json.dumps(
+        {"name": "pkg3", "version": "1.0", "build": "0",
+         "files": ["lib/pkg3.py"]}, indent=2)[:30])
+    conda_path = str(tmpdir)
+    tracer = CondaTracer()
+    with swallow_logs(new_level=logging.WARNING) as log:
+        packages, file_to_pkg = tracer._get_conda_package_details(conda_path)
+        assert "Could not retrieve conda info" in log.out
+    assert sorted(packages) == ["pkg1=1.0=0", "pkg4=1.0=0", "pkg5=1.0=0"]
+    assert file_to_pkg == {
+        os.path.join(conda_path, "lib", "pkg%d.py" % i): "pkg%d=1.0=0" % i
+        for i in (1, 5)}
+
+
+def test_get_conda_env_details_cached(tmpdir):
+    from niceman.support.cache import FingerprintCache
+    meta_dir = tmpdir.mkdir("env").mkdir("conda-meta")
+    meta_dir.join("history").write("")
+    meta_dir.join("pkg1-1.0-0.json").write(json.dumps({
+        "name": "pkg1", "version": "1.0", "build": "0",
+        "files": ["lib/pkg1.py"]}))
+    conda_path = str(tmpdir.join("env"))
+    cache = FingerprintCache(str(tmpdir.join("cache")))
+
+    def get_details(**kwargs):
+        tracer = CondaTracer(**kwargs)
+        assert (tracer._cache is None) == (kwargs.get("cache") is False)
+        if tracer._cache:
+            tracer._cache = cache
+        with mock.patch.object(tracer, "_get_conda_info",
+                               return_value={"root_prefix": "/root"}) \
+                as get_info, \
+                mock.patch.object(tracer, "_get_conda_env_export",
+                                  return_value={}):
+            details = tracer._get_conda_env_details(conda_path)
+        return details, get_info.call_count
+
+    details, ninfo = get_details()
+    assert ninfo == 1
+    root_path, packages, file_to_pkg = details
+    assert root_path == "/root"
+    assert list(packages) == ["pkg1=1.0=0"]
+    # loaded from the cache
+    assert get_details() == (details, 0)
+    # unless asked not to
+    assert get_details(cache=False) == (details, 1)
+    # or the environment changed
+    meta_dir.join("pkg2-1.0-0.json").write(json.dumps({
+        "name": "pkg2", "version": "1.0", "build": "0", "files": []}))
+    details, ninfo = get_details()
+    assert ninfo == 1
+    assert sorted(details[1]) == ["pkg1=1.0=0", "pkg2=1.0=0"]
+
+
+def test_get_conda_info_memoized():
+    tracer = CondaTracer()
+    calls = []
+
+    def execute_command(cmd):
+        calls.append(cmd)
+        return json.dumps({"root_prefix": "/conda",
+                           "conda_version": "4.5.4"}), ""
+
+    with mock.patch.object(tracer._session, "execute_command",
+                           execute_command):
+        info = tracer._get_conda_info("/conda/envs/env1")
+        assert info["conda_version"] == "4.5.4"
+        assert tracer._get_conda_info("/conda/envs/env1") == info
+        # known root and other environments of it
+        assert tracer._get_conda_info("/conda") == info
+        assert tracer._get_conda_info("/conda/envs/env2") == info
+    assert calls == ["/conda/envs/env1/bin/conda info --json"]
+
+
+def test_identify_distributions_concurrently():
+    import threading
+    tracer = CondaTracer()
+    env_paths = ["/conda"] + ["/conda/envs/env%d" % i for i in range(5)]
+    threads = set()
+
+    def get_env_details(conda_path):
+        threads.add(threading.current_thread().name)
+        name = os.path.basename(conda_path)
+        return "/conda", {name: {"name": name}}, \
+            {conda_path + "/bin/" + name: name}
+
+    with mock.patch.object(tracer, "_get_conda_env_path",
+                           PathRoot(lambda p: p in env_paths)), \
+            mock.patch.object(tracer, "_get_conda_env_details",
+                              get_env_details), \
+            mock.patch.object(tracer, "_get_conda_info",
+                              return_value={"conda_version": "4.5.4"}):
+        dists = list(tracer.identify_distributions(
+            [p + "/bin/" + os.path.basename(p) for p in env_paths]
+            + ["/unrelated"]))
+    # run within the pool
+    assert threads and threading.current_thread().name not in threads
+    (dist, unknown_files), = dists
+    assert unknown_files == {"/unrelated"}
+    assert [(env.name, env.path, [p.files for p in env.packages])
+            for env in dist.environments] == \
+        [("root", "/conda", [["bin/conda"]])] + \
+        [("env%d" % i, "/conda/envs/env%d" % i, [["bin/env%d" % i]])
+         for i in range(5)]
+
+
+def test_get_conda_env_details_updated(tmpdir):
+    from niceman.support.cache import FingerprintCache
+    meta_dir = tmpdir.mkdir("env").mkdir("conda-meta")
+    conda_path = str(tmpdir.join("env"))
+    cache = FingerprintCache(str(tmpdir.join("cache")))
+
+    def install(name, version="1.0"):
+        meta_dir.join("%s-%s-0.json" % (name, version)).write(json.dumps({
+            "name": name, "version": version, "build": "0",
+            "files": ["lib/%s.py" % name]}))
+        return "+defaults::%s-%s-0\n" % (name, version)
+
+    def uninstall(name, version="1.0"):
+        meta_dir.join("%s-%s-0.json" % (name, version)).remove()
+        return "-defaults::%s-%s-0\n" % (name, version)
+
+    def get_details():
+        tracer = CondaTracer()
+        tracer._cache = cache
+        with mock.patch.object(tracer, "_get_conda_info",
+                               return_value={"root_prefix": "/root"}) \
+                as get_info, \
+                mock.patch.object(tracer, "_get_conda_env_export",
+                                  return_value={}), \
+                mock.patch.object(tracer, "_read_conda_meta",
+                                  wraps=tracer._read_conda_meta) as read:
+            details = tracer._get_conda_env_details(conda_path)
+        return details, get_info.call_count, \
+            [c[0][1:] for c in read.call_args_list]
+
+    history = meta_dir.join("history")
+    history.write("==> 2018-06-01 12:00:00 <==\n"
+                  + install("pkg1") + install("pkg2"))
+    details, ninfo, reads = get_details()
+    assert (ninfo, reads) == (1, [(None,)])
+
+    history.write("==> 2018-06-02 12:00:00 <==\n"
+                  + uninstall("pkg1") + install("pkg3")
+                  + uninstall("pkg2") + install("pkg2", "2.0"),
+                  mode="a")
+    details, ninfo, reads = get_details()
+    # only the records of the new packages were read
+    assert (ninfo, reads) == (0, [(["pkg2-2.0-0", "pkg3-1.0-0"],)])
+    root_path, packages, file_to_pkg = details
+    assert root_path == "/root"
+    assert sorted(packages) == ["pkg2=2.0=0", "pkg3=1.0=0"]
+    assert file_to_pkg == {
+        os.path.join(conda_path, "lib", "pkg2.py"): "pkg2=2.0=0",
+        os.path.join(conda_path, "lib", "pkg3.py"): "pkg3=1.0=0"}
+    assert get_details()[1:] == (0, [])
+
+    # changes not recorded in the history lead to reading all the records
+    install("pkg4")
+    details, ninfo, reads = get_details()
+    assert (ninfo, reads) == (1, [(None,)])
+    assert sorted(details[1]) == ["pkg2=2.0=0", "pkg3=1.0=0", "pkg4=1.0=0"]
@@ -24,6 +24,7 @@ import pytest
 
 import mock
 
+from niceman.support.exceptions import CommandError
 from niceman.utils import swallow_logs
 from niceman.tests.utils import skip_if_no_apt_cache
 
@@ -154,8 +155,11 @@ afni: /usr/lib/afni/bin/afni
 fail2ban: /usr/bin/fail2ban-server
 fail2ban: /usr/bin/fail2ban-server
 """, None, None)
+    # force the use of dpkg-query instead of the dpkg file index
     with mock.patch('niceman.distributions.debian.execute_command_batch',
-                    exec_cmd_batch_mock):
+                    exec_cmd_batch_mock), \
+            mock.patch.object(manager, '_get_dpkg_file_index',
+                              return_value=None):
         out = manager._get_packagefields_for_files(files)
 
     assert out == {
@@ -167,6 +171,140 @@ fail2ban: /usr/bin/fail2ban-server
     }
 
 
+def test_get_packagefields_for_files_index():
+    manager = DebTracer()
+    files = ['/bin/sh', '/bin/sh.distrib', '/bin/bash',
+             '/lib/i386-linux-gnu/libz.so.1.2.8',
+             '/lib/x86_64-linux-gnu/libz.so.1.2.8',
+             '/usr/bin/fail2ban-server',
+             '/usr', '/bogus']
+    lists_out = """\
+/var/lib/dpkg/info/dash.list:/bin/sh
+/var/lib/dpkg/info/bash.list:/bin/sh
+/var/lib/dpkg/info/bash.list:/bin/bash
+/var/lib/dpkg/info/bash.list:/usr
+/var/lib/dpkg/info/zlib1g:i386.list:/lib/i386-linux-gnu/libz.so.1.2.8
+/var/lib/dpkg/info/zlib1g:amd64.list:/lib/x86_64-linux-gnu/libz.so.1.2.8
+/var/lib/dpkg/info/fail2ban.list:/usr
+/var/lib/dpkg/info/fail2ban.list:/usr/bin/fail2ban-server
+"""
+    diversions = """\
+/bin/sh
+/bin/sh.distrib
+dash
+"""
+
+    def execute_command(cmd, **kwargs):
+        assert cmd[:2] == ['find', '/var/lib/dpkg/info']
+        return lists_out, ''
+
+    session = manager._session
+    with mock.patch.object(session, 'execute_command', execute_command), \
+            mock.patch.object(session, 'read', return_value=diversions), \
+            mock.patch('niceman.distributions.debian.execute_command_batch',
+                       side_effect=AssertionError("must not be called")):
+        out = manager._get_packagefields_for_files(files)
+        # all lookups are answered from the index loaded only once
+        out2 = manager._get_packagefields_for_files(files[:1])
+
+    assert out == {
+        '/bin/sh': {'name': 'dash'},
+        '/bin/sh.distrib': {'name': 'bash'},
+        '/bin/bash': {'name': 'bash'},
+        '/lib/i386-linux-gnu/libz.so.1.2.8': {'name': 'zlib1g', 'architecture': 'i386'},
+        '/lib/x86_64-linux-gnu/libz.so.1.2.8': {'name': 'zlib1g', 'architecture': 'amd64'},
+        '/usr/bin/fail2ban-server': {'name': 'fail2ban'},
+    }
+    assert out2 == {'/bin/sh': {'name': 'dash'}}
+
+
+def test_get_packagefields_for_files_index_fallback():
+    manager = DebTracer()
+
+    def exec_cmd_batch_mock(session, cmd, subfiles, exc_classes):
+        assert cmd == ['dpkg-query', '-S']
+        yield ("dash: /bin/sh\n", None, None)
+
+    with mock.patch.object(manager._session, 'execute_command',
+                           side_effect=CommandError("find", "failed")), \
+            mock.patch('niceman.distributions.debian.execute_command_batch',
+                       exec_cmd_batch_mock):
+        out = manager._get_packagefields_for_files(['/bin/sh'])
+    assert out == {'/bin/sh': {'name': 'dash'}}
+
+
+def test_get_pkgs_arch_and_version():
+    manager = DebTracer()
+    status = u"""\
+Package: zlib1g
+Status: install ok installed
+Installed-Size: 168
+Architecture: i386
+Version: 1:1.2.13.dfsg-1
+
+Package: zlib1g
+Status: install ok installed
+Installed-Size: 164
+Architecture: amd64
+Version: 1:1.2.13.dfsg-1
+
+Package: dash
+Status: install ok installed
+Installed-Size: 204
+Architecture: amd64
+Version: 0.5.12-2
+"""
+    pkg_dicts = [{'name': 'zlib1g', 'architecture': 'amd64'},
+                 {'name': 'dash', 'architecture': None},
+                 {'name': 'bogus', 'architecture': None}]
+    with mock.patch.object(manager._session, 'read',
+                           return_value=status) as read, \
+            mock.patch('niceman.distributions.debian.execute_command_batch',
+                       side_effect=AssertionError("must not be called")):
+        manager._get_pkgs_arch_and_version(pkg_dicts)
+        manager._get_pkgs_arch_and_version(pkg_dicts[:1])
+    read.assert_called_once_with('/var/lib/dpkg/status')
+    assert pkg_dicts == [
+        {'name': 'zlib1g', 'architecture': 'amd64',
+         'version': '1:1.2.13.dfsg-1', 'installed_size': '164'},
+        {'name': 'dash', 'architecture': 'amd64',
+         'version': '0.5.12-2', 'installed_size': '204'},
+        {'name': 'bogus', 'architecture': None},
+    ]
+
+
+def test_get_pkgs_details_from_apt_lists_index():
+    manager = DebTracer()
+    pkg_dicts = [{'name': 'zlib1g', 'architecture': 'amd64',
+                  'version': '1:1.2.13.dfsg-1'},
+                 {'name': 'local', 'architecture': 'amd64',
+                  'version': '1.0'}]
+    index = mock.Mock()
+    index.get.side_effect = lambda name, arch, version: \
+        {'package': name, 'architecture': arch, 'source_name': 'zlib',
+         'size': '87040'} if name == 'zlib1g' else None
+
+    def exec_cmd_batch_mock(session, cmd, queries):
+        # only the packages not in the lists are queried
+        assert cmd == ['apt-cache', 'show']
+        assert queries == ['local:amd64=1.0']
+        yield ("Package: local\nArchitecture: amd64\nVersion: 1.0\n",
+               None, None)
+
+    with mock.patch.object(manager, '_get_apt_lists_index',
+                           return_value=index), \
+            mock.patch('niceman.distributions.debian.execute_command_batch',
+                       exec_cmd_batch_mock):
+        manager._get_pkgs_details_from_apt_cache_show(pkg_dicts)
+    assert pkg_dicts[0]['source_name'] == 'zlib'
+    assert pkg_dicts[0]['size'] == '87040'
+    assert 'size' not in pkg_dicts[1]
+
+
+def test_apt_lists_index_only_for_local_sessions():
+    assert DebTracer(session=mock.Mock())._get_apt_lists_index() is None
+
+
 def test_parse_dpkgquery_line():
     parse = DebTracer()._parse_dpkgquery_line
 
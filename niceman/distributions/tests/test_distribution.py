@@ -100,4 +100,39 @@ dcm2niix=1:1.0.20171017+git3-g9ccc4c0-1~nd16.04+1', log.lines)
         call.add_command(['pip', 'install', 'piponlypkg']),
     ]
     environment.assert_has_calls(calls, any_order=True)
-    """
\ No newline at end of file
+    """
+
+
+def test_merge_spec_objects():
+    from niceman.distributions.base import merge_spec_objects
+    from niceman.distributions.debian import APTSource
+    from niceman.distributions.debian import DebianDistribution
+    from niceman.distributions.debian import DEBPackage
+
+    source = APTSource(name='apt_1', component='main')
+
+    def get_dist(*packages):
+        return DebianDistribution(
+            name='debian', apt_sources=[APTSource(name='apt_1',
+                                                  component='main')],
+            packages=[DEBPackage(name=name, version='1', files=files)
+                      for name, files in packages])
+
+    dists = merge_spec_objects([
+        get_dist(('a', ['/a1']), ('b', ['/b1'])),
+        get_dist(('b', ['/b2', '/b1']), ('c', ['/c1'])),
+    ])
+    assert len(dists) == 1
+    assert dists[0].apt_sources == [source]
+    assert [(p.name, p.files) for p in dists[0].packages] == [
+        ('a', ['/a1']), ('b', ['/b1', '/b2']), ('c', ['/c1'])]
+
+    # different versions of a package are kept separate
+    dists = merge_spec_objects([
+        get_dist(('a', ['/a1'])),
+        DebianDistribution(
+            name='debian',
+            packages=[DEBPackage(name='a', version='2', files=['/a2'])])
+    ])
+    assert [(p.name, p.version) for p in dists[0].packages] == [
+        ('a', '1'), ('a', '2')]
@@ -8,6 +8,7 @@
 # ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 
 import mock
+import os
 
 from niceman.distributions import piputils
 from niceman.tests.utils import assert_is_subset_recur
@@ -98,3 +99,87 @@ comma_in_vers (2.2,0)"""
               ("comma_in_vers", "2.2,0", None)]
     result = list(piputils.parse_pip_list(out))
     assert expect == result
+
+
+def test_parse_pkg_info():
+    assert piputils.parse_pkg_info("""\
+Metadata-Version: 2.1
+Name: pkg
+Version: 1.0
+Summary: Name: not this one
+Description: multi
+  Version: 2.0
+
+Version: 3.0
+""") == ("pkg", "1.0")
+    assert piputils.parse_pkg_info("") == (None, None)
+
+
+def test_parse_record():
+    assert piputils.parse_record("""\
+pkg/__init__.py,sha256=abc,10
+"pkg/with,comma.py",sha256=def,20
+../../../bin/pkg,,
+pkg-1.0.dist-info/RECORD,,
+""") == ["pkg/__init__.py", "pkg/with,comma.py", "../../../bin/pkg",
+         "pkg-1.0.dist-info/RECORD"]
+
+
+def test_get_installed_package_details(tmpdir):
+    from niceman.resource.shell import ShellSession
+    venv = tmpdir.mkdir("venv")
+    venv.join("pyvenv.cfg").write("include-system-site-packages = false\n")
+    sp = venv.mkdir("lib").mkdir("python3.6").mkdir("site-packages")
+    sp_path = str(sp)
+    src = tmpdir.mkdir("src")
+    # wheel installed
+    dist_info = sp.mkdir("Pkg_A-1.0.dist-info")
+    dist_info.join("METADATA").write("Name: Pkg-A\nVersion: 1.0\n")
+    dist_info.join("RECORD").write(
+        "pkg_a/__init__.py,sha256=x,1\n../../../bin/pkg-a,,\n")
+    # installed by setup.py install
+    egg_info = sp.mkdir("pkg_b-2.0-py3.6.egg-info")
+    egg_info.join("PKG-INFO").write("Name: pkg_b\nVersion: 2.0\n")
+    egg_info.join("installed-files.txt").write("../pkg_b/__init__.py\n")
+    sp.join("pkg_c-0.1-py3.6.egg-info").write("Name: pkg-c\nVersion: 0.1\n")
+    # editable, by an .egg-link and by direct_url.json
+    src.mkdir("dev.egg-info").join("PKG-INFO").write(
+        "Name: dev\nVersion: 0.2\n")
+    sp.join("dev.egg-link").write(str(src) + "\n.")
+    dist_info = sp.mkdir("newdev-0.3.dist-info")
+    dist_info.join("METADATA").write("Name: newdev\nVersion: 0.3\n")
+    dist_info.join("RECORD").write("__editable__.newdev-0.3.pth,,\n")
+    dist_info.join("direct_url.json").write(
+        '{"url": "file:///some/source", "dir_info": {"editable": true}}')
+
+    session = ShellSession()
+    details, file_to_pkg = piputils.get_installed_package_details(
+        session, str(venv))
+    assert details == {
+        "pkg-a": {"name": "Pkg-A", "version": "1.0", "location": sp_path,
+                  "editable": False},
+        "pkg_b": {"name": "pkg_b", "version": "2.0", "location": sp_path,
+                  "editable": False},
+        "pkg-c": {"name": "pkg-c", "version": "0.1", "location": sp_path,
+                  "editable": False},
+        "dev": {"name": "dev", "version": "0.2", "location": str(src),
+                "editable": True},
+        "newdev": {"name": "newdev", "version": "0.3",
+                   "location": "/some/source", "editable": True},
+    }
+    assert file_to_pkg == {
+        os.path.join(sp_path, "pkg_a", "__init__.py"): "pkg-a",
+        os.path.join(str(venv), "bin", "pkg-a"): "pkg-a",
+        os.path.join(sp_path, "pkg_b", "__init__.py"): "pkg_b",
+        os.path.join(sp_path, "__editable__.newdev-0.3.pth"): "newdev",
+    }
+
+    # only the requested packages, under the requested names
+    details, file_to_pkg = piputils.get_installed_package_details(
+        session, str(venv), ["pkg_a", "Dev"])
+    assert sorted(details) == ["Dev", "pkg_a"]
+    assert set(file_to_pkg.values()) == {"pkg_a"}
+
+    # pip should be used to also list global packages
+    venv.join("pyvenv.cfg").write("include-system-site-packages = true\n")
+    assert piputils.get_installed_package_details(session, str(venv)) is None
@@ -9,9 +9,10 @@
 import os
 
 import attr
+from mock import mock
 
 from niceman.cmd import Runner
-from niceman.distributions.vcs import VCSTracer
+from niceman.distributions.vcs import GitMetadata, VCSTracer
 from niceman.utils import chpwd
 from niceman.tests.utils import assert_is_subset_recur
 from niceman.tests.fixtures import git_repo_fixture
@@ -105,6 +106,43 @@ def test_git_repo(git_repo):
         assert not list(tracer.identify_distributions([subdir]))
 
 
+def test_git_repo_dirty(git_repo):
+    import hashlib
+    from mock import patch
+    from niceman import cfg
+    from niceman.distributions.vcs import parse_git_status
+    runner = Runner()
+    foo = os.path.join(git_repo, "foo")
+    with open(foo, "a") as f:
+        f.write("more")
+    runner(["git", "mv", "bar", "bar2"], cwd=git_repo)
+    untracked = os.path.join(git_repo, "subdir", "untracked")
+    with open(untracked, "w") as f:
+        f.write("untracked")
+    paths = [foo, os.path.join(git_repo, "bar2"),
+             os.path.join(git_repo, "subdir", "baz")]
+
+    tracer = VCSTracer()
+    with patch.object(cfg, "getboolean", return_value=True):
+        dists = list(tracer.identify_distributions(paths + [untracked]))
+    (dist, unknown_files), = dists
+    assert unknown_files == {untracked}
+    pkg, = dist.packages
+    assert pkg.files == paths
+    assert pkg.dirty_files == paths[:2]
+    assert pkg.untracked_files == [untracked]
+    with open(foo, "rb") as f:
+        foo_sha256 = hashlib.sha256(f.read()).hexdigest()
+    assert "%s  %s" % (foo_sha256, foo) in pkg.dirty_sha256sums
+    assert len(pkg.dirty_sha256sums) == 2
+
+    assert parse_git_status(
+        "1 .M N... 100644 100644 100644 1234 1234 a b\0"
+        "2 R. N... 100644 100644 100644 1234 1234 R100 new\0old\0"
+        "u UU N... 100644 100644 100644 100644 1 2 3 conflict\0"
+        "? untracked\0") == {"a b", "new", "old", "conflict"}
+
+
 def test_git_repo_detached(git_repo):
     runner = Runner()
     # If we are in a detached state, we still don't identify the
@@ -173,7 +211,11 @@ def test_git_repo_remotes(git_repo_pair):
     # If we set the pushurl and retrace, it is included.
     runner.run(["git", "config", "remote.origin.pushurl", repo_remote],
                cwd=repo_local)
-    dists_push = list(tracer.identify_distributions(paths))
+    with mock.patch.object(GitMetadata, "read",
+                           wraps=GitMetadata.read) as read:
+        dists_push = list(tracer.identify_distributions(paths))
+    # .git is read anew, but once
+    assert read.call_count == 1
     pkg_push = dists_push[0][0].packages[0]
     assert pkg_push.remotes["origin"]["pushurl"] == repo_remote
 
@@ -190,3 +232,238 @@ def test_git_repo_remotes(git_repo_pair):
     paths = [os.path.join(repo_remote, "foo")]
     dists_remote = list(tracer.identify_distributions(paths))
     assert not dists_remote[0][0].packages[0].remotes.values()
+
+
+def test_git_repo_worktree(git_repo, tmpdir):
+    from niceman.resource.session import get_local_session
+    runner = Runner()
+    worktree = str(tmpdir.join("worktree"))
+    runner(["git", "worktree", "add", "-b", "wt", worktree],
+           cwd=git_repo, expect_stderr=True)
+    runner(["git", "pack-refs", "--all"], cwd=git_repo)
+    hexsha, _ = runner(["git", "rev-parse", "HEAD"], cwd=worktree)
+
+    # .git of the worktree is a file pointing into .git of the repository
+    assert os.path.isfile(os.path.join(worktree, ".git"))
+    metadata = GitMetadata.read(get_local_session(), worktree)
+    assert metadata.hexsha == hexsha.strip()
+    assert metadata.branch == "wt"
+    # refs are shared, and (now) packed
+    assert metadata.has_tags
+    assert metadata.get_refs("refs/heads/") == {
+        "refs/heads/master": hexsha.strip(),
+        "refs/heads/wt": hexsha.strip()}
+
+    dists = list(VCSTracer().identify_distributions(
+        [os.path.join(worktree, "foo")]))
+    pkg = dists[0][0].packages[0]
+    assert pkg.path == worktree
+    assert pkg.branch == "wt"
+    assert pkg.hexsha == hexsha.strip()
+    assert pkg.describe.startswith("tag0")
+
+
+def test_parse_git_config():
+    from niceman.distributions.vcs import parse_git_config
+    config = parse_git_config("""\
+# comment
+[core]
+\tbare = false
+[remote "origin"]
+\turl = https://example.com/repo.git  ; comment
+\tfetch = +refs/heads/*:refs/remotes/origin/*
+[Branch "we\\"ird"]
+\tRemote = "or;igin"
+[old.style]
+\tflag
+\tlong = one \\
+two
+[core]
+\tbare = true
+""")
+    assert config == {
+        ("core", None, "bare"): ["false", "true"],
+        ("remote", "origin", "url"): ["https://example.com/repo.git"],
+        ("remote", "origin", "fetch"): ["+refs/heads/*:refs/remotes/origin/*"],
+        ("branch", 'we"ird', "remote"): ["or;igin"],
+        ("old", "style", "flag"): ["true"],
+        ("old", "style", "long"): ["one two"],
+    }
+    # we do not follow includes
+    assert parse_git_config("[include]\npath = other") is None
+
+
+def test_git_repo_sniffed_once(git_repo, tmpdir):
+    from mock import patch
+    from niceman.distributions.vcs import GitRepoShim, SVNRepoShim
+    # nested repository
+    runner = Runner()
+    nested = os.path.join(git_repo, "nested")
+    os.mkdir(nested)
+    with open(os.path.join(nested, "qux"), "w") as f:
+        f.write("qux")
+    runner(["git", "init"], cwd=nested)
+    runner(["git", "add", "qux"], cwd=nested)
+    runner(["git", "-c", "user.name=A U Thor",
+            "-c", "user.email=a.thor@example.com",
+            "commit", "-m", "nested"], cwd=nested)
+    nested_path = os.path.join(nested, "qux")
+    # untracked files, as well as files not under VCS at all
+    untracked = [os.path.join(git_repo, "subdir", "untracked%d" % i)
+                 for i in range(3)]
+    other = [str(tmpdir.join("other%d" % i)) for i in range(3)]
+    for path in untracked + other:
+        with open(path, "w") as f:
+            f.write("content")
+
+    tracer = VCSTracer()
+    with patch.object(GitRepoShim, "get_at_dirpath",
+                      wraps=GitRepoShim.get_at_dirpath) as git_probe, \
+            patch.object(SVNRepoShim, "get_at_dirpath",
+                         wraps=SVNRepoShim.get_at_dirpath) as svn_probe:
+        dists = list(tracer.identify_distributions(
+            [os.path.join(git_repo, "subdir", "baz"), nested_path]
+            + untracked + other))
+    (dist, unknown_files), = dists
+    assert unknown_files == set(untracked + other)
+    assert sorted((p.path, p.files) for p in dist.packages) == [
+        (git_repo, [os.path.join(git_repo, "subdir", "baz")]),
+        (nested, [nested_path])]
+    # every directory was probed only once, but those without VCS metadata
+    # above them at all
+    probed = [c[0][1] for c in git_probe.call_args_list]
+    assert sorted(probed) == [nested, os.path.join(git_repo, "subdir")]
+    assert len(svn_probe.call_args_list) == len(probed)
+
+
+def test_svn_working_copy(tmpdir):
+    import sqlite3
+    from mock import patch
+    from niceman.cmd import CommandError
+    from niceman.distributions.vcs import SVNRepoShim
+    from niceman.resource.session import get_local_session
+    # a minimal wc.db, so we do not need svn
+    root = str(tmpdir)
+    os.mkdir(os.path.join(root, ".svn"))
+    db = sqlite3.connect(os.path.join(root, ".svn", "wc.db"))
+    db.executescript("""
+        create table repository (id integer primary key, root text,
+                                 uuid text);
+        create table nodes (local_relpath text, op_depth integer,
+                            repos_path text, revision integer, kind text);
+        create view nodes_base as select * from nodes where op_depth = 0;
+        insert into repository values (1, 'https://example.com/svn', 'uuid');
+    """)
+    db.executemany(
+        "insert into nodes values (?, 0, ?, ?, ?)",
+        [("", "trunk", 3, "dir"),
+         ("a", "trunk/a", 3, "file"),
+         ("sub", "trunk/sub", 2, "dir"),
+         ("sub/b", "trunk/sub/b", 2, "file"),
+         ("sub/c d", "trunk/sub/c d", 2, "file"),
+         ("sub0", "trunk/sub0", 3, "file")])
+    db.commit()
+    db.close()
+    info = ("Path: .\n"
+            "Working Copy Root Path: %s\n"
+            "URL: https://example.com/svn/trunk\n"
+            "Relative URL: ^/trunk\n"
+            "Repository Root: https://example.com/svn\n"
+            "Repository UUID: uuid\n"
+            "Revision: 3\n" % root)
+
+    session = get_local_session()
+    execute_command = session.execute_command
+    svn_calls = []
+
+    def execute_svn(command, cwd=None, **kwargs):
+        if command != "svn info":
+            return execute_command(command, cwd=cwd, **kwargs)
+        svn_calls.append(cwd)
+        if cwd != root:
+            raise CommandError(command)
+        return info, ""
+
+    shared = {}
+    with patch.object(session, "execute_command", execute_svn):
+        shim = SVNRepoShim.get_at_dirpath(session, root, shared=shared)
+        # known to be versioned within the working copy already
+        subshim = SVNRepoShim.get_at_dirpath(
+            session, os.path.join(root, "sub"), shared=shared)
+        # not versioned, need to ask
+        assert SVNRepoShim.get_at_dirpath(
+            session, os.path.join(root, "other"), shared=shared) is None
+    assert svn_calls == [root, os.path.join(root, "other")]
+    assert subshim._working_copy is shim._working_copy
+
+    assert list(shim.all_files) == ["a", "sub", "sub/b", "sub/c d", "sub0"]
+    assert list(subshim.all_files) == ["b", "c d"]
+    assert subshim.owns_path(os.path.join(root, "sub", "c d"))
+    assert not subshim.owns_path(os.path.join(root, "sub0"))
+    assert (shim.url, shim.relative_url, shim.revision) == \
+        ("https://example.com/svn/trunk", "^/trunk", 3)
+    assert (subshim.url, subshim.relative_url, subshim.revision) == \
+        ("https://example.com/svn/trunk/sub", "^/trunk/sub", 2)
+    assert subshim.root_url == "https://example.com/svn"
+    assert subshim.uuid == "uuid"
+    # the database is opened in one thread, and queried from another
+    from threading import Thread
+    from niceman.distributions.vcs import SVNWorkingCopy
+    working_copy = SVNWorkingCopy(session, root, {
+        "Repository Root": "https://example.com/svn"})
+    results = []
+    thread = Thread(target=lambda: results.append(
+        working_copy.get_node("sub")))
+    thread.start()
+    thread.join()
+    assert results == [("trunk/sub", 2)]
+    assert list(working_copy.get_files("sub")) == ["b", "c d"]
+
+    # a directory without a node in wc.db (e.g. added, not committed)
+    added = SVNRepoShim(os.path.join(root, "added"), session,
+                        working_copy=shim._working_copy)
+    assert (added.url, added.relative_url, added.revision) == \
+        (None, None, None)
+
+    status = ("M       a\n"
+              " M      sub\n"
+              "A  +    sub/c d\n"
+              "        > moved from sub0\n"
+              "\n"
+              "Performing status on external item at 'ext':\n")
+    shared = {}
+    with patch.object(session, "execute_command",
+                      return_value=(status, "")) as execute:
+        assert shim.get_dirty_files(shared) == {"a", "sub", "sub/c d"}
+        assert subshim.get_dirty_files(shared) == {"c d"}
+    # status is queried once per working copy
+    assert execute.call_count == 1
+
+
+def test_file_index():
+    from niceman.distributions.vcs import FileIndex
+    paths = ["a", "b/c", "b/d/e", "bb", "c d", u"dé"]
+    index = FileIndex("".join(p + "\0" for p in paths))
+    assert len(index) == len(paths)
+    assert list(index) == paths
+    assert all(p in index for p in paths)
+    assert not any(p in index for p in ["", "b", "b/d", "0", "z", "b/c/"])
+    assert index.has_paths_under("b")
+    assert index.has_paths_under("b/")
+    assert index.has_paths_under("b/d")
+    assert not index.has_paths_under("b/c")
+    assert not index.has_paths_under("a")
+    assert not index.has_paths_under("z")
+    assert index.has_paths_under(".")
+
+    # not sorted, and without the trailing separator
+    index = FileIndex.from_paths(reversed(paths))
+    assert list(index) == paths
+    assert "b/d/e" in index
+    index = FileIndex("b\nc\n\na", sep="\n")
+    assert list(index) == ["a", "b", "c"]
+
+    empty = FileIndex("")
+    assert not len(empty)
+    assert "a" not in empty
+    assert not empty.has_paths_under(".")
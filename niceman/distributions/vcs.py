@@ -11,22 +11,34 @@
 from __future__ import unicode_literals
 
 import abc
+import array
 import attr
+import bisect
 import os
+import re
+import sqlite3
+import tempfile
+import threading
 
-from collections import defaultdict
-from os.path import dirname, isdir, isabs, abspath
-from os.path import exists, lexists
+from collections import defaultdict, OrderedDict
+from os.path import dirname, isabs, abspath
 from os.path import join as opj
 
 from logging import getLogger
 
+from six.moves.urllib.parse import quote as urlquote
+
+from niceman import cfg
 from niceman.dochelpers import exc_str
 from niceman.utils import attrib
+from niceman.utils import execute_command_batch
 from niceman.utils import only_with_values
+from niceman.utils import PathRoot
+from niceman.utils import PathTrie
 from niceman.utils import instantiate_attr_object
 
 from niceman.cmd import CommandError
+from niceman.support.profiler import profiled
 
 lgr = getLogger('niceman.distributions.vcs')
 
@@ -77,6 +89,13 @@ class VCSRepo(SpecObject):
 
     path = attrib(default=attr.NOTHING)
     files = attrib(default=attr.Factory(list))
+    # files (among the above) with uncommitted changes
+    dirty_files = attrib(default=attr.Factory(list))
+    # files within the repository but not under its control
+    untracked_files = attrib(default=attr.Factory(list))
+    # "<sha256>  <file>" (as output by sha256sum) for the dirty files, if
+    # [vcs] hash dirty files is enabled
+    dirty_sha256sums = attrib(default=attr.Factory(list))
 
 
 @attr.s
@@ -119,6 +138,75 @@ class SVNDistribution(VCSDistribution):
 SVNRepo._distribution = SVNDistribution
 
 
+class FileIndex(object):
+    """Compact index of the files of a repository
+
+    Instead of a set of strings, the paths are kept sorted in a single
+    string (e.g. as output by ``git ls-files -z``), split into blocks of
+    `block_size` paths.  Only the first path of every block is kept as a
+    separate string, so a lookup bisects those and then searches within a
+    single block.
+
+    Parameters
+    ----------
+    content : str
+      Paths, separated (or terminated) by `sep`
+    sep : str, optional
+    block_size : int, optional
+    """
+
+    def __init__(self, content, sep='\0', block_size=16):
+        paths = [p for p in content.split(sep) if p]
+        paths.sort()  # already sorted if listed by git
+        self._sep = sep
+        self._len = len(paths)
+        # every path is surrounded by separators
+        self._content = sep + ''.join(p + sep for p in paths)
+        # first path of every block, and the offset of the separator
+        # preceding it
+        self._block_paths = paths[::block_size]
+        del paths
+        # str() since array needs a native string as its typecode on
+        # Python 2
+        self._block_offsets = array.array(
+            str('I' if len(self._content) < 2 ** 32 else 'L'))
+        offset = 0
+        for path in self._block_paths:
+            offset = self._content.index(sep + path + sep, offset)
+            self._block_offsets.append(offset)
+        self._block_offsets.append(len(self._content) - 1)
+
+    @classmethod
+    def from_paths(cls, paths):
+        """Create an index from an iterable of paths"""
+        return cls('\0'.join(paths))
+
+    def _find(self, needle, path, nblocks=1):
+        """Find needle within the block(s) `path` would be in"""
+        idx = max(bisect.bisect_right(self._block_paths, path) - 1, 0)
+        end = min(idx + nblocks, len(self._block_offsets) - 1)
+        return self._content.find(needle, self._block_offsets[idx],
+                                  self._block_offsets[end] + 1) != -1
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return iter(self._content.split(self._sep)[1:-1])
+
+    def __contains__(self, path):
+        return bool(path) and \
+            self._find(self._sep + path + self._sep, path)
+
+    def has_paths_under(self, dirpath):
+        """Return whether there are paths under the (relative) directory"""
+        if dirpath in ('', os.curdir):
+            return bool(self._len)
+        prefix = dirpath.rstrip('/') + '/'
+        # the first path after the prefix might start the next block
+        return self._find(self._sep + prefix, prefix, nblocks=2)
+
+
 #
 # Tracer Shims
 # We use unified VCSTracer but it needs per-VCS specific handling/
@@ -127,7 +215,6 @@ SVNRepo._distribution = SVNDistribution
 # 
 class GitSVNRepoShim(object):
     _ls_files_command = None  # just need to define in subclass
-    _ls_files_filter = None
     
     _vcs_class = None  # associated VCS class
 
@@ -153,14 +240,17 @@ class GitSVNRepoShim(object):
 
     @property
     def all_files(self):
-        """Lazy evaluation for _all_files. If session changes, result would be old"""
+        """Lazy evaluation for _all_files. If session changes, result would be old
+
+        Returns
+        -------
+        FileIndex
+        """
         if self._all_files is None:
             out, err = self._session_execute_command(self._ls_files_command)
             assert not err
-            self._all_files = set(filter(None, out.split('\n')))
-            if self._ls_files_filter:
-                self._all_files = self._ls_files_filter(self._all_files)
-            self._all_files = set(self._all_files)  # for efficient lookups
+            # NUL-separated paths, as listed by 'git ls-files -z'
+            self._all_files = FileIndex(out)
         return self._all_files
 
     def owns_path(self, path):
@@ -180,10 +270,150 @@ class GitSVNRepoShim(object):
         return rpath in self.all_files
 
     @classmethod
-    def get_at_dirpath(cls, session, dirpath):
-        """Return VCS instance at the given path (if under that VCS control)"""
+    def get_at_dirpath(cls, session, dirpath, shared=None):
+        """Return VCS instance at the given path (if under that VCS control)
+
+        Parameters
+        ----------
+        session : Session
+        dirpath : str
+        shared : dict, optional
+          State shared by all the instances found by a tracer, e.g. to
+          reuse what several repositories have in common
+        """
         raise NotImplementedError
 
+    def reset_metadata(self):
+        """Forget the metadata read so far, so it is read anew if needed"""
+        pass
+
+    def get_dirty_files(self, shared):
+        """Return the paths (relative to the repository) with changes
+
+        Parameters
+        ----------
+        shared : dict
+          State shared by the calls for all the repositories within a
+          single pass, e.g. to query a status once for several of them
+        """
+        raise NotImplementedError
+
+
+def parse_svn_status(out):
+    """Return the paths changed according to 'svn status'"""
+    paths = set()
+    for line in out.splitlines():
+        # 7 status columns, then the path; other lines describe externals
+        # or moves
+        if line[7:8] != ' ' or len(line) < 9:
+            continue
+        # the item itself or its properties changed
+        if line[0] in 'ACDMR!~' or line[1] in 'CM':
+            paths.add(line[8:])
+    return paths
+
+
+def parse_svn_info(out):
+    """Parse the output of 'svn info' into a dict"""
+    return dict(
+        [x.lstrip() for x in l.split(':', 1)]
+        for l in out.splitlines() if l.strip()
+    )
+
+
+class SVNWorkingCopy(object):
+    """SVN working copy, shared by the shims of all the directories within
+
+    Its wc.db is fetched from the session once, and queried in process (by
+    any thread, since tracers might run in a pool).
+
+    Parameters
+    ----------
+    session : Session
+    root_path : str
+      Path to the top of the working copy (with the .svn directory)
+    info : dict
+      Parsed output of 'svn info' anywhere within the working copy
+    """
+
+    def __init__(self, session, root_path, info):
+        self._session = session
+        self.root_path = root_path
+        self.root_url = info['Repository Root']
+        self.uuid = info.get('Repository UUID')
+        self.__db = None
+        self._db_lock = threading.Lock()
+        self._files = {}
+
+    def _open_db(self):
+        fd, local_path = tempfile.mkstemp(prefix='niceman-wc-', suffix='.db')
+        os.close(fd)
+        try:
+            self._session.get(opj(self.root_path, '.svn', 'wc.db'),
+                              local_path)
+            # shared among threads, queried under the lock
+            db = sqlite3.connect(local_path, check_same_thread=False)
+            # read it before the copy is gone, we stay with the open file
+            db.execute('select count(*) from repository').fetchone()
+        finally:
+            os.unlink(local_path)
+        return db
+
+    def _query(self, query, params=()):
+        """Return all the rows the query selects from wc.db"""
+        with self._db_lock:
+            if self.__db is None:
+                self.__db = self._open_db()
+            return self.__db.execute(query, params).fetchall()
+
+    def get_node(self, relpath):
+        """Return (repos_path, revision) of the versioned directory or None
+
+        Parameters
+        ----------
+        relpath : str
+          Path relative to the root of the working copy
+        """
+        rows = self._query(
+            "select repos_path, revision from nodes_base "
+            "where local_relpath = ? and kind = 'dir'",
+            (self._local_relpath(relpath),))
+        return rows[0] if rows else None
+
+    def get_files(self, relpath):
+        """Return FileIndex of the paths versioned under the directory
+
+        Parameters
+        ----------
+        relpath : str
+          Path relative to the root of the working copy.  The paths are
+          relative to it as well
+        """
+        relpath = self._local_relpath(relpath)
+        if relpath not in self._files:
+            if relpath:
+                # all the paths starting with relpath/ (and '0' follows '/')
+                rows = self._query(
+                    "select substr(local_relpath, ?) from nodes_base "
+                    "where local_relpath > ? and local_relpath < ?",
+                    (len(relpath) + 2, relpath + '/', relpath + '0'))
+            else:
+                rows = self._query(
+                    "select local_relpath from nodes_base "
+                    "where local_relpath != ''")
+            self._files[relpath] = FileIndex.from_paths(r[0] for r in rows)
+        return self._files[relpath]
+
+    def get_dirty_files(self):
+        """Return the paths (relative to the root) with changes"""
+        out, _ = self._session.execute_command(['svn', 'status', '-q'],
+                                               cwd=self.root_path)
+        return parse_svn_status(out)
+
+    @staticmethod
+    def _local_relpath(relpath):
+        # the way wc.db refers to the root
+        return '' if relpath == os.curdir else relpath
 
 
 # Name must be   TYPERepo since used later in the code
@@ -192,110 +422,352 @@ class SVNRepoShim(GitSVNRepoShim):
     
     _vcs_class = SVNRepo
     _vcs_distribution_class = SVNDistribution
-    
+
+    def __init__(self, path, session, working_copy=None):
+        super(SVNRepoShim, self).__init__(path, session)
+        self._working_copy = working_copy
+        self.__node = False  # not read yet
+
     @property
-    def _ls_files_command(self):
-        # tricky -- we need to locate wc.db somewhere upstairs, and filter out paths
-        root_path = self._info['Working Copy Root Path']
-        return 'sqlite3 -batch %s/.svn/wc.db ".headers off" ' \
-            '"select local_relpath from nodes_base"' \
-                    % root_path
-
-    def _ls_files_filter(self, all_files):
-        root_path = self._info['Working Copy Root Path']
-        subdir = os.path.relpath(self.path, root_path)
-        if subdir == os.curdir:
-            return all_files
-        else:
-            return [f[len(subdir)+1:] for f in all_files
-                    if os.path.commonprefix((subdir, f)) == subdir]
+    def all_files(self):
+        if self._all_files is None:
+            self._all_files = self._working_copy.get_files(self._relpath)
+        return self._all_files
 
-    def __init__(self, *args, **kwargs):
-        super(SVNRepoShim, self).__init__(*args, **kwargs)
-        self.__info = None
+    @property
+    def _relpath(self):
+        return os.path.relpath(self.path, self._working_copy.root_path)
 
     @classmethod
-    def get_at_dirpath(cls, session, dirpath):
+    def get_at_dirpath(cls, session, dirpath, shared=None):
         # ho ho -- no longer the case that there is .svn in each subfolder:
         # http://stackoverflow.com/a/9070242
-        found = False
-        if exists(opj(dirpath, '.svn')):  # early detection
-            found = True
-        # but still might be under SVN
-        if not found:
-            try:
-                out, err = session.execute_command(
-                    'svn info',
-                    # expect_fail=True,
-                    cwd=dirpath
+        # so it is a directory versioned within any working copy known already
+        # (the most nested first) or we need to ask svn about it
+        working_copies = (shared if shared is not None else {}) \
+            .setdefault('svn working copies', PathTrie())
+        for working_copy, relpath in working_copies.find_all(dirpath):
+            if working_copy.get_node(relpath):
+                lgr.debug("Detected SVN repository at %s", dirpath)
+                return cls(dirpath, session=session,
+                           working_copy=working_copy)
+        try:
+            out, err = session.execute_command(
+                'svn info',
+                # expect_fail=True,
+                cwd=dirpath
+            )
+        except CommandError as exc:
+            if "Please see the 'svn upgrade' command" in str(exc):
+                # we are in SVN but it is outdated and needs an upgrade
+                lgr.warning(
+                    "SVN at %s is outdated, needs 'svn upgrade'",
+                    dirpath)
+            else:
+                lgr.debug(
+                    "Probably %s is not under SVN repo path: %s",
+                    dirpath, exc_str(exc)
                 )
-            except CommandError as exc:
-                if "Please see the 'svn upgrade' command" in str(exc):
-                    lgr.warning(
-                        "SVN at %s is outdated, needs 'svn upgrade'",
-                        dirpath)
-                else:
-                    # we are in SVN but it is outdated and needs an upgrade
-                    lgr.debug(
-                        "Probably %s is not under SVN repo path: %s",
-                        dirpath, exc_str(exc)
-                    )
-                    return None
+            return None
+        info = parse_svn_info(out)
         # for now we treat each directory under SVN independently
         # pros:
         #   - could provide us 'minimal' set of checkouts to do, since it might be
         #      quite expensive to checkout the entire tree if it was not used
         #      besides few leaves
         lgr.debug("Detected SVN repository at %s", dirpath)
-        return cls(dirpath, session=session)
+        root_path = info['Working Copy Root Path']
+        working_copy = SVNWorkingCopy(session, root_path, info)
+        working_copies.add(root_path, working_copy)
+        return cls(dirpath, session=session, working_copy=working_copy)
+
+    def get_dirty_files(self, shared):
+        key = ('svn dirty files', self._working_copy.root_path)
+        if key not in shared:
+            shared[key] = self._working_copy.get_dirty_files()
+        relpath = self._relpath
+        if relpath == os.curdir:
+            return shared[key]
+        return set(p[len(relpath) + 1:] for p in shared[key]
+                   if p.startswith(relpath + '/'))
 
     @property
-    def _info(self):
-        if self.__info is None:
-            # TODO -- outdated repos might need 'svn upgrade' first
-            # so not sure -- if we should copy them somewhere first and run
-            # update there or ask user to update them on his behalf?!
-            out, err = self._session.execute_command('svn info', cwd=self.path)
-            self.__info = dict(
-                [x.lstrip() for x in l.split(':', 1)]
-                for l in out.splitlines() if l.strip()
-            )
-        return self.__info
+    def _node(self):
+        if self.__node is False:
+            self.__node = self._working_copy.get_node(self._relpath)
+        return self.__node
 
     @property
     def revision(self):
-        r = self._info['Revision']
-        return int(r) if ((r is not None) and r.isdigit()) else r
+        # no node for directories not (yet) in the repository
+        return self._node[1] if self._node else None
 
     @property
     def url(self):
         # also has similarity to APT in that we could have the top of SVN repo
         # as an 'origin' which might be reused by multiple 'sub-repos'/directories
         # "Repository Root" and "Relative URL"
-        return self._info['URL']
+        if self._quoted_repos_path is None:
+            return None
+        return '/'.join(
+            filter(None, [self.root_url, self._quoted_repos_path]))
 
     @property
     def root_url(self):
-        return self._info['Repository Root']
+        return self._working_copy.root_url
 
     @property
     def relative_url(self):
-        return self._info['Relative URL']
+        if self._quoted_repos_path is None:
+            return None
+        return '^/' + self._quoted_repos_path
+
+    @property
+    def _quoted_repos_path(self):
+        if not self._node:
+            return None
+        # as svn escapes it in URLs
+        return urlquote(self._node[0], safe="/!$&'()*+,;=:@~")
 
     @property
     def uuid(self):
-        return self._info['Repository UUID']
+        return self._working_copy.uuid
+
+
+def parse_git_status(out):
+    """Return the paths changed according to 'git status --porcelain=v2 -z'
+
+    Renamed (or copied) paths are returned along with their originals.
+    """
+    paths = set()
+    entries = iter(out.split('\0'))
+    for entry in entries:
+        # changed, renamed/copied (followed by the original), unmerged
+        nfields = {'1': 9, '2': 10, 'u': 11}.get(entry[:1])
+        if not nfields:
+            continue
+        paths.add(entry.split(' ', nfields - 1)[-1])
+        if entry[0] == '2':
+            paths.add(next(entries, ''))
+    paths.discard('')
+    return paths
+
+
+def parse_git_config(content):
+    """Parse a git config file
+
+    Parameters
+    ----------
+    content : str
+
+    Returns
+    -------
+    dict or None
+      (section, subsection, key) -> list of values, with section and key
+      lower-cased (as they are case-insensitive) and subsection None for
+      variables outside of one.  None if the config includes other files.
+    """
+    config = OrderedDict()
+    section = subsection = None
+    # join continuation lines
+    content = re.sub(r'\\\r?\n', '', content)
+    for line in content.splitlines():
+        line = line.strip()
+        match = re.match(
+            r'\[\s*([-.\w]+)\s*(?:"((?:[^"\\]|\\.)*)")?\s*\](.*)$', line)
+        if match:
+            section, subsection, line = match.groups()
+            section = section.lower()
+            if subsection is not None:
+                subsection = re.sub(r'\\(.)', r'\1', subsection)
+            elif '.' in section:
+                # deprecated [section.subsection] syntax
+                section, subsection = section.split('.', 1)
+            if section in ('include', 'includeif'):
+                return None
+            line = line.strip()
+        if not line or line[0] in '#;' or section is None:
+            continue
+        key, sep, value = line.partition('=')
+        config.setdefault((section, subsection, key.strip().lower()), []) \
+            .append(_parse_git_config_value(value) if sep else 'true')
+    return config
+
+
+def _parse_git_config_value(value):
+    chars = []
+    quoted = False
+    escaped = False
+    for c in value:
+        if escaped:
+            chars.append({'n': '\n', 't': '\t', 'b': '\b'}.get(c, c))
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c == '"':
+            quoted = not quoted
+        elif c in '#;' and not quoted:
+            break
+        else:
+            chars.append(c)
+    return ''.join(chars).strip()
+
+
+# Marks the beginning of a file in the output of _GIT_METADATA_SCRIPT
+_FILE_MARKER = "==> niceman file: "
+
+# Dumps HEAD, config and refs of the git repository at $1, also if its .git
+# is a file pointing to the git directory (submodules and worktrees).  The
+# files are named relative to the git directory for HEAD, and to the common
+# directory of the worktrees for the rest.
+_GIT_METADATA_SCRIPT = """\
+dump() { [ -f "$2" ] && printf '\\n%s%s\\n' "$M" "$1" && cat "$2"; }
+M='""" + _FILE_MARKER + """'
+g="$1/.git"
+if [ -f "$g" ]; then
+    g="$(sed -n 's/^gitdir: *//p' "$g")"
+    case "$g" in /*) ;; *) g="$1/$g";; esac
+fi
+c="$g"
+if [ -f "$g/commondir" ]; then
+    c="$(cat "$g/commondir")"
+    case "$c" in /*) ;; *) c="$g/$c";; esac
+fi
+[ -f "$g/HEAD" ] || exit 1
+dump HEAD "$g/HEAD"
+dump config "$c/config"
+dump packed-refs "$c/packed-refs"
+find "$c/refs/heads" "$c/refs/remotes" "$c/refs/tags" -type f 2>/dev/null |
+while read -r f; do dump "${f#$c/}" "$f"; done
+true
+"""
+
+
+class GitMetadata(object):
+    """Metadata of a git repository, as read from the files of its .git
+
+    Parameters
+    ----------
+    head : str
+      Content of HEAD
+    refs : dict
+      Name -> content of the refs (a hexsha or "ref: <name>")
+    config : dict
+      As returned by `parse_git_config`
+    """
+
+    def __init__(self, head, refs, config):
+        self._head = head.strip()
+        self._refs = refs
+        self._config = config
+
+    @classmethod
+    def read(cls, session, path):
+        """Read the metadata of the repository at the path with one command
+
+        Returns
+        -------
+        GitMetadata or None
+          None if the metadata could not be read, or is not supported
+          (e.g. the config includes other files)
+        """
+        try:
+            out, _ = session.execute_command(
+                ["sh", "-c", _GIT_METADATA_SCRIPT, "sh", path])
+        except CommandError as exc:
+            lgr.debug("Could not read git metadata of %s: %s",
+                      path, exc_str(exc))
+            return None
+        files = {}
+        for entry in out.split("\n" + _FILE_MARKER)[1:]:
+            name, _, content = entry.partition("\n")
+            files[name] = content
+        config = parse_git_config(files.pop('config', ''))
+        if 'HEAD' not in files or config is None:
+            return None
+        head = files.pop('HEAD')
+        refs = {}
+        for line in files.pop('packed-refs', '').splitlines():
+            # skip comments and peeled tags
+            if line and line[0] not in '#^':
+                hexsha, _, name = line.partition(' ')
+                refs[name.strip()] = hexsha
+        # loose refs take precedence over the packed ones
+        refs.update((name, content.strip())
+                    for name, content in files.items())
+        return cls(head, refs, config)
+
+    def _resolve(self, ref_content):
+        # follow symbolic refs, but not forever
+        for _ in range(5):
+            if not ref_content or not ref_content.startswith('ref:'):
+                return ref_content or None
+            ref_content = self._refs.get(ref_content[4:].strip())
+        return None
+
+    @property
+    def hexsha(self):
+        return self._resolve(self._head)
+
+    @property
+    def branch(self):
+        if not self._head.startswith('ref:'):
+            return None  # detached
+        ref = self._head[4:].strip()
+        return ref[len('refs/heads/'):] if ref.startswith('refs/heads/') \
+            else ref[len('refs/'):]
+
+    @property
+    def has_tags(self):
+        return any(name.startswith('refs/tags/') for name in self._refs)
+
+    @property
+    def remotes(self):
+        remotes = []
+        for section, subsection, _ in self._config:
+            if section == 'remote' and subsection is not None \
+                    and subsection not in remotes:
+                remotes.append(subsection)
+        return remotes
+
+    def get_refs(self, prefix):
+        """Return name -> hexsha of the refs with the prefix"""
+        refs = {}
+        for name in self._refs:
+            if name.startswith(prefix):
+                hexsha = self._resolve(self._refs[name])
+                if hexsha:
+                    refs[name] = hexsha
+        return refs
+
+    def get_config(self, name):
+        """Return the (last) value of a config variable, as git config would
+
+        Parameters
+        ----------
+        name : str
+          Full name of the variable, e.g. remote.origin.url
+        """
+        section, rest = name.split('.', 1)
+        subsection, _, key = rest.rpartition('.')
+        values = self._config.get(
+            (section.lower(), subsection or None, key.lower()))
+        return values[-1] if values else None
 
 
 class GitRepoShim(GitSVNRepoShim):
 
-    _ls_files_command = 'git ls-files'
+    _ls_files_command = 'git ls-files -z'
 
     _vcs_class = GitRepo
     _vcs_distribution_class = GitDistribution
 
+    def __init__(self, path, session):
+        super(GitRepoShim, self).__init__(path, session)
+        self.__metadata = False  # not read yet
+
     @classmethod
-    def get_at_dirpath(cls, session, dirpath):
+    def get_at_dirpath(cls, session, dirpath, shared=None):
         try:
             out, err = session.execute_command(
                 'git rev-parse --show-toplevel',
@@ -328,8 +800,27 @@ class GitRepoShim(GitSVNRepoShim):
                 return None
         return out.strip()
 
+    @property
+    def _metadata(self):
+        """GitMetadata read from the files under .git, None if not supported
+
+        Lets us avoid running git for every single field we record
+        """
+        if self.__metadata is False:
+            self.__metadata = GitMetadata.read(self._session, self.path)
+        return self.__metadata
+
+    def reset_metadata(self):
+        self.__metadata = False
+
+    def get_dirty_files(self, shared):
+        return parse_git_status(self._run_git(
+            ['status', '--porcelain=v2', '-z', '--untracked-files=no']))
+
     @property
     def hexsha(self):
+        if self._metadata:
+            return self._metadata.hexsha
         try:
             return self._run_git('rev-parse HEAD')
         except CommandError:
@@ -339,11 +830,43 @@ class GitRepoShim(GitSVNRepoShim):
     @property
     def describe(self):
         """Let's use git describe"""
+        if self._metadata and not self._metadata.has_tags:
+            # nothing to describe with
+            return None
         try:
             return self._run_git('describe --tags', expect_fail=True)
         except CommandError:
             return None
 
+    def _get_config(self, name):
+        if self._metadata:
+            return self._metadata.get_config(name)
+        return self._run_git('config %s' % name, expect_fail=True) or None
+
+    def _get_remote_names(self):
+        if self._metadata:
+            return self._metadata.remotes
+        return self._run_git('remote').splitlines()
+
+    def _get_containing_remotes(self, hexsha):
+        """Return names of the remotes with branches containing the commit"""
+        if self._metadata:
+            remote_refs = self._metadata.get_refs('refs/remotes/')
+            # refs/remotes/<remote>/<name> => <remote>
+            containing_remotes = set(
+                ref.split('/', 3)[2] for ref, ref_hexsha in remote_refs.items()
+                if ref_hexsha == hexsha)
+            if all(ref.split('/', 3)[2] in containing_remotes
+                   for ref in remote_refs):
+                # nothing left to find out about
+                return containing_remotes
+        remote_branches = self._run_git(
+            ["for-each-ref", "--contains", hexsha,
+             # refs/remotes/<remote>/<name> => <remote>/<name>
+             "--format=%(refname:strip=2)",
+             "refs/remotes"]).splitlines()
+        return set(x.split('/', 1)[0] for x in remote_branches)
+
     @property
     def remotes(self):
         # ideally needs to figure out the remote(s) which already have
@@ -361,24 +884,15 @@ class GitRepoShim(GitSVNRepoShim):
         if not hexsha:  # just initialized
             return {}
 
-        remote_branches = self._run_git(
-            ["for-each-ref", "--contains", hexsha,
-             # refs/remotes/<remote>/<name> => <remote>/<name>
-             "--format=%(refname:strip=2)",
-             "refs/remotes"]).splitlines()
-
-        if not remote_branches:
+        containing_remotes = self._get_containing_remotes(hexsha)
+        if not containing_remotes:
             return {}
-        containing_remotes = set(x.split('/', 1)[0] for x in remote_branches)
         remotes = {}
-        for remote in self._run_git('remote').splitlines():
+        for remote in self._get_remote_names():
             rec = {}
             for f in 'url', 'pushurl':
                 try:
-                    v = self._run_git('config remote.%s.%s' % (remote, f)
-                                      , expect_fail=True
-                                      #, expect_stderr=True
-                                     )
+                    v = self._get_config('remote.%s.%s' % (remote, f))
                     if v is not None:
                         rec[f] = v
                 except CommandError:
@@ -394,15 +908,14 @@ class GitRepoShim(GitSVNRepoShim):
         branch = self.branch
         if not branch:
             return None
-        return self._run_git(
-                'config branch.%s.remote' % (branch,)
-                #, expect_stderr=True
-                , expect_fail=True
-        ) or None         # want explicit None
+        # want explicit None
+        return self._get_config('branch.%s.remote' % (branch,))
 
     @property
     def branch(self):
         if self._branch is None:
+            if self._metadata:
+                return self._metadata.branch
             try:
                 branch = self._run_git('symbolic-ref --short HEAD')
             except CommandError:
@@ -440,9 +953,35 @@ class VCSTracer(DistributionTracer):
         # dictionary to contain per each inspected/known directory a VCS
         # instance it belongs to
         self._known_repos = {}
+        # the same, indexed to find all the repositories above a path
+        self._repos_index = PathTrie()
+        # directory -> VCS instances detected at it (none for directories
+        # not under VCS), so we do not sniff around the same one twice
+        self._dirpath_repos = {}
+        # closest directory with VCS metadata above a directory, without
+        # which there is no need to sniff around
+        self._vcs_dir_root = PathRoot(self._has_vcs_dir, self._have_vcs_dir)
+        # state the shims share, e.g. SVN working copies
+        self._shims_shared = {}
+
+    # Directories with VCS metadata at the top of a repository (of any VCS)
+    _VCS_DIRS = ('.git', '.svn')
+
+    def _has_vcs_dir(self, path):
+        return any(self._session.exists(opj(path, d)) for d in self._VCS_DIRS)
+
+    def _have_vcs_dir(self, paths):
+        stats = self._session.stat_many(
+            [opj(path, d) for path in paths for d in self._VCS_DIRS])
+        return [path for path in paths
+                if any(stats.get(opj(path, d)) for d in self._VCS_DIRS)]
         
     def identify_distributions(self, files):
+        # the repositories might have changed since we have seen them last
+        for shim in self._known_repos.values():
+            shim.reset_metadata()
         repos, remaining_files = self.identify_packages_from_files(files)
+        self._record_files_state(repos, remaining_files)
         pkgs_per_distr = defaultdict(list)
         for repo in repos:
             pkgs_per_distr[repo._distribution].append(repo)
@@ -450,11 +989,100 @@ class VCSTracer(DistributionTracer):
             yield dist_class(name=dist_class._cmd,
                              packages=repos), remaining_files
 
+    @profiled
+    def _record_files_state(self, repos, unknown_files):
+        """Record dirty and untracked files on the repositories
+
+        Needs a single status command per repository (or SVN working
+        copy), and one more for all of them to hash the dirty files.
+        """
+        repos = dict((repo.path, repo) for repo in repos)
+        shared = {}
+        dirty_paths = {}
+        for repo in repos.values():
+            try:
+                dirty_files = self._known_repos[repo.path] \
+                    .get_dirty_files(shared)
+            except CommandError as exc:
+                lgr.warning("Could not find out which files of %s are "
+                            "dirty: %s", repo.path, exc_str(exc))
+                continue
+            for f in repo.files:
+                path = f if isabs(f) else abspath(f)
+                if path[len(repo.path) + 1:] in dirty_files:
+                    repo.dirty_files.append(f)
+                    dirty_paths[path] = (repo, f)
+
+        # files not known to any repository we had found anyways
+        for f in sorted(unknown_files):
+            path = f if isabs(f) else abspath(f)
+            shim, relpath = self._repos_index.find(path)
+            if shim and shim.path in repos and relpath != os.curdir:
+                repos[shim.path].untracked_files.append(f)
+
+        if dirty_paths and cfg.getboolean('vcs', 'hash dirty files',
+                                          default=False):
+            for path, sha256 in self._hash_files(dirty_paths).items():
+                repo, f = dirty_paths[path]
+                repo.dirty_sha256sums.append('%s  %s' % (sha256, f))
+
+    def _hash_files(self, paths):
+        """Return path -> sha256 of the files, hashed in parallel"""
+        jobs = cfg.get_as_dtype('vcs', 'hash jobs', int, default=4)
+        hashes = {}
+        # few files per sha256sum, so their outputs do not get interleaved
+        for out, _, exc in execute_command_batch(
+                self._session,
+                ['sh', '-c', 'printf "%%s\\0" "$@" | '
+                             'xargs -0 -n 8 -P %d sha256sum --' % jobs, 'sh'],
+                sorted(paths),
+                exception_filter=lambda exc: isinstance(exc, CommandError)):
+            if exc:
+                # some are not files (anymore), the rest is hashed anyways
+                lgr.debug("Failed to hash some files: %s", exc_str(exc))
+                out = exc.stdout or ''
+            for line in out.splitlines():
+                # escaped if the path is not a plain one, skip those
+                if line.startswith('\\'):
+                    continue
+                sha256, _, path = line.partition('  ')
+                if path in paths:
+                    hashes[path] = sha256
+        return hashes
+
+    @profiled
     def _get_packagefields_for_files(self, files):
         out = {}
+        # Find out which paths are directories (and which do not exist) in
+        # the session at once
+        paths = dict((f, f if isabs(f) else abspath(f)) for f in files)
+        stats = self._session.stat_many(set(paths.values()),
+                                        follow_symlinks=True)
+        dirpaths = {}
+        existing_dirpaths = set()
+        for path in set(paths.values()):
+            stat = stats.get(path)
+            dirpaths[path] = path if stat and stat.type == 'dir' \
+                else dirname(path)
+            if stat:
+                existing_dirpaths.add(dirpaths[path])
+        missing_dirpaths = set(dirpaths.values()) - existing_dirpaths
+        if missing_dirpaths:
+            existing_dirpaths.update(
+                p for p, stat in self._session.stat_many(
+                    missing_dirpaths).items() if stat)
+        # Directories with no VCS metadata above are not under VCS
+        for dirpath, vcs_dir_root in self._vcs_dir_root.find_many(
+                d for d in existing_dirpaths
+                if d not in self._dirpath_repos).items():
+            if not vcs_dir_root:
+                self._dirpath_repos[dirpath] = []
+
         for f in files:
             lgr.log(6, "%s testing file %s", self, f)
-            shim = self._resolve_file(f)
+            path = paths[f]
+            shim = self._resolve_file(path, dirpaths[path],
+                                      dirpaths[path] in existing_dirpaths)
             if not shim:
                 continue
             # we probably do not want all the attributes to just report which
@@ -472,55 +1100,65 @@ class VCSTracer(DistributionTracer):
         return out
 
     def _create_package(self, path):
-        # TODO:  we might want to mark those which are found to belong to pkg
-        #  files which are dirty.
         shim = self._known_repos[path]
         attrs = dict(
             (a.name, getattr(shim, a.name)) for a in shim._vcs_class.__attrs_attrs__
-            if a.name not in {'files'}  # those will be populated later
+            # those will be populated later
+            if a.name not in {'files', 'dirty_files', 'untracked_files',
+                              'dirty_sha256sums'}
         )
         attrs = only_with_values(attrs)
         return instantiate_attr_object(shim._vcs_class, attrs)
 
-    def _resolve_file(self, path):
-        """Given a path, return path of the repository it belongs to"""
-        # very naive just to get a ball rolling
-        if not isabs(path):
-            path = abspath(path)
-        dirpath = path if isdir(path) else dirname(path)
+    def _resolve_file(self, path, dirpath, dirpath_exists=True):
+        """Given a path, return the repository it belongs to
 
+        Parameters
+        ----------
+        path : str
+          Absolute path
+        dirpath : str
+          The path itself if it is a directory, or its parent directory
+        dirpath_exists : bool, optional
+        """
         # quick check first
         if dirpath in self._known_repos:
             return self._known_repos[dirpath]
 
-        # it could still be a subdirectory known to the repository known above it
-        for repo in self._known_repos.values():
-            # XXX this design is nohow accounts for some fancy cases where
-            # someone could use GIT_TREE and other trickery to have out of the
-            # directory checkout.  May be some time we would get there but
-            # for now
-            # should be ok
-
-            # could be less efficient than some str manipulations but ok for now
-            if os.path.commonprefix((repo.path, path)) != repo.path:
-                continue
-
-            # could be less efficient than some str manipulations but ok for now
-            # since we rely on a strict check (must be registered within the repo)
+        # it could still be a subdirectory known to the repository known above
+        # it.  XXX this design is nohow accounts for some fancy cases where
+        # someone could use GIT_TREE and other trickery to have out of the
+        # directory checkout.  May be some time we would get there but
+        # for now should be ok
+        for repo, _ in self._repos_index.find_all(path):
+            # since we rely on a strict check (must be registered within the
+            # repo)
             if repo.owns_path(path):
                 return repo
 
         # ok -- if it is not among known repos, we need to 'sniff' around
-        # if there is a repository at that path
+        # if there is a repository at that path, unless we did already
+        if dirpath not in self._dirpath_repos:
+            self._dirpath_repos[dirpath] = \
+                self._sniff_repos(dirpath) if dirpath_exists else []
+        for shim in self._dirpath_repos[dirpath]:
+            # there is one nearby but it might still not know about the file
+            if shim.owns_path(path):
+                return shim
+            # if not -- just keep going to the next candidate repository
+        return None
+
+    def _sniff_repos(self, dirpath):
+        """Return the repositories (of any VCS) at the directory"""
+        shims = []
         for Shim in self.SHIMS:
-            lgr.log(5, "Trying %s for path %s", Shim, path)
-            shim = Shim.get_at_dirpath(self._session, dirpath) \
-                if lexists(dirpath) else None
+            lgr.log(5, "Trying %s for path %s", Shim, dirpath)
+            shim = Shim.get_at_dirpath(self._session, dirpath,
+                                       shared=self._shims_shared)
             if shim:
-                # so there is one nearby -- record it
-                self._known_repos[shim.path] = shim
-                # but it might still not to know about the file
-                if shim.owns_path(path):
-                    return shim
-                # if not -- just keep going to the next candidate repository
-        return None
+                # so there is one nearby -- record it, unless known already
+                # (along with its files)
+                shim = self._known_repos.setdefault(shim.path, shim)
+                self._repos_index.add(shim.path, shim)
+                shims.append(shim)
+        return shims
@@ -9,7 +9,6 @@
 """Support for Python's virtualenv."""
 from collections import defaultdict
 import logging
-import os
 import os.path as op
 
 import attr
@@ -18,7 +17,10 @@ from six import iteritems
 from niceman.distributions import Distribution
 from niceman.distributions import piputils
 from niceman.dochelpers import exc_str
-from niceman.utils import attrib, PathRoot, is_subpath
+from niceman.support.exceptions import CommandError
+from niceman.support.profiler import profiled
+from niceman.utils import attrib, execute_command_batch, PathRoot, PathTrie, \
+    is_subpath
 
 from .base import DistributionTracer
 from .base import Package
@@ -65,7 +67,8 @@ class VenvTracer(DistributionTracer):
     """
 
     def _init(self):
-        self._path_root = PathRoot(self._is_venv_directory)
+        self._path_root = PathRoot(self._is_venv_directory,
+                                   self._are_venv_directories)
 
     def _get_packagefields_for_files(self, files):
         raise NotImplementedError
@@ -73,7 +76,19 @@ class VenvTracer(DistributionTracer):
     def _create_package(self, **package_fields):
         raise NotImplementedError
 
+    @profiled
     def _get_package_details(self, venv_path):
+        """Return details of the packages, file to package map and local packages
+
+        Package metadata are read directly from the virtualenv, unless it has
+        access to global site-packages, so pip is used to list all of those.
+        """
+        details = piputils.get_installed_package_details(self._session,
+                                                         venv_path)
+        if details is not None:
+            packages, file_to_pkg = details
+            return packages, file_to_pkg, set(packages)
+
         pip = venv_path + "/bin/pip"
         try:
             packages, file_to_pkg = piputils.get_package_details(
@@ -81,8 +96,10 @@ class VenvTracer(DistributionTracer):
         except Exception as exc:
             lgr.warning("Could not determine pip package details for %s: %s",
                         venv_path, exc_str(exc))
-            return {}, {}
-        return packages, file_to_pkg
+            return {}, {}, set()
+        local_pkgs = set(piputils.get_pip_packages(self._session, pip,
+                                                   local_only=True))
+        return packages, file_to_pkg, local_pkgs
 
     def _is_venv_directory(self, path):
         try:
@@ -94,6 +111,18 @@ class VenvTracer(DistributionTracer):
             return False
         return True
 
+    def _are_venv_directories(self, paths):
+        activate_files = []
+        for out, _, exc in execute_command_batch(
+                self._session, ["grep", "-l", "-s", "VIRTUAL_ENV"],
+                ["{}/bin/activate".format(path) for path in paths],
+                lambda exc: isinstance(exc, CommandError)):
+            if exc:
+                # grep fails if any of the files is missing or none matched
+                out = exc.stdout or ""
+            activate_files.extend(out.splitlines())
+        return [f[:-len("/bin/activate")] for f in activate_files]
+
     def _get_venv_path(self, path):
         return self._path_root(path)
 
@@ -102,35 +131,47 @@ class VenvTracer(DistributionTracer):
         found_package_count = 0
         total_file_count = len(unknown_files)
 
-        venv_paths = map(self._get_venv_path, files)
-        venv_paths = set(filter(None, venv_paths))
+        venv_paths = self._path_root.find_many(files).values()
+        venv_paths = sorted(set(filter(None, venv_paths)))
 
-        venvs = []
+        # Index all the venvs first, so the files are bucketed by venv (and
+        # relative paths computed) in a single pass over them.
+        venv_index = PathTrie()
+        venv_details = []
+        file_to_venv_pkg = {}
         for venv_path in venv_paths:
-            package_details, file_to_pkg = self._get_package_details(venv_path)
-            local_pkgs = set(piputils.get_pip_packages(self._session,
-                                                       venv_path + "/bin/pip",
-                                                       local_only=True))
-            pkg_to_found_files = defaultdict(list)
-            for path in set(unknown_files):  # Clone the set
-                # The supplied path may be relative or absolute, but
-                # file_to_pkg keys are absolute paths.
-                fullpath = os.path.abspath(path)
-                if fullpath in file_to_pkg:
-                    unknown_files.remove(path)
-                    pkg_to_found_files[file_to_pkg[fullpath]].append(
-                        os.path.relpath(path, venv_path))
-
-            # Some files, like venvs/dev/lib/python2.7/abc.py could be
-            # symlinks populated by virtualenv itself during venv creation
-            # since it relies on system wide python environment.  So we need
-            # to resolve those into filenames which could be associated with
-            # system wide installation of python
-            for path in unknown_files.copy():
-                if is_subpath(path, venv_path) and op.islink(path):
-                    unknown_files.add(op.realpath(path))
-                    unknown_files.remove(path)
+            package_details, file_to_pkg, local_pkgs = \
+                self._get_package_details(venv_path)
+            venv_details.append((venv_path, package_details, local_pkgs))
+            # The supplied paths may be relative or absolute, but
+            # file_to_pkg keys are absolute paths.
+            venv_index.add(op.abspath(venv_path), venv_path)
+            for fullpath, pkg in iteritems(file_to_pkg):
+                file_to_venv_pkg.setdefault(fullpath, (venv_path, pkg))
+
+        pkg_to_found_files = defaultdict(list)
+        for path in list(unknown_files):
+            fullpath = op.abspath(path)
+            venv_path, relpath = venv_index.find(fullpath)
+            if fullpath in file_to_venv_pkg:
+                pkg_venv_path, pkg = file_to_venv_pkg[fullpath]
+                if pkg_venv_path != venv_path:
+                    # e.g. a file of a package installed outside of the venv
+                    relpath = op.relpath(path, pkg_venv_path)
+                unknown_files.remove(path)
+                pkg_to_found_files[pkg_venv_path, pkg].append(relpath)
+            elif venv_path and op.islink(path):
+                # Some files, like venvs/dev/lib/python2.7/abc.py could be
+                # symlinks populated by virtualenv itself during venv
+                # creation since it relies on system wide python
+                # environment.  So we need to resolve those into filenames
+                # which could be associated with system wide installation
+                # of python
+                unknown_files.add(op.realpath(path))
+                unknown_files.remove(path)
 
+        venvs = []
+        for venv_path, package_details, local_pkgs in venv_details:
             packages = []
             for name, details in iteritems(package_details):
                 location = details["location"]
@@ -140,7 +181,7 @@ class VenvTracer(DistributionTracer):
                                 local=name in local_pkgs,
                                 location=location,
                                 editable=details["editable"],
-                                files=pkg_to_found_files[name]))
+                                files=pkg_to_found_files[venv_path, name]))
                 if location and not is_subpath(location, venv_path):
                     unknown_files.add(location)
 
@@ -84,3 +84,48 @@ class ReprozipProvenance(Provenance):
             files.update(src_yaml["other_files"])
 
         return files
+
+    @staticmethod
+    def iter_files(source, limit='all'):
+        """Yield the system files from a ReproZip configuration file
+
+        Unlike `get_files`, the configuration is not loaded at once but
+        parsed as a stream of YAML events, so memory use does not depend on
+        the size of the trace.  Files might be yielded multiple times.
+
+        Parameters
+        ----------
+        source : str
+            Path to the ReproZip configuration file
+        limit : {'all', 'packaged', 'loose'}, optional
+            Which files to yield, as in `get_files`
+        """
+        targets = set()
+        if limit in {'all', 'packaged'}:
+            targets.add(('packages', None, 'files', None))
+        if limit in {'all', 'loose'}:
+            targets.add(('other_files', None))
+
+        # for each collection we are in: [is_mapping, current key]. Key is
+        # None while the next scalar within a mapping is a key
+        stack = []
+
+        def value_done():
+            if stack and stack[-1][0]:
+                stack[-1][1] = None
+
+        with io.open(source, encoding='utf-8') as stream:
+            for event in yaml.parse(stream, Loader=yaml.SafeLoader):
+                if isinstance(event, yaml.CollectionStartEvent):
+                    stack.append(
+                        [isinstance(event, yaml.MappingStartEvent), None])
+                elif isinstance(event, yaml.CollectionEndEvent):
+                    stack.pop()
+                    value_done()
+                elif isinstance(event, yaml.ScalarEvent):
+                    if stack and stack[-1][0] and stack[-1][1] is None:
+                        stack[-1][1] = event.value
+                        continue
+                    if tuple(e[1] for e in stack) in targets:
+                        yield event.value
+                    value_done()
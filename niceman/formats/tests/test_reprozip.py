@@ -19,3 +19,11 @@ def test_load_config():
     assert len(files_noother) < len(files_all)
     # TODO: more testing
 
+
+
+def test_iter_files():
+    config = ReprozipProvenance(REPROZIP_SPEC2_YML_FILENAME)
+    for limit in 'all', 'packaged', 'loose':
+        files = list(
+            ReprozipProvenance.iter_files(REPROZIP_SPEC2_YML_FILENAME, limit))
+        assert set(files) == config.get_files(limit=limit)
@@ -11,16 +11,26 @@
 
 from __future__ import unicode_literals
 
+from itertools import chain
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from os.path import normpath
+import json
 import sys
 import time
 
+from six.moves import map
+
+from niceman import cfg
+from niceman.distributions.base import merge_spec_objects
 from niceman.resource.session import get_local_session
 from .base import Interface
+from ..support.constraints import EnsureInt
 from ..support.constraints import EnsureNone
 from ..support.constraints import EnsureStr
 from ..support.exceptions import InsufficientArgumentsError
 from ..support.param import Parameter
+from ..support.profiler import profiler
 from ..utils import assure_list
 from ..utils import to_unicode
 
@@ -61,12 +71,45 @@ class Retrace(Interface):
             metavar='output_file',
             constraints=EnsureStr() | EnsureNone(),
         ),
+        jobs=Parameter(
+            args=("-J", "--jobs",),
+            doc="""number of tracers to run concurrently.  If not specified,
+            taken from the 'jobs' option of the [retrace] configuration
+            section, and tracers are run one after another by default""",
+            metavar='NJOBS',
+            constraints=EnsureInt() | EnsureNone(),
+        ),
+        chunk_size=Parameter(
+            args=("--chunk-size",),
+            doc="""trace files in chunks of (up to) this many files, merging the
+            identified distributions.  The spec file is then read as a stream
+            instead of being loaded at once, so memory use is bounded for
+            very large traces""",
+            metavar='NFILES',
+            constraints=EnsureInt() | EnsureNone(),
+        ),
+        profile=Parameter(
+            args=("--profile",),
+            doc="""file to write a JSON report on the time spent by the tracers
+            and within the commands they ran.  A summary table is printed to
+            stderr""",
+            metavar='PROFILE_FILE',
+            constraints=EnsureStr() | EnsureNone(),
+        ),
+        no_cache=Parameter(
+            args=("--no-cache",),
+            action="store_true",
+            doc="""do not use (nor store) the results of previous runs cached
+            for the environments which did not change (e.g. conda
+            environments)""",
+        ),
     )
 
     # TODO: add a session/resource so we could trace within
     # arbitrary sessions
     @staticmethod
-    def __call__(path=None, spec=None, output_file=None):
+    def __call__(path=None, spec=None, output_file=None, jobs=None,
+                 chunk_size=None, profile=None, no_cache=False):
         # heavy import -- should be delayed until actually used
 
         if not (spec or path):
@@ -74,18 +117,41 @@ class Retrace(Interface):
                 "Need at least a single --spec or a file"
             )
 
+        if not profile:
+            return Retrace._retrace(path, spec, output_file, jobs, chunk_size,
+                                    no_cache)
+
+        profiler.reset()
+        profiler.enabled = True
+        try:
+            with profiler.phase('retrace'):
+                Retrace._retrace(path, spec, output_file, jobs, chunk_size,
+                                 no_cache)
+        finally:
+            profiler.enabled = False
+            with open(profile, 'w') as f:
+                json.dump(profiler.get_report(), f, indent=2)
+            sys.stderr.write(profiler.format_report())
+
+    @staticmethod
+    def _retrace(path, spec, output_file, jobs, chunk_size, no_cache):
         paths = assure_list(path)
         if spec:
             lgr.info("reading spec file %s", spec)
             # TODO: generic loader to auto-detect formats etc
             from niceman.formats.reprozip import ReprozipProvenance
-            spec = ReprozipProvenance(spec)
-            paths += spec.get_files() or []
+            if chunk_size:
+                paths = chain(paths, ReprozipProvenance.iter_files(spec))
+            else:
+                spec = ReprozipProvenance(spec)
+                paths += spec.get_files() or []
 
         # Convert paths to unicode
         paths = map(to_unicode, paths)
         # The tracers assume normalized paths.
-        paths = list(map(normpath, paths))
+        paths = map(normpath, paths)
+        if not chunk_size:
+            paths = list(paths)
 
         session = get_local_session()
 
@@ -95,7 +161,10 @@ class Retrace(Interface):
         # If we are to reuse their layout largely -- the rest should stay as is
         (distributions, files) = identify_distributions(
             paths,
-            session=session
+            session=session,
+            jobs=jobs,
+            chunk_size=chunk_size,
+            cache=not no_cache
         )
         from niceman.distributions.base import EnvironmentSpec
         spec = EnvironmentSpec(
@@ -115,13 +184,31 @@ class Retrace(Interface):
 # TODO: session should be with a state.  Idea is that if we want
 #  to trace while inheriting all custom PATHs which that run might have
 #  had
-def identify_distributions(files, session=None, tracer_classes=None):
+def identify_distributions(files, session=None, tracer_classes=None,
+                           jobs=None, chunk_size=None, cache=True):
     """Identify packages files belong to
 
+    Files are offered to every tracer only once.  Tracers might introduce
+    new files (e.g. resolved symlinks), which are then offered to all the
+    tracers in the next round, until no tracer has new files to consider.
+
     Parameters
     ----------
     files : iterable
       Files to consider
+    jobs : int, optional
+      Number of tracers to run concurrently.  If more than 1, all tracers
+      consider the same files at once, and files claimed by multiple tracers
+      are assigned to the one coming first in `tracer_classes`.  If None,
+      the 'jobs' option of the [retrace] configuration section (1 by default)
+      is used
+    chunk_size : int, optional
+      Trace files in chunks of (up to) this many files, so `files` could be
+      a (lazy) iterator over a very large number of files.  Distributions
+      identified in different chunks are merged
+    cache : bool, optional
+      Either tracers could use (and store) the results cached by previous
+      runs, e.g. for environments which did not change
 
     Returns
     -------
@@ -132,81 +219,223 @@ def identify_distributions(files, session=None, tracer_classes=None):
     if tracer_classes is None:
         tracer_classes = get_tracer_classes()
 
+    if jobs is None:
+        jobs = cfg.get_as_dtype('retrace', 'jobs', int, default=1)
+
     session = session or get_local_session()
     # TODO create list of appropriate for the `environment` OS tracers
     #      in case of no environment -- get current one
     # TODO: should operate in the session, might be given additional information
     #       not just files
 
+    # Tracers keep their state (e.g. caches) across the rounds and chunks
+    tracer_kwargs = {} if cache else {'cache': False}
+    tracers = [Tracer(session=session, **tracer_kwargs)
+               for Tracer in tracer_classes]
+    distibutions = []
+    unknown_files = set()
+
+    pool = ThreadPool(min(jobs, len(tracers))) if jobs > 1 else None
+    try:
+        if not chunk_size:
+            return _identify_distributions(set(files), tracers, session, pool)
+        for ichunk, chunk in enumerate(_iter_chunks(files, chunk_size)):
+            lgr.info("Tracing chunk #%d of %d files", ichunk + 1, len(chunk))
+            envs, files_to_consider = _identify_distributions(
+                chunk, tracers, session, pool)
+            # merge as we go to not accumulate duplicates across chunks
+            distibutions = merge_spec_objects(distibutions + envs)
+            unknown_files |= files_to_consider
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return distibutions, unknown_files
+
+
+def _iter_chunks(files, chunk_size):
+    """Yield sets of (up to) chunk_size unique files"""
+    files = iter(files)
+    while True:
+        chunk = set(islice(files, chunk_size))
+        if not chunk:
+            return
+        # fill up the chunk if there were duplicates
+        while len(chunk) < chunk_size:
+            more = set(islice(files, chunk_size - len(chunk)))
+            if not more:
+                break
+            chunk |= more
+        yield chunk
+
 
-    # .identify_ functions will have a side-effect of shrinking this list in-place
-    # as they identify files beloning to them
-    files_to_consider = set(files)
+def _identify_distributions(files_to_consider, tracers, session, pool):
+    """Run the tracers over the files until no tracer has new files
 
+    Returns
+    -------
+    distributions : list of Distribution
+    unknown_files : set
+    """
+    worklist = _TracersWorklist(tracers, session)
     distibutions = []
-    files_processed = set()
-    files_to_trace = files_to_consider
 
     niter = 0
     max_niter = 10
     while True:
         niter += 1
-        nfiles_processed = len(files_processed)
-        nfiles_to_trace = len(files_to_trace)
-        lgr.info("Entering iteration #%d over Tracers", niter)
         if niter > max_niter:
             lgr.error(
                 "We did %s iterations already, something is not right"
                 % max_niter)
             break
 
-        for Tracer in tracer_classes:
-            lgr.debug("Tracing using %s", Tracer.__name__)
-            # TODO: memoize across all loops
-            # Identify directories from the files_to_consider
-            dirs = set(filter(session.isdir, files_to_trace))
-
-            # Pull out directories if the tracer can't handle them
-            if Tracer.HANDLES_DIRS:
-                files_to_trace = files_to_consider
-                files_skipped = set()
-            else:
-                files_to_trace = files_to_consider - dirs
-                files_skipped = files_to_consider - files_to_trace
-
-            tracer = Tracer(session=session)
-            begin = time.time()
-            # yoh things the idea was that tracer might trace even without
-            #     files, so we should not just 'continue' the loop if there is no
-            #     files_to_trace
-            if files_to_trace:
-                remaining_files_to_trace = files_to_trace
-                nenvs = 0
-                for env, remaining_files_to_trace in tracer.identify_distributions(
-                        files_to_trace):
-                    distibutions.append(env)
-                    nenvs += 1
-                files_processed |= files_to_trace - remaining_files_to_trace
-                files_to_trace = remaining_files_to_trace
-                lgr.info("%s: %d envs with %d other files remaining",
-                         Tracer.__name__,
-                         nenvs,
-                         len(files_to_trace))
-
-            # Re-combine any files that were skipped
-            files_to_consider = files_to_trace | files_skipped
-
-            lgr.debug("Assigning files to packages by %s took %f seconds",
-                      tracer, time.time() - begin)
-        if len(files_to_trace) == 0 or (
-            nfiles_processed == len(files_processed) and
-            nfiles_to_trace == len(files_to_trace)):
+        if not any(worklist.get_files_to_trace(tracer, files_to_consider)
+                   for tracer in tracers):
             lgr.info("No more changes or files to track.  Exiting the loop")
             break
 
+        lgr.info("Entering iteration #%d over Tracers", niter)
+        if pool:
+            envs, files_to_consider = worklist.trace_concurrently(
+                pool, files_to_consider)
+        else:
+            envs, files_to_consider = worklist.trace(files_to_consider)
+        distibutions.extend(envs)
+
     return distibutions, files_to_consider
 
 
+class _TracersWorklist(object):
+    """Keeps track of the files already offered to each tracer"""
+
+    def __init__(self, tracers, session):
+        self._session = session
+        self._offered = dict((id(t), set()) for t in tracers)
+        self._tracers = tracers
+        # information about paths within the session, shared across rounds
+        self._path_stats = {}
+
+    def get_files_to_trace(self, tracer, files):
+        """Return files the tracer was not offered yet"""
+        files = files - self._offered[id(tracer)]
+        if files and not tracer.HANDLES_DIRS:
+            dirs = _get_dirs(self._session, files, self._path_stats)
+            # the tracer has no use for them
+            self._offered[id(tracer)] |= dirs
+            files = files - dirs
+        return files
+
+    def _run_tracer(self, tracer, files_to_trace):
+        """Offer files to the tracer
+
+        Returns
+        -------
+        envs : list of Distribution
+        remaining_files_to_trace : set
+          Files not claimed by the tracer, possibly with new files introduced
+          by the tracer
+        """
+        self._offered[id(tracer)] |= files_to_trace
+        name = tracer.__class__.__name__
+        lgr.debug("Tracing using %s", name)
+        begin = time.time()
+        envs = []
+        remaining_files_to_trace = files_to_trace
+        if files_to_trace:
+            with profiler.phase(name):
+                for env, remaining_files_to_trace in \
+                        tracer.identify_distributions(files_to_trace):
+                    envs.append(env)
+            lgr.info("%s: %d envs with %d other files remaining",
+                     name,
+                     len(envs),
+                     len(remaining_files_to_trace))
+        lgr.debug("Assigning files to packages by %s took %f seconds",
+                  tracer, time.time() - begin)
+        return envs, remaining_files_to_trace
+
+    def trace(self, files_to_consider):
+        """Offer new files to the tracers one after another
+
+        Returns
+        -------
+        envs : list of Distribution
+        files_to_consider : set
+          Files not claimed by any tracer
+        """
+        all_envs = []
+        for tracer in self._tracers:
+            files_to_trace = self.get_files_to_trace(tracer, files_to_consider)
+            if not files_to_trace:
+                continue
+            envs, remaining_files_to_trace = self._run_tracer(
+                tracer, files_to_trace)
+            all_envs.extend(envs)
+            files_to_consider = \
+                (files_to_consider - files_to_trace) | remaining_files_to_trace
+        return all_envs, files_to_consider
+
+    def trace_concurrently(self, pool, files_to_consider):
+        """Offer new files to all the tracers at once within the pool
+
+        Conflicts are resolved in the order of the tracers: if a tracer
+        claimed files already claimed by a preceding one, it is rerun over the
+        files left unclaimed.
+
+        Returns
+        -------
+        envs : list of Distribution
+          In the order of the tracers
+        files_to_consider : set
+          Files not claimed by any tracer
+        """
+        files_to_trace = [self.get_files_to_trace(t, files_to_consider)
+                          for t in self._tracers]
+        # map() preserves the order, so the results are deterministic
+        results = pool.map(
+            lambda args: self._run_tracer(*args),
+            zip(self._tracers, files_to_trace))
+
+        all_envs = []
+        files_claimed = set()
+        files_introduced = set()
+        for tracer, tracer_files, (envs, remaining) in zip(
+                self._tracers, files_to_trace, results):
+            claimed = tracer_files - remaining
+            if claimed & files_claimed:
+                lgr.debug("%s claimed files already claimed by other tracers, "
+                          "rerunning it on the remaining files",
+                          tracer.__class__.__name__)
+                tracer_files = tracer_files - files_claimed
+                envs, remaining = self._run_tracer(tracer, tracer_files)
+                claimed = tracer_files - remaining
+            all_envs.extend(envs)
+            files_claimed |= claimed
+            files_introduced |= remaining - tracer_files
+        files_to_consider = \
+            (files_to_consider - files_claimed) | files_introduced
+        return all_envs, files_to_consider
+
+
+def _get_dirs(session, paths, path_stats):
+    """Return the subset of paths which are directories within the session
+
+    Paths are stat'ed in bulk, and only those not yet known in `path_stats`
+    (which gets updated in-place).
+    """
+    missing = [p for p in paths if p not in path_stats]
+    if missing:
+        path_stats.update(session.stat_many(missing, follow_symlinks=True))
+    dirs = set()
+    for p in paths:
+        st = path_stats.get(p)
+        if st is not None and st.type == 'dir':
+            dirs.add(p)
+    return dirs
+
+
 def get_tracer_classes():
     """A helper which returns a list of all available Tracers
 
@@ -10,7 +10,9 @@
 from niceman.cmdline.main import main
 from niceman.formats import Provenance
 
+import json
 import logging
+from itertools import islice
 
 from niceman.utils import swallow_logs, swallow_outputs, make_tempfile
 from niceman.tests.utils import assert_in, skip_if_no_apt_cache
@@ -42,6 +44,92 @@ def test_retrace_to_output_file(reprozip_spec2):
         assert len(provenance.get_distributions()) == 1
 
 
+def test_retrace_in_chunks(reprozip_spec2):
+    provenances = []
+    for chunk_args in [], ['--chunk-size', '3']:
+        with make_tempfile() as outfile:
+            main(['retrace', '--spec', reprozip_spec2,
+                  '--output-file', outfile] + chunk_args)
+            provenances.append(Provenance.factory(outfile))
+    full, chunked = provenances
+    assert chunked.get_files() == full.get_files()
+
+    def get_packages(provenance):
+        return {
+            (d.name, p.name, tuple(sorted(p.files)))
+            for d in provenance.get_distributions()
+            for p in getattr(d, 'packages', [])
+        }
+    assert get_packages(chunked) == get_packages(full)
+
+
+def test_retrace_in_chunks_lazily(reprozip_spec2):
+    from mock import patch
+    from niceman.formats.reprozip import ReprozipProvenance
+    from niceman.interface import retrace
+    consumed = []
+
+    def iter_files(spec):
+        for f in ['/a', '/b/../c']:
+            consumed.append(f)
+            yield f
+
+    def identify_distributions(files, **kwargs):
+        # nothing was read from the spec before tracing started
+        assert not consumed
+        assert list(islice(files, 1)) == ['/a']
+        assert consumed == ['/a']
+        assert list(files) == ['/c']
+        return [], set()
+
+    with patch.object(ReprozipProvenance, 'iter_files',
+                      staticmethod(iter_files)), \
+            patch.object(retrace, 'identify_distributions',
+                         identify_distributions), \
+            make_tempfile() as outfile:
+        main(['retrace', '--spec', reprozip_spec2, '--output-file', outfile,
+              '--chunk-size', '1'])
+    assert consumed == ['/a', '/b/../c']
+
+
+def test_retrace_profile(reprozip_spec2):
+    from niceman.support.profiler import profiler
+    with make_tempfile() as outfile, make_tempfile() as profile, \
+            swallow_outputs() as cm:
+        main(['retrace', '--spec', reprozip_spec2, '--output-file', outfile,
+              '--profile', profile])
+        with open(profile) as f:
+            report = json.load(f)
+        assert not profiler.enabled
+        assert_in('DebTracer', cm.err)
+    assert report['phases']['retrace']['calls'] == 1
+    assert report['phases']['DebTracer']['commands'] > 0
+
+
+def test_identify_distributions_in_chunks():
+    _, session = get_tracer_session([])
+
+    class FakeTracer(object):
+        HANDLES_DIRS = False
+        chunks = []
+
+        def __init__(self, session):
+            assert not self.chunks, "must be instantiated only once"
+
+        def identify_distributions(self, files):
+            self.chunks.append(files)
+            yield 'Env', {f for f in files if f.startswith('unknown')}
+
+    files = ['a', 'b', 'unknown1', 'a', 'c', 'unknown2', 'd']
+    dists, unknown_files = identify_distributions(
+        iter(files), session, tracer_classes=[FakeTracer], chunk_size=3)
+    assert FakeTracer.chunks == [
+        {'a', 'b', 'unknown1'}, {'a', 'c', 'unknown2'}, {'d'}]
+    # merged
+    assert dists == ['Env']
+    assert unknown_files == {'unknown1', 'unknown2'}
+
+
 @skip_if_no_apt_cache
 def test_retrace_normalize_paths():
     # Retrace should normalize paths before passing them to tracers.
@@ -53,13 +141,16 @@ def test_retrace_normalize_paths():
 def get_tracer_session(protocols):
     class FakeSession(object):
         """A fake session attributes and methods of which should not
-        actually be used only but isdir.
+        actually be used only but isdir and stat_many.
         If anything else is accessed, it means that we have some assumptions
         """
 
         def isdir(self, _):
             return False  # TODO: make it parametric
 
+        def stat_many(self, paths, follow_symlinks=False):
+            return {p: None for p in paths}
+
     tracer_classes = []
     for itracer, protocol in enumerate(protocols):
         # Test the loop logic
@@ -69,12 +160,11 @@ def get_tracer_session(protocols):
 
             def __init__(self, session):
                 assert session
-                assert self._protocol, \
-                    "No more protocols to go through, but were were asked to"
-                self._current_protocol = self._protocol.pop(0)
 
             def identify_distributions(self, files):
-                for item in self._current_protocol:
+                assert self._protocol, \
+                    "No more protocols to go through, but were were asked to"
+                for item in self._protocol.pop(0):
                     yield item
         FakeTracer.__name__ = "FakeTracer%d" % itracer
         tracer_classes.append(FakeTracer)
@@ -90,6 +180,44 @@ def _check_loop_protocol(protocols, files, tenvs, tfiles):
     assert unknown_files == tfiles
 
 
+def test_retrace_concurrent_tracers():
+    _, session = get_tracer_session([])
+
+    def get_tracer(name, owned):
+        class FakeTracer(object):
+            HANDLES_DIRS = False
+            calls = []
+
+            def __init__(self, session):
+                pass
+
+            def identify_distributions(self, files):
+                self.calls.append(set(files))
+                if files & owned:
+                    yield name + ':' + ','.join(sorted(files & owned)), \
+                        files - owned
+        FakeTracer.__name__ = name
+        return FakeTracer
+
+    files = ['a', 'b', 'c', 'd']
+    for jobs in 1, 3:
+        tracer_classes = [
+            get_tracer('T1', {'a', 'b'}),
+            get_tracer('T2', {'b', 'c'}),  # conflicts with T1 on 'b'
+            get_tracer('T3', {'d'}),
+        ]
+        dists, unknown_files = identify_distributions(
+            files, session, tracer_classes=tracer_classes, jobs=jobs)
+        assert dists == ['T1:a,b', 'T2:c', 'T3:d']
+        assert unknown_files == set()
+        if jobs > 1:
+            # all tracers were given all the files at once, T2 was rerun
+            # on the files not claimed by T1
+            assert tracer_classes[0].calls[0] == set(files)
+            assert tracer_classes[1].calls == [set(files), {'c', 'd'}]
+            assert tracer_classes[2].calls[0] == set(files)
+
+
 def test_retrace_loop_over_tracers():
     _check_loop_protocol(
         [  # Tracers
@@ -128,20 +256,16 @@ def test_retrace_loop_over_tracers():
                 [  # what to yield
                     ("Env1", {"file2", "file3"}),
                 ],
-                [
+                [  # only file3 and file4 are new to it
                     ("Env3", {"file3"})  # consume file4
                 ],
-                []  # finale
             ],
             [  # Tracer passes
                 [  # what to yield
                     ("Env2", {"file3", "file4", "file5"}),
                     ("Env2.1", {"file3", "file4"})
                 ],
-                [
-
-                ],
-                []  # finale
+                # file3 was already offered to it
             ]
         ],
         files=["file1", "file2"],
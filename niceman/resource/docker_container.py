@@ -14,11 +14,12 @@ import dockerpty
 import io
 import json
 import os
+import struct
 import tarfile
 from niceman import utils
 from ..support.exceptions import CommandError, ResourceError
 from niceman.dochelpers import borrowdoc
-from niceman.resource.session import POSIXSession, Session
+from niceman.resource.session import POSIXSession, Session, ShellCoprocess
 from .base import Resource
 from ..utils import attrib
 
@@ -45,6 +46,8 @@ class DockerContainer(Resource):
         doc="Docker server URL where engine is listening for connections")
     seccomp_unconfined = attrib(default=False,
         doc="Disable kernel secure computing mode when creating the container")
+    persistent_session = attrib(default=False,
+        doc="Run all commands through a single long-lived shell")
 
     status = attrib()
 
@@ -160,10 +163,43 @@ class DockerContainer(Resource):
 
         if pty and shared is not None and not shared:
             lgr.warning("Cannot do non-shared pty session for docker yet")
-        return (PTYDockerSession if pty else DockerSession)(
+        session = (PTYDockerSession if pty else DockerSession)(
             client=self._client,
             container=self._container
         )
+        session.persistent = bool(self.persistent_session)
+        return session
+
+
+class _DockerStreamReader(object):
+    """Reads the payload of a stream multiplexed by docker exec without a tty
+
+    Every frame of the stream starts with an 8 bytes header carrying the type
+    of the stream (stdout or stderr) and the size of the frame.
+    """
+
+    def __init__(self, recv):
+        self._recv = recv
+        self._left = 0  # bytes left in the current frame
+
+    def _recv_exactly(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self._recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def __call__(self, n):
+        while not self._left:
+            header = self._recv_exactly(8)
+            if header is None:
+                return b''
+            _, self._left = struct.unpack('>BxxxL', header)
+        data = self._recv(min(n, self._left))
+        self._left -= len(data)
+        return data
 
 
 @attr.s
@@ -209,6 +245,18 @@ class DockerSession(POSIXSession):
 
         return (out, '')
 
+    @borrowdoc(POSIXSession)
+    def _start_coprocess(self):
+        # stderr of the shell itself is of no interest, and output of the
+        # commands is collected by the shell
+        execute = self.client.exec_create(
+            container=self.container, cmd='/bin/sh', stdin=True,
+            stderr=False)
+        sock = self.client.exec_start(exec_id=execute['Id'], socket=True)
+        sock = getattr(sock, '_sock', sock)  # SocketIO under Python 3
+        return ShellCoprocess(sock.sendall, _DockerStreamReader(sock.recv),
+                              close=sock.close)
+
     # XXX should we start/stop on open/close or just assume that it is running already?
 
 
@@ -16,11 +16,21 @@ import attr
 import json
 import os
 import re
+import stat
+import threading
+import time
+import uuid
+from pipes import quote
+
+from six import string_types
 
 from niceman.support.exceptions import SessionRuntimeError
 from niceman.cmd import Runner
 from niceman.dochelpers import exc_str, borrowdoc
 from niceman.support.exceptions import CommandError
+from niceman.support.profiler import profiler
+from niceman.utils import attrib
+from niceman.utils import execute_command_batch
 from niceman.utils import updated
 from niceman.utils import to_unicode
 
@@ -28,6 +38,173 @@ import logging
 lgr = logging.getLogger('niceman.session')
 
 
+@attr.s(slots=True, frozen=True)
+class PathStat(object):
+    """Information about a path as returned by `Session.stat_many`"""
+    type = attrib()  # 'file', 'dir', 'link' or 'other'
+    size = attrib()
+    mtime = attrib()
+    link_target = attrib()  # if path is a symlink
+
+    @classmethod
+    def from_stat(cls, st, link_target=None):
+        """Create an instance from os.stat_result"""
+        mode = st.st_mode
+        if stat.S_ISDIR(mode):
+            type_ = 'dir'
+        elif stat.S_ISREG(mode):
+            type_ = 'file'
+        elif stat.S_ISLNK(mode):
+            type_ = 'link'
+        else:
+            type_ = 'other'
+        return cls(type=type_, size=st.st_size, mtime=st.st_mtime,
+                   link_target=link_target)
+
+
+def stat_path(path, follow_symlinks=False):
+    """Return PathStat for a path on the local file system
+
+    Returns
+    -------
+    PathStat or None
+      None if path does not exist
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    link_target = None
+    if stat.S_ISLNK(st.st_mode):
+        link_target = os.readlink(path)
+        if follow_symlinks:
+            try:
+                st = os.stat(path)
+            except OSError:
+                pass  # broken symlink
+    return PathStat.from_stat(st, link_target=link_target)
+
+
+class ShellCoprocess(object):
+    """A long-lived POSIX shell which runs commands sent to it one at a time
+
+    Each command is run in a subshell with its stdout and stderr captured into
+    temporary files within the resource.  They are sent back after a sentinel
+    line which carries the exit code of the command, followed by the lengths
+    of its stdout and stderr, so there is no need to start a new process (or
+    open a new channel) per command.
+
+    Parameters
+    ----------
+    write : callable
+      Sends bytes to the stdin of the shell
+    read : callable
+      Given a number of bytes, returns up to that many bytes from the stdout
+      of the shell, or an empty bytes string if it has exited
+    close : callable, optional
+      Called (after the shell was asked to exit) to release the transport
+    """
+
+    _BUFSIZE = 65536
+
+    def __init__(self, write, read, close=None):
+        self._write = write
+        self._read = read
+        self._close = close
+        self._buffer = b''
+        self._lock = threading.Lock()
+        self._sentinel = 'NICEMAN-%s' % uuid.uuid4().hex
+        self._write(
+            b'_niceman_d=$(mktemp -d) || exit 1\n'
+            b'trap \'rm -rf "$_niceman_d"\' EXIT\n')
+
+    def _format_command(self, command, env=None, cwd=None):
+        if isinstance(command, string_types):
+            cmd = command
+        else:
+            cmd = 'exec ' + ' '.join(quote(c) for c in command)
+        prefix = ''
+        if cwd:
+            prefix += 'cd %s || exit 1; ' % quote(cwd)
+        for var, value in sorted((env or {}).items()):
+            if value is None:
+                prefix += 'unset %s; ' % var
+            else:
+                prefix += 'export %s=%s; ' % (var, quote(value))
+        # wc reports the sizes of both files (and their total) on separate
+        # lines right after the sentinel line
+        return (
+            '( %s%s\n) </dev/null >"$_niceman_d/out" 2>"$_niceman_d/err"\n'
+            'echo "%s $?"\n'
+            'wc -c "$_niceman_d/out" "$_niceman_d/err"\n'
+            'cat "$_niceman_d/out" "$_niceman_d/err"\n'
+            % (prefix, cmd, self._sentinel)
+        ).encode('utf-8')
+
+    def _fill_buffer(self):
+        data = self._read(self._BUFSIZE)
+        if not data:
+            raise SessionRuntimeError(
+                "Persistent shell exited unexpectedly")
+        self._buffer += data
+
+    def _readline(self):
+        while b'\n' not in self._buffer:
+            self._fill_buffer()
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line
+
+    def _readexactly(self, n):
+        while len(self._buffer) < n:
+            self._fill_buffer()
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def run(self, command, env=None, cwd=None):
+        """Run a command within the shell
+
+        Parameters
+        ----------
+        command : list or str
+          Command tokens, or a string to be interpreted by the shell
+        env : dict, optional
+          Environment variables to set (or unset if value is None) for the
+          command
+        cwd : str, optional
+          Directory to run the command in
+
+        Returns
+        -------
+        (exit_code, stdout, stderr)
+          stdout and stderr are bytes
+        """
+        sentinel = self._sentinel.encode('utf-8')
+        with self._lock:
+            self._write(self._format_command(command, env=env, cwd=cwd))
+            while True:
+                line = self._readline()
+                if line.startswith(sentinel + b' '):
+                    break
+                # should not happen since all output is redirected
+                lgr.debug("Ignoring unexpected output from the shell: %r",
+                          line)
+            exit_code = int(line.split()[1])
+            out_len, err_len = [
+                int(self._readline().split()[0]) for _ in range(3)][:2]
+            out = self._readexactly(out_len)
+            err = self._readexactly(err_len)
+        return exit_code, out, err
+
+    def close(self):
+        """Ask the shell to exit and release the transport"""
+        try:
+            self._write(b'exit\n')
+        except (IOError, OSError) as exc:
+            lgr.debug("Failed to ask the shell to exit: %s", exc_str(exc))
+        if self._close:
+            self._close()
+
+
 @attr.s
 class Session(object):
     """Interface for Resources to provide interaction within that environment"""
@@ -53,6 +230,11 @@ class Session(object):
         """Sugaring shortcut to `execute_command`"""
         return self.execute_command(*args, **kwargs)
 
+    # Run all the commands through a single long-lived shell (see
+    # ShellCoprocess) instead of the session specific _execute_command.
+    # Enabled by resources which have persistent_session set
+    persistent = False
+
     # By default don't do anything special
     def open(self):
         """
@@ -189,11 +371,27 @@ class Session(object):
         if command_env:
             run_kw['env'] = command_env
 
-        return self._execute_command(
-            command,
-            cwd=cwd,
-            **run_kw
-        )  # , shell=True)
+        execute = self._execute_command_persistent if self.persistent \
+            else self._execute_command
+        if not profiler.enabled:
+            return execute(
+                command,
+                cwd=cwd,
+                **run_kw
+            )  # , shell=True)
+
+        start = time.time()
+        out = err = None
+        try:
+            out, err = execute(command, cwd=cwd, **run_kw)
+            return out, err
+        except CommandError as exc:
+            out, err = exc.stdout, exc.stderr
+            raise
+        finally:
+            profiler.record_command(
+                command, time.time() - start,
+                len(out or '') + len(err or ''))
 
     def _execute_command(self, command, env=None, cwd=None):
         """
@@ -224,6 +422,13 @@ class Session(object):
         """
         raise NotImplementedError
 
+    def _execute_command_persistent(self, command, env=None, cwd=None):
+        """Execute the given command through a long-lived shell
+
+        Same as `_execute_command` otherwise.
+        """
+        raise NotImplementedError
+
     #
     # Files query and manipulation
     # TODO:  should be in subspace (.path) may be? This would allow for
@@ -319,6 +524,42 @@ class Session(object):
         """
         raise NotImplementedError
 
+    def put_many(self, paths, uid=-1, gid=-1):
+        """Copy multiple files from the local file system into the resource
+
+        By default every file is copied with `put`, sessions which can
+        transfer them in bulk should override it.
+
+        Parameters
+        ----------
+        paths : iterable of (str, str)
+            (src_path, dest_path) pairs, as `put` takes them
+        uid : int, optional
+            As `put` takes it, for all the files
+        gid : int, optional
+            As `put` takes it, for all the files
+        """
+        for src_path, dest_path in paths:
+            self.put(src_path, dest_path, uid=uid, gid=gid)
+
+    def get_many(self, paths, uid=-1, gid=-1):
+        """Copy multiple files from the resource into the local file system
+
+        By default every file is copied with `get`, sessions which can
+        transfer them in bulk should override it.
+
+        Parameters
+        ----------
+        paths : iterable of (str, str)
+            (src_path, dest_path) pairs, as `get` takes them
+        uid : int, optional
+            As `get` takes it, for all the files
+        gid : int, optional
+            As `get` takes it, for all the files
+        """
+        for src_path, dest_path in paths:
+            self.get(src_path, dest_path, uid=uid, gid=gid)
+
     def get_mtime(self, path):
         """Returns the modification time for a file in the resource
         
@@ -392,6 +633,28 @@ class Session(object):
         """
         raise NotImplementedError
 
+    def stat_many(self, paths, follow_symlinks=False):
+        """Return information about multiple paths at once
+
+        Unlike calling `exists` or `isdir` for each path, implementations
+        should query the resource in a single (or a few) round-trip(s).
+
+        Parameters
+        ----------
+        paths : iterable of str
+            Paths to stat in the resource
+        follow_symlinks : bool, optional
+            Report type, size and mtime of the symlink targets (as os.stat
+            would), instead of the symlinks themselves (as os.lstat would).
+            link_target is reported for symlinks regardless
+
+        Returns
+        -------
+        dict
+            path -> PathStat, or None if path does not exist
+        """
+        raise NotImplementedError
+
     def chmod(self, path, mode, recursive=False):
         """Set the mode of the indicated path
         
@@ -440,6 +703,38 @@ class POSIXSession(Session):
 
     _GET_ENVIRON_CMD = ['python', '-c', 'import os,json,sys; sys.stdout.write(json.dumps(dict(os.environ)))']
 
+    _coprocess = None
+
+    @borrowdoc(Session)
+    def close(self):
+        if self._coprocess is not None:
+            self._coprocess.close()
+            self._coprocess = None
+        super(POSIXSession, self).close()
+
+    def _start_coprocess(self):
+        """Start a long-lived shell within the resource
+
+        Returns
+        -------
+        ShellCoprocess
+        """
+        raise NotImplementedError
+
+    @borrowdoc(Session)
+    def _execute_command_persistent(self, command, env=None, cwd=None):
+        if self._coprocess is None:
+            self._coprocess = self._start_coprocess()
+        exit_code, out, err = self._coprocess.run(command, env=env, cwd=cwd)
+        out = to_unicode(out, "utf-8")
+        err = to_unicode(err, "utf-8")
+        if exit_code != 0:
+            msg = "Failed to run %r. Exit code=%d. out=%s err=%s" \
+                % (command, exit_code, out, err)
+            raise CommandError(str(command), msg, exit_code, out, err)
+        lgr.log(8, "Finished running %r with status %s", command, exit_code)
+        return out, err
+
     @borrowdoc(Session)
     def query_envvars(self):
         out, err = self.execute_command(self._GET_ENVIRON_CMD)
@@ -591,6 +886,63 @@ class POSIXSession(Session):
                       "test for direcory has failed", err)
             return False
 
+    # Reports [path, type, size, mtime, link_target] for all the paths given
+    # after the follow_symlinks flag
+    _STAT_MANY_SCRIPT = """\
+import json, os, stat, sys
+follow = sys.argv[1] == '1'
+out = []
+for p in sys.argv[2:]:
+    try:
+        st = os.lstat(p)
+    except OSError:
+        out.append([p, None, None, None, None])
+        continue
+    target = os.readlink(p) if stat.S_ISLNK(st.st_mode) else None
+    if target is not None and follow:
+        try:
+            st = os.stat(p)
+        except OSError:
+            pass
+    m = st.st_mode
+    t = 'dir' if stat.S_ISDIR(m) else 'file' if stat.S_ISREG(m) \\
+        else 'link' if stat.S_ISLNK(m) else 'other'
+    out.append([p, t, st.st_size, st.st_mtime, target])
+sys.stdout.write(json.dumps(out))
+"""
+
+    @borrowdoc(Session)
+    def stat_many(self, paths, follow_symlinks=False):
+        paths = list(paths)
+        stats = {}
+        for python in ('python3', 'python'):
+            try:
+                for out, _, _ in execute_command_batch(
+                        self,
+                        [python, '-c', self._STAT_MANY_SCRIPT,
+                         '1' if follow_symlinks else '0'],
+                        [p for p in paths if p not in stats]):
+                    for path, type_, size, mtime, link_target \
+                            in json.loads(out):
+                        stats[path] = PathStat(
+                            type=type_, size=size, mtime=mtime,
+                            link_target=link_target) if type_ else None
+                return stats
+            except (CommandError, ValueError) as exc:
+                lgr.debug("Failed to stat paths in bulk using %s: %s",
+                          python, exc_str(exc))
+        # no python in the environment -- check one path at a time
+        for path in paths:
+            if path in stats:
+                continue
+            if self.isdir(path):
+                stats[path] = PathStat(type='dir')
+            elif self.exists(path):
+                stats[path] = PathStat(type='file')
+            else:
+                stats[path] = None
+        return stats
+
     def chmod(self, path, mode, recursive=False):
         """Set the mode of a remote path
         """
@@ -599,9 +951,9 @@ class POSIXSession(Session):
         command += [mode] + [path]
         self.execute_command(command)
 
-    def chown(self, path, uid=-1, gid=-1, recursive=False, remote=True):
-        """Set the user and gid of a path
-        """
+    @staticmethod
+    def _get_chown_command(uid=-1, gid=-1, recursive=False):
+        """Return the command to set the user and gid, without the paths"""
         uid = int(uid) # Command line parameters getting passed as type str
         gid = int(gid)
 
@@ -611,11 +963,16 @@ class POSIXSession(Session):
             command = ['chown']
         if recursive: command += ["-R"]
         if uid > -1 and gid > -1: command += ["{}.{}".format(uid, gid)]
-        elif uid > -1: command += [uid]
-        elif gid > -1: command += [gid]
+        elif uid > -1: command += [str(uid)]
+        elif gid > -1: command += [str(gid)]
         else: raise CommandError(cmd='chown', msg="Invalid command \
             parameters.")
-        command += [path]
+        return command
+
+    def chown(self, path, uid=-1, gid=-1, recursive=False, remote=True):
+        """Set the user and gid of a path
+        """
+        command = self._get_chown_command(uid, gid, recursive) + [path]
         if remote:
             self.execute_command(command)
         else:
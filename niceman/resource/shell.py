@@ -10,6 +10,7 @@
 
 import attr
 import shutil
+import subprocess
 
 from .base import Resource
 from niceman.cmd import Runner
@@ -23,7 +24,8 @@ lgr = logging.getLogger('niceman.resource.shell')
 
 import os
 
-from .session import POSIXSession, get_updated_env
+from .session import POSIXSession, ShellCoprocess, get_updated_env, \
+    stat_path
 
 
 # For now just assuming that local shell is a POSIX shell
@@ -43,6 +45,7 @@ class ShellSession(POSIXSession):
     @borrowdoc(Session)
     def close(self):
         self._runner = None
+        super(ShellSession, self).close()
 
     @borrowdoc(Session)
     def _execute_command(self, command, env=None, cwd=None):
@@ -66,10 +69,32 @@ class ShellSession(POSIXSession):
             **run_kw
         )  # , shell=True)
 
+    @borrowdoc(POSIXSession)
+    def _start_coprocess(self):
+        proc = subprocess.Popen(
+            ['/bin/sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def write(data):
+            proc.stdin.write(data)
+            proc.stdin.flush()
+
+        def close():
+            proc.stdin.close()
+            proc.wait()
+            proc.stdout.close()
+
+        return ShellCoprocess(
+            write, lambda n: os.read(proc.stdout.fileno(), n), close=close)
+
     @borrowdoc(Session)
     def isdir(self, path):
         return os.path.isdir(path)
 
+    @borrowdoc(Session)
+    def stat_many(self, paths, follow_symlinks=False):
+        return {p: stat_path(p, follow_symlinks=follow_symlinks)
+                for p in paths}
+
     @borrowdoc(Session)
     def mkdir(self, path, parents=False):
         if not os.path.exists(path):
@@ -104,6 +129,9 @@ class Shell(Resource):
     id = attrib()
     type = attrib(default='shell')
 
+    persistent_session = attrib(default=False,
+        doc="Run all commands through a single long-lived shell")
+
     status = attrib()
 
     def create(self):
@@ -155,4 +183,6 @@ class Shell(Resource):
             raise NotImplementedError
         if shared:
             raise NotImplementedError
-        return ShellSession()
\ No newline at end of file
+        session = ShellSession()
+        session.persistent = bool(self.persistent_session)
+        return session
\ No newline at end of file
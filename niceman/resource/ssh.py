@@ -9,7 +9,10 @@
 """Resource sub-class to provide management of a SSH connection."""
 
 import attr
+import errno
+import time
 import uuid
+from multiprocessing.pool import ThreadPool
 from pipes import quote
 import socket
 import termios
@@ -26,7 +29,9 @@ from .base import Resource
 from ..utils import attrib
 from niceman.dochelpers import borrowdoc
 from niceman.resource.session import Session
+from niceman import cfg
 from niceman import utils
+from niceman.utils import execute_command_batch
 from ..support.exceptions import CommandError, SSHError, SSHConnectionError, \
     SSHAuthException
 from ..support import exceptions as exception  # to minimize diff for adopted code
@@ -49,6 +54,9 @@ class SSH(Resource):
     password = attrib(
         doc="Password to use to log into remote environment")
 
+    persistent_session = attrib(default=False,
+        doc="Run all commands through a single long-lived shell")
+
     id = attrib()  # EC2 instance ID
 
     type = attrib(default='ssh')  # Resource type
@@ -107,9 +115,11 @@ class SSH(Resource):
         if not self._ssh:
             self.connect()
 
-        return (PTYSSHSession if pty else SSHSession)(
+        session = (PTYSSHSession if pty else SSHSession)(
             ssh=self._ssh
         )
+        session.persistent = bool(self.persistent_session)
+        return session
 
 # Alias SSH class so that it can be discovered by the ResourceManager.
 @attr.s
@@ -117,7 +127,7 @@ class Ssh(SSH):
     pass
 
 
-from niceman.resource.session import POSIXSession
+from niceman.resource.session import POSIXSession, ShellCoprocess
 
 @attr.s
 class SSHSession(POSIXSession):
@@ -152,14 +162,41 @@ class SSHSession(POSIXSession):
 
         return (stdout, stderr)
 
+    @borrowdoc(POSIXSession)
+    def _start_coprocess(self):
+        channel = self.ssh.get_transport().open_session()
+        channel.exec_command('/bin/sh')
+        return ShellCoprocess(channel.sendall, channel.recv,
+                              close=channel.close)
+
+    _sftp = None
+
+    @property
+    def sftp(self):
+        """SFTP client, opened once and reused for all the transfers"""
+        if self._sftp is None:
+            self._sftp = self.ssh.open_sftp()
+        return self._sftp
+
+    @borrowdoc(Session)
+    def close(self):
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
+        super(SSHSession, self).close()
+
     @borrowdoc(Session)
     def put(self, src_path, dest_path, uid=-1, gid=-1):
         dest_dir, dest_basename = os.path.split(dest_path)
-        if not self.exists(dest_dir):
+        try:
+            self.sftp.put(src_path, dest_path)
+        except IOError as exc:
+            # the directory is created only if missing, instead of checking
+            # for it before every transfer
+            if exc.errno != errno.ENOENT or not dest_dir:
+                raise
             self.mkdir(dest_dir, parents=True)
-        sftp = self.ssh.open_sftp()
-        sftp.put(src_path, dest_path)
-        sftp.close()
+            self.sftp.put(src_path, dest_path)
 
         if uid > -1 or gid > -1:
             self.chown(dest_path, uid, gid)
@@ -167,15 +204,100 @@ class SSHSession(POSIXSession):
     @borrowdoc(Session)
     def get(self, src_path, dest_path, uid=-1, gid=-1):
         dest_dir, dest_basename = os.path.split(dest_path)
-        if not os.path.exists(dest_dir):
+        if dest_dir and not os.path.exists(dest_dir):
             os.makedirs(dest_dir)
-        sftp = self.ssh.open_sftp()
-        sftp.get(src_path, dest_path)
-        sftp.close()
+        self.sftp.get(src_path, dest_path)
 
         if uid > -1 or gid > -1:
             self.chown(dest_path, uid, gid, remote=False)
 
+    @borrowdoc(Session)
+    def put_many(self, paths, uid=-1, gid=-1):
+        paths = list(paths)
+        # all the directories are created at once
+        dest_dirs = set(os.path.dirname(dest_path)
+                        for _, dest_path in paths) - {''}
+        for _ in execute_command_batch(self, ['mkdir', '-p'],
+                                       sorted(dest_dirs)):
+            pass
+        self._transfer(paths, put=True)
+
+        if uid > -1 or gid > -1:
+            for _ in execute_command_batch(
+                    self, self._get_chown_command(uid, gid),
+                    [dest_path for _, dest_path in paths]):
+                pass
+
+    @borrowdoc(Session)
+    def get_many(self, paths, uid=-1, gid=-1):
+        paths = list(paths)
+        for dest_dir in set(os.path.dirname(dest_path)
+                            for _, dest_path in paths) - {''}:
+            if not os.path.exists(dest_dir):
+                os.makedirs(dest_dir)
+        self._transfer(paths, put=False)
+
+        if uid > -1 or gid > -1:
+            for _, dest_path in paths:
+                self.chown(dest_path, uid, gid, remote=False)
+
+    def _transfer(self, paths, put):
+        """Transfer the files over a few SFTP channels concurrently
+
+        The channels (see [ssh] transfer jobs) share the connection, so
+        the round-trips of a transfer overlap with the others.
+
+        Parameters
+        ----------
+        paths : list of (str, str)
+          (src_path, dest_path) pairs
+        put : bool
+          Either to put the files into the resource, or to get them from it
+
+        Returns
+        -------
+        int
+          Number of bytes transferred
+        """
+        if not paths:
+            return 0
+        jobs = min(cfg.get_as_dtype('ssh', 'transfer jobs', int, default=4),
+                   len(paths))
+        sizes = []
+
+        def transfer(ichannel):
+            # the persistent client for the first channel, new ones for the
+            # rest
+            sftp = self.sftp if not ichannel else self.ssh.open_sftp()
+            try:
+                for src_path, dest_path in paths[ichannel::jobs]:
+                    if put:
+                        sizes.append(sftp.put(src_path, dest_path).st_size)
+                    else:
+                        sftp.get(src_path, dest_path)
+                        sizes.append(os.path.getsize(dest_path))
+            finally:
+                if ichannel:
+                    sftp.close()
+
+        start = time.time()
+        if jobs > 1:
+            pool = ThreadPool(jobs)
+            try:
+                pool.map(transfer, range(jobs))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            transfer(0)
+        duration = time.time() - start
+        size = sum(sizes)
+        lgr.info("Transferred %d files (%d bytes) %s in %.2f sec (%.2f MB/s)",
+                 len(paths), size, "to the resource" if put
+                 else "from the resource", duration,
+                 size / 1e6 / max(duration, 1e-6))
+        return size
+
 
 @attr.s
 class PTYSSHSession(SSHSession):
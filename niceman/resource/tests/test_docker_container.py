@@ -161,3 +161,26 @@ def test_setup_ubuntu(setup_ubuntu):
     print(setup_ubuntu)
     assert setup_ubuntu['container_id']
 
+
+
+def test_docker_stream_reader():
+    from ..docker_container import _DockerStreamReader
+    # two stdout frames: 'hello' and ' world'
+    stream = b'\x01\x00\x00\x00\x00\x00\x00\x05hello' \
+             b'\x01\x00\x00\x00\x00\x00\x00\x06 world'
+    buf = [stream]
+
+    def recv(n):
+        # as a socket would, return at most 3 bytes at a time
+        data, buf[0] = buf[0][:min(n, 3)], buf[0][min(n, 3):]
+        return data
+
+    reader = _DockerStreamReader(recv)
+    data = b''
+    while True:
+        chunk = reader(4)
+        if not chunk:
+            break
+        assert len(chunk) <= 4
+        data += chunk
+    assert data == b'hello world'
@@ -182,6 +182,8 @@ def test_session_class():
             session.mktmpdir()
         with pytest.raises(NotImplementedError):
             session.isdir('path')
+        with pytest.raises(NotImplementedError):
+            session.stat_many(['path'])
         with pytest.raises(NotImplementedError):
             session.chmod('path', 'mode')
         with pytest.raises(NotImplementedError):
@@ -291,6 +293,12 @@ def test_session_abstract_methods(testing_container, resource_session,
     result = session.isdir('/no/such/dir')
     assert not result
 
+    # Check stat_many() method
+    result = session.stat_many(['/etc', '/etc/hosts', '/no/such/file'])
+    assert result['/etc'].type == 'dir'
+    assert result['/etc/hosts'].type == 'file'
+    assert result['/no/such/file'] is None
+
     # Create a temporary test file
     temp_file = tempfile.NamedTemporaryFile(dir=resource_test_dir)
     with temp_file as f:
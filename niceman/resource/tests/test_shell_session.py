@@ -0,0 +1,79 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+# Tests of the shell sessions which, unlike test_shell.py, do not depend on
+# test_session.py, and so run without NICEMAN_TESTS_SSH
+
+import os
+from mock import patch
+from pytest import raises
+
+from ..base import ResourceManager
+from ...support.exceptions import CommandError
+from ..shell import ShellSession
+from ..session import POSIXSession
+
+
+def test_stat_many(tmpdir):
+    tmpdir = str(tmpdir)
+    path = os.path.join(tmpdir, 'file')
+    with open(path, 'w') as f:
+        f.write('123')
+    link = os.path.join(tmpdir, 'link')
+    os.symlink(tmpdir, link)
+    missing = os.path.join(tmpdir, 'missing')
+
+    paths = [tmpdir, path, link, missing]
+    for session in ShellSession(), POSIXSession():
+        if isinstance(session, POSIXSession) \
+                and not isinstance(session, ShellSession):
+            # run the script based implementation through the local shell
+            session._execute_command = ShellSession()._execute_command
+        stats = session.stat_many(paths)
+        assert stats[tmpdir].type == 'dir'
+        assert stats[path].type == 'file'
+        assert stats[path].size == 3
+        assert stats[path].mtime == os.stat(path).st_mtime
+        assert stats[link].type == 'link'
+        assert stats[link].link_target == tmpdir
+        assert stats[missing] is None
+
+        stats = session.stat_many(paths, follow_symlinks=True)
+        assert stats[link].type == 'dir'
+        assert stats[link].link_target == tmpdir
+
+
+def test_persistent_session(tmpdir):
+    resource = ResourceManager.factory({
+        'name': 'test-persistent-shell',
+        'type': 'shell',
+        'persistent_session': True
+    })
+    session = resource.get_session()
+    assert session.persistent
+    with patch.object(session, '_execute_command') as execute_command:
+        out, err = session.execute_command(['echo', 'one two'])
+        assert out == 'one two\n'
+        assert err == ''
+        # the same shell is reused for all the commands
+        coprocess = session._coprocess
+        out, err = session.execute_command(
+            'pwd; echo "$VAR" >&2', env={'VAR': "it's"}, cwd=str(tmpdir))
+        assert out == str(tmpdir) + '\n'
+        assert err == "it's\n"
+        assert session._coprocess is coprocess
+        # binary and unterminated output is transferred as is
+        out, _ = session.execute_command(['printf', 'a\\0b\\nc'])
+        assert out == 'a\0b\nc'
+        with raises(CommandError) as cme:
+            session.execute_command(['sh', '-c', 'echo out; exit 3'])
+        assert cme.value.code == 3
+        assert cme.value.stdout == 'out\n'
+        assert not execute_command.called
+    session.close()
+    assert session._coprocess is None
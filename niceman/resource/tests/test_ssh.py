@@ -90,6 +90,14 @@ def test_ssh_class(setup_ssh, resource_test_dir):
         session.get('/etc/hosts', tmp_path)
         assert os.path.isfile(tmp_path)
 
+        remote_dir = '/tmp/{}'.format(uuid.uuid4().hex)
+        session.put_many([(__file__, remote_dir + '/a/test_ssh.py'),
+                          (__file__, remote_dir + '/b/test_ssh.py')])
+        session.get_many([(remote_dir + '/a/test_ssh.py', tmp_path + '.a'),
+                          (remote_dir + '/b/test_ssh.py', tmp_path + '.b')])
+        assert os.path.isfile(tmp_path + '.a')
+        assert os.path.isfile(tmp_path + '.b')
+
         file_contents = session.read('remote_test_ssh.py')
         file_contents = file_contents.split('\n')
         assert file_contents[8] == '# Test string to read'
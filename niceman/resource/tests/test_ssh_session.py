@@ -0,0 +1,74 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+# Tests of SSHSession which, unlike test_ssh.py, need no SSH server, and so
+# run without NICEMAN_TESTS_SSH
+
+import os
+import shutil
+from mock import MagicMock, patch
+
+from ...cmd import Runner
+from ..ssh import SSHSession
+
+
+def test_ssh_session_transfers(tmpdir):
+    class FakeSFTPClient(object):
+        opened = []
+
+        def __init__(self):
+            self.closed = False
+            self.opened.append(self)
+
+        def put(self, src_path, dest_path):
+            shutil.copy(src_path, dest_path)
+            return os.stat(dest_path)
+
+        def get(self, src_path, dest_path):
+            shutil.copy(src_path, dest_path)
+
+        def close(self):
+            self.closed = True
+
+    ssh = MagicMock()
+    ssh.open_sftp.side_effect = FakeSFTPClient
+    session = SSHSession(ssh=ssh)
+    commands = []
+
+    def execute_command(command, **kwargs):
+        commands.append(command)
+        return Runner().run(command)
+
+    src = tmpdir.join("src")
+    src.write("content")
+    remote = str(tmpdir.join("remote"))
+    paths = [(str(src), os.path.join(remote, "sub%d" % (i % 3), str(i)))
+             for i in range(10)]
+    with patch.object(session, "execute_command", execute_command):
+        session.put_many(paths)
+    # all the directories are created with a single command
+    assert commands == [["mkdir", "-p"] + sorted(
+        os.path.join(remote, "sub%d" % i) for i in range(3))]
+    assert sorted(os.listdir(remote)) == ["sub0", "sub1", "sub2"]
+    assert sum(len(files) for _, _, files in os.walk(remote)) == 10
+    # transferred over a few channels, but the first one is kept open
+    assert len(FakeSFTPClient.opened) == 4
+    assert [c.closed for c in FakeSFTPClient.opened] == [False] + [True] * 3
+
+    local = str(tmpdir.join("local"))
+    session.get_many((dest, os.path.join(local, os.path.basename(dest)))
+                     for _, dest in paths)
+    assert sorted(os.listdir(local), key=int) == [str(i) for i in range(10)]
+    assert len(FakeSFTPClient.opened) == 7
+
+    # single transfers reuse the open channel
+    session.put(str(src), os.path.join(remote, "single"))
+    session.get(os.path.join(remote, "single"), os.path.join(local, "single"))
+    assert len(FakeSFTPClient.opened) == 7
+    session.close()
+    assert FakeSFTPClient.opened[0].closed
@@ -0,0 +1,129 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""On-disk cache of values which stay valid while their fingerprint matches"""
+
+import hashlib
+import os
+import os.path as op
+import pickle
+
+import logging
+lgr = logging.getLogger('niceman.cache')
+
+
+class FingerprintCache(object):
+    """Cache of values stored along with a fingerprint of what they describe
+
+    Every value is pickled into its own file (named after a hash of its key)
+    within the cache directory.  Whenever the total size of the files exceeds
+    `max_size`, the least recently used ones are removed.
+
+    Parameters
+    ----------
+    path : str
+      Cache directory.  Created when the first value is stored
+    max_size : int, optional
+      Maximal total size (in bytes) of the stored values
+    """
+
+    def __init__(self, path, max_size=None):
+        self._path = path
+        self._max_size = max_size
+
+    def _get_file(self, key):
+        return op.join(self._path,
+                       hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+    def get(self, key, fingerprint):
+        """Return the value stored under the key, if fingerprints match
+
+        Returns
+        -------
+        object or None
+          None if there is no (valid) value stored under the key
+        """
+        cached_fingerprint, value = self.lookup(key)
+        if cached_fingerprint != fingerprint:
+            if value is not None:
+                lgr.debug("Cached value for %r is outdated", key)
+            return None
+        return value
+
+    def lookup(self, key):
+        """Return the value stored under the key, along with its fingerprint
+
+        Useful to update an outdated value, instead of recomputing it.
+
+        Returns
+        -------
+        (fingerprint, value)
+          (None, None) if there is no value stored under the key
+        """
+        cache_file = self._get_file(key)
+        if not op.exists(cache_file):
+            return None, None
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+        except Exception as exc:
+            lgr.debug("Failed to load cached value from %s: %s",
+                      cache_file, exc)
+            return None, None
+        if cached.get('key') != key:
+            return None, None
+        try:
+            # mark as recently used
+            os.utime(cache_file, None)
+        except OSError:
+            pass
+        return cached['fingerprint'], cached['value']
+
+    def set(self, key, fingerprint, value):
+        """Store the value under the key, along with its fingerprint"""
+        cache_file = self._get_file(key)
+        try:
+            if not op.exists(self._path):
+                os.makedirs(self._path)
+            tmp_file = cache_file + '.tmp%d' % os.getpid()
+            with open(tmp_file, 'wb') as f:
+                pickle.dump({'key': key,
+                             'fingerprint': fingerprint,
+                             'value': value},
+                            f, protocol=2)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as exc:
+            lgr.debug("Failed to store value for %r into %s: %s",
+                      key, cache_file, exc)
+            return
+        self._evict(keep=cache_file)
+
+    def _evict(self, keep=None):
+        if self._max_size is None:
+            return
+        entries = []
+        for name in os.listdir(self._path):
+            cache_file = op.join(self._path, name)
+            try:
+                st = os.stat(cache_file)
+            except OSError:  # removed concurrently
+                continue
+            entries.append((st.st_mtime, st.st_size, cache_file))
+        total_size = sum(size for _, size, _ in entries)
+        # least recently used first
+        for _, size, cache_file in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            if cache_file == keep:
+                continue
+            lgr.debug("Evicting %s from the cache", cache_file)
+            try:
+                os.unlink(cache_file)
+            except OSError:
+                continue
+            total_size -= size
@@ -12,7 +12,11 @@
 
 from __future__ import absolute_import
 
+import glob
 import logging
+import mmap
+import os
+import pickle
 import re
 import string
 
@@ -251,3 +255,253 @@ def parse_dpkgquery_line(line):
         if res['architecture'] is None:
             res.pop('architecture')
     return res
+
+
+def parse_dpkg_info_lists_output(output):
+    """Parse the content of /var/lib/dpkg/info/*.list files dumped by grep -H
+
+    Each line of the output is expected to be of the form
+    "/var/lib/dpkg/info/<name>[:<architecture>].list:<path>".
+
+    Yields
+    ------
+    (name, architecture, path)
+        architecture is None if package file name was not arch-qualified
+    """
+    re_list_line = re.compile(
+        r"^[^:]*/(?P<name>[^:/]+)(:(?P<architecture>[^:/]+))?\.list:"
+        r"(?P<path>.*)$"
+    )
+    for line in output.splitlines():
+        res = re_list_line.match(line)
+        if not res:
+            lgr.debug("Skipping unexpected dpkg list line %r", line)
+            continue
+        yield res.group('name'), res.group('architecture'), res.group('path')
+
+
+def parse_dpkg_diversions(content):
+    """Parse the content of /var/lib/dpkg/diversions
+
+    The file consists of records of three lines: the diverted path, the path
+    it was diverted to, and the package which diverted it (":" for local
+    diversions).
+
+    Returns
+    -------
+    dict
+        diverted path -> (path diverted to, diverting package or None)
+    """
+    lines = content.splitlines()
+    if len(lines) % 3:
+        lgr.warning("dpkg diversions list has %d lines which is not "
+                    "divisible by 3.  Ignoring incomplete record",
+                    len(lines))
+    diversions = {}
+    for i in range(0, len(lines) - 2, 3):
+        divert_from, divert_to, pkg = lines[i:i + 3]
+        diversions[divert_from] = (divert_to, None if pkg == ':' else pkg)
+    return diversions
+
+
+def iter_deb822_paragraphs(lines, fields=None):
+    """Iterate over paragraphs of deb822-formatted content
+
+    Only single-line fields are collected, continuation lines of multi-line
+    fields (e.g. Description, Conffiles) are skipped.
+
+    Parameters
+    ----------
+    lines : iterable of str
+      E.g. an open file, so the content does not need to be loaded at once
+    fields : container of str, optional
+      Lower-cased names of the fields to collect.  If not specified, all
+      fields are collected
+
+    Yields
+    ------
+    dict
+      lower-cased field name -> value
+    """
+    para = {}
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            # paragraphs are separated by empty lines
+            if para:
+                yield para
+                para = {}
+            continue
+        if line[0] in ' \t#':
+            continue
+        tag, sep, val = line.partition(':')
+        if not sep:
+            continue
+        tag = tag.lower()
+        if fields is None or tag in fields:
+            para[tag] = val.strip()
+    if para:
+        yield para
+
+
+def parse_dpkg_status(lines):
+    """Parse /var/lib/dpkg/status into records for the installed packages
+
+    Parameters
+    ----------
+    lines : iterable of str
+
+    Yields
+    ------
+    dict
+      with package, architecture, version, installed-size and status fields
+      (as present in the status file)
+    """
+    fields = {'package', 'status', 'architecture', 'version',
+              'installed-size'}
+    for pkg in iter_deb822_paragraphs(lines, fields):
+        # not-installed or purged packages could still be listed
+        if 'package' not in pkg or 'version' not in pkg \
+                or pkg.get('status', '').endswith('not-installed'):
+            continue
+        yield pkg
+
+
+class APTListsIndex(object):
+    """Index of package stanzas in local /var/lib/apt/lists/*_Packages files
+
+    For every stanza only its location (file, offset, length) is recorded,
+    keyed by (name, architecture, version).  Stanzas are parsed only upon
+    lookup directly from memory-mapped list files.  The index could be
+    stored in a cache file and is reused as long as the list files were not
+    changed (judging by their names, sizes and mtimes).
+
+    Parameters
+    ----------
+    lists_dir : str, optional
+    cache_file : str, optional
+      Path to the file to load the index from and to store it into
+    """
+
+    # Increment whenever the structure of the stored index changes
+    _CACHE_VERSION = 1
+
+    _re_stanza_start = re.compile(b'(?:\\A|\\n)(?=Package: )')
+    _re_fields = {
+        f: re.compile(b'^' + f.encode() + b': *(\\S+) *$', flags=re.MULTILINE)
+        for f in ('Package', 'Architecture', 'Version')
+    }
+
+    def __init__(self, lists_dir='/var/lib/apt/lists', cache_file=None):
+        self._lists_dir = lists_dir
+        self._cache_file = cache_file
+        self._lists = None   # list of (path, size, mtime)
+        self._index = None   # (name, architecture, version) -> (i, offset, len)
+        self._mmaps = {}     # list index -> mmap
+
+    def _get_lists(self):
+        lists = []
+        for path in sorted(glob.glob(os.path.join(self._lists_dir,
+                                                  '*_Packages'))):
+            st = os.stat(path)
+            lists.append((path, st.st_size, st.st_mtime))
+        return lists
+
+    def _load_cache(self, lists):
+        if not (self._cache_file and os.path.exists(self._cache_file)):
+            return None
+        try:
+            with open(self._cache_file, 'rb') as f:
+                cached = pickle.load(f)
+        except Exception as exc:
+            lgr.debug("Failed to load APT lists index from %s: %s",
+                      self._cache_file, exc)
+            return None
+        if cached.get('version') != self._CACHE_VERSION \
+                or cached.get('lists') != lists:
+            lgr.debug("APT lists index in %s is outdated", self._cache_file)
+            return None
+        return cached['index']
+
+    def _store_cache(self, lists, index):
+        if not self._cache_file:
+            return
+        try:
+            cache_dir = os.path.dirname(self._cache_file)
+            if cache_dir and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_file = self._cache_file + '.tmp%d' % os.getpid()
+            with open(tmp_file, 'wb') as f:
+                pickle.dump({'version': self._CACHE_VERSION,
+                             'lists': lists,
+                             'index': index},
+                            f, protocol=2)
+            os.rename(tmp_file, self._cache_file)
+        except (IOError, OSError) as exc:
+            lgr.debug("Failed to store APT lists index into %s: %s",
+                      self._cache_file, exc)
+
+    def _get_mmap(self, i):
+        if i not in self._mmaps:
+            with open(self._lists[i][0], 'rb') as f:
+                self._mmaps[i] = mmap.mmap(f.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+        return self._mmaps[i]
+
+    def _index_list(self, i, index):
+        mm = self._get_mmap(i)
+        starts = [m.end() for m in self._re_stanza_start.finditer(mm)]
+        ends = starts[1:] + [len(mm)]
+        for start, end in zip(starts, ends):
+            key = []
+            for f in ('Package', 'Architecture', 'Version'):
+                m = self._re_fields[f].search(mm, start, end)
+                if not m:
+                    break
+                key.append(m.group(1).decode('utf-8'))
+            else:
+                # the first listed stanza wins, as in apt-cache show
+                index.setdefault(tuple(key), (i, start, end - start))
+
+    def load(self):
+        """Load the index from the cache or (re)build it if outdated"""
+        lists = self._get_lists()
+        index = self._load_cache(lists)
+        self.close()
+        self._lists = lists
+        if index is None:
+            index = {}
+            for i, (_, size, _) in enumerate(lists):
+                if size:  # empty files cannot be mmap'ed
+                    self._index_list(i, index)
+            lgr.debug("Indexed %d package stanzas in %d APT lists",
+                      len(index), len(lists))
+            self._store_cache(lists, index)
+        self._index = index
+        return self
+
+    def close(self):
+        for mm in self._mmaps.values():
+            mm.close()
+        self._mmaps = {}
+
+    def __len__(self):
+        return len(self._index or {})
+
+    def get(self, name, architecture, version):
+        """Return the package record as parse_apt_cache_show_pkgs_output would
+
+        Returns
+        -------
+        dict or None
+          None if there is no such package in the lists
+        """
+        if self._index is None:
+            self.load()
+        loc = self._index.get((name, architecture, version))
+        if not loc:
+            return None
+        i, offset, length = loc
+        stanza = self._get_mmap(i)[offset:offset + length].decode('utf-8')
+        records = parse_apt_cache_show_pkgs_output(stanza)
+        return records[0] if records else None
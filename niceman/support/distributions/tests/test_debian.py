@@ -10,11 +10,15 @@
 
 """
 
+import os
+
+import mock
+
 from ..debian import DebianReleaseSpec
 from ..debian import get_spec_from_release_file
 from ..debian import parse_dpkgquery_line
 
-from niceman.tests.utils import eq_, assert_is_subset_recur
+from niceman.tests.utils import eq_, assert_is_subset_recur, with_tree
 
 
 def test_get_spec_from_release_file(f=None):
@@ -374,3 +378,132 @@ def test_parse_dpkgquery_line():
             ('diversion by dash from: /bin/sh', None)
     ]:
         assert parse_dpkgquery_line(line) == expected
+
+
+def test_parse_dpkg_info_lists_output():
+    from ..debian import parse_dpkg_info_lists_output
+    out = """\
+/var/lib/dpkg/info/libtk8.6:amd64.list:/usr/lib
+/var/lib/dpkg/info/dash.list:/bin/sh
+/var/lib/dpkg/info/a.list:amd64.list:/path:with:colons
+/var/lib/dpkg/info/b.list.list:/
+garbage
+"""
+    assert list(parse_dpkg_info_lists_output(out)) == [
+        ('libtk8.6', 'amd64', '/usr/lib'),
+        ('dash', None, '/bin/sh'),
+        ('a.list', 'amd64', '/path:with:colons'),
+        ('b.list', None, '/'),
+    ]
+
+
+def test_parse_dpkg_diversions():
+    from ..debian import parse_dpkg_diversions
+    content = """\
+/bin/sh
+/bin/sh.distrib
+dash
+/etc/local.conf
+/etc/local.conf.orig
+:
+/incomplete
+"""
+    assert parse_dpkg_diversions(content) == {
+        '/bin/sh': ('/bin/sh.distrib', 'dash'),
+        '/etc/local.conf': ('/etc/local.conf.orig', None),
+    }
+
+
+def test_parse_dpkg_status():
+    from ..debian import parse_dpkg_status
+    import io
+    content = u"""\
+Package: adduser
+Status: install ok installed
+Installed-Size: 686
+Architecture: all
+Version: 3.134
+Conffiles:
+ /etc/adduser.conf cc3493ecd2d09837ffdcc3e25fdfff18
+Description: add and remove users and groups
+ This package includes the 'adduser' and 'deluser' commands.
+
+Package: zlib1g
+Status: install ok installed
+Architecture: i386
+Multi-Arch: same
+Version: 1:1.2.13.dfsg-1
+
+Package: removed
+Status: purge ok not-installed
+Architecture: amd64
+
+"""
+    assert list(parse_dpkg_status(io.StringIO(content))) == [
+        {'package': 'adduser', 'status': 'install ok installed',
+         'installed-size': '686', 'architecture': 'all',
+         'version': '3.134'},
+        {'package': 'zlib1g', 'status': 'install ok installed',
+         'architecture': 'i386', 'version': '1:1.2.13.dfsg-1'},
+    ]
+
+
+_PACKAGES_LIST = """\
+Package: zlib1g
+Source: zlib
+Version: 1:1.2.13.dfsg-1
+Installed-Size: 164
+Architecture: amd64
+Description: compression library - runtime
+ zlib is a library implementing the deflate compression method found
+ in gzip and PKZIP.
+Filename: pool/main/z/zlib/zlib1g_1.2.13.dfsg-1_amd64.deb
+Size: 87040
+MD5sum: 05d7e4d3a9b2c1ab4d6f0dc1d5dc0ef0
+SHA256: 0d5d4d1c3ecdb1fa6b9d07a0b5c3d3d8d81e7d1b1a2e36be0b8c6e4a1f4a1a9b
+
+Package: adduser
+Version: 3.134
+Architecture: all
+Filename: pool/main/a/adduser/adduser_3.134_all.deb
+Size: 1234
+MD5sum: 11111111111111111111111111111111
+"""
+
+
+@with_tree(tree={
+    'deb.debian.org_debian_dists_bookworm_main_binary-amd64_Packages':
+        _PACKAGES_LIST,
+    'deb.debian.org_debian_dists_bookworm_InRelease': 'not indexed',
+})
+def test_apt_lists_index(lists_dir=None):
+    from ..debian import APTListsIndex
+    cache_file = os.path.join(lists_dir, 'cache', 'index.pickle')
+    index = APTListsIndex(lists_dir, cache_file=cache_file).load()
+    assert len(index) == 2
+    assert os.path.exists(cache_file)
+    rec = index.get('zlib1g', 'amd64', '1:1.2.13.dfsg-1')
+    assert_is_subset_recur(
+        {'package': 'zlib1g', 'source_name': 'zlib', 'size': '87040',
+         'md5': '05d7e4d3a9b2c1ab4d6f0dc1d5dc0ef0'},
+        rec, [dict])
+    assert index.get('adduser', 'all', '3.134')['size'] == '1234'
+    assert index.get('adduser', 'all', '3.133') is None
+    assert index.get('zlib1g', 'i386', '1:1.2.13.dfsg-1') is None
+    index.close()
+
+    # the cached index gets reused, without scanning the lists
+    with mock.patch.object(APTListsIndex, '_index_list',
+                           side_effect=AssertionError("must not rescan")):
+        index = APTListsIndex(lists_dir, cache_file=cache_file).load()
+    assert index.get('adduser', 'all', '3.134')['size'] == '1234'
+    index.close()
+
+    # but not when the lists change
+    with open(os.path.join(lists_dir, 'other_binary-amd64_Packages'),
+              'w') as f:
+        f.write(_PACKAGES_LIST.replace('3.134', '3.135'))
+    index = APTListsIndex(lists_dir, cache_file=cache_file).load()
+    assert len(index) == 3
+    assert index.get('adduser', 'all', '3.135')['package'] == 'adduser'
+    index.close()
@@ -0,0 +1,190 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Profiling of the time spent in external commands and within phases of work
+
+Commands run through `Session.execute_command` and subprocesses started by
+`Runner.run` are accounted for within all the phases (e.g. tracers or their
+methods) active in the thread at the moment.  Phases are reported with
+inclusive wall and CPU times, so the time not spent waiting on commands
+(e.g. parsing their output) could be deduced.
+"""
+
+import collections
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from six import string_types
+
+import logging
+lgr = logging.getLogger('niceman.profiler')
+
+_FIELDS = (
+    'calls', 'wall', 'cpu', 'children_cpu', 'commands', 'command_wall',
+    'bytes_in', 'bytes_out', 'subprocesses', 'subprocess_wall')
+_TIME_FIELDS = {
+    'wall', 'cpu', 'children_cpu', 'command_wall', 'subprocess_wall'}
+
+
+def _get_cpu_times():
+    """Return CPU times of this process and of its (waited for) children"""
+    times = os.times()
+    return times[0] + times[1], times[2] + times[3]
+
+
+def _get_command_name(command):
+    if isinstance(command, string_types):
+        command = command.split()
+    return os.path.basename(command[0]) if command else ''
+
+
+def _get_command_len(command):
+    if isinstance(command, string_types):
+        return len(command)
+    return sum(len(c) for c in command) + len(command)
+
+
+class Profiler(object):
+    """Collects the statistics of the commands and phases while enabled"""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Drop all the collected statistics"""
+        with self._lock:
+            self._phases = collections.OrderedDict()
+            self._commands = collections.OrderedDict()
+
+    def _get_stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _get_stats(self, stats, name):
+        if name not in stats:
+            stats[name] = collections.OrderedDict(
+                (f, 0.0 if f in _TIME_FIELDS else 0) for f in _FIELDS)
+        return stats[name]
+
+    @contextmanager
+    def phase(self, name):
+        """Account for everything done within the context under the name"""
+        if not self.enabled:
+            yield
+            return
+        stack = self._get_stack()
+        stack.append(name)
+        wall = time.time()
+        cpu, children_cpu = _get_cpu_times()
+        try:
+            yield
+        finally:
+            stack.pop()
+            cpu_end, children_cpu_end = _get_cpu_times()
+            with self._lock:
+                stats = self._get_stats(self._phases, name)
+                stats['calls'] += 1
+                stats['wall'] += time.time() - wall
+                stats['cpu'] += cpu_end - cpu
+                stats['children_cpu'] += children_cpu_end - children_cpu
+
+    def _record(self, command, **values):
+        names = self._get_stack()
+        with self._lock:
+            all_stats = [self._get_stats(self._phases, name) for name in names]
+            all_stats.append(
+                self._get_stats(self._commands, _get_command_name(command)))
+            for stats in all_stats:
+                for field, value in values.items():
+                    stats[field] += value
+
+    def record_command(self, command, wall, bytes_out):
+        """Record a command run within a session
+
+        Parameters
+        ----------
+        command : list or str
+        wall : float
+          Time it took to run the command
+        bytes_out : int
+          Size of the collected stdout and stderr
+        """
+        if not self.enabled:
+            return
+        self._record(command, commands=1, command_wall=wall,
+                     bytes_in=_get_command_len(command), bytes_out=bytes_out)
+
+    def record_subprocess(self, command, wall):
+        """Record a local subprocess (e.g. of a local session command)
+
+        Parameters
+        ----------
+        command : list or str
+        wall : float
+          Time it took to run the subprocess
+        """
+        if not self.enabled:
+            return
+        self._record(command, subprocesses=1, subprocess_wall=wall)
+
+    def get_report(self):
+        """Return collected statistics as a dict of 'phases' and 'commands'"""
+        with self._lock:
+            return {
+                'phases': collections.OrderedDict(
+                    (k, dict(v)) for k, v in self._phases.items()),
+                'commands': collections.OrderedDict(
+                    (k, dict(v)) for k, v in self._commands.items()),
+            }
+
+    def format_report(self):
+        """Return collected statistics as human-readable tables"""
+        report = self.get_report()
+        lines = []
+        for title, stats, columns in (
+                ('PHASE', report['phases'],
+                 ('calls', 'wall', 'cpu', 'children_cpu')),
+                ('COMMAND', report['commands'], ())):
+            columns += ('commands', 'command_wall', 'bytes_in', 'bytes_out',
+                        'subprocesses', 'subprocess_wall')
+            lines.append(' '.join(
+                ['%-40s' % title] +
+                ['%12s' % c.upper().replace('_', ' ') for c in columns]))
+            for name, values in stats.items():
+                lines.append(' '.join(
+                    ['%-40s' % name[:40]] +
+                    [('%12.3f' if c in _TIME_FIELDS else '%12d') % values[c]
+                     for c in columns]))
+            lines.append('')
+        return '\n'.join(lines)
+
+
+profiler = Profiler()
+
+
+def profiled(method):
+    """Decorator to account for the calls of a method within a phase
+
+    The phase is named after the class of the instance and the method.
+    """
+    @functools.wraps(method)
+    def newmethod(self, *args, **kwargs):
+        if not profiler.enabled:
+            return method(self, *args, **kwargs)
+        with profiler.phase(
+                '%s.%s' % (self.__class__.__name__, method.__name__)):
+            return method(self, *args, **kwargs)
+    return newmethod
@@ -0,0 +1,50 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import os
+
+from ..cache import FingerprintCache
+
+
+def test_fingerprint_cache(tmpdir):
+    path = str(tmpdir.join('cache'))
+    cache = FingerprintCache(path)
+    assert cache.get('key', 'fp1') is None
+    cache.set('key', 'fp1', {'some': ['value']})
+    assert cache.get('key', 'fp1') == {'some': ['value']}
+    # outdated
+    assert cache.get('key', 'fp2') is None
+    # persistent
+    assert FingerprintCache(path).get('key', 'fp1') == {'some': ['value']}
+    cache.set('key', 'fp2', 'new')
+    assert cache.get('key', 'fp1') is None
+    assert cache.get('key', 'fp2') == 'new'
+    # regardless of the fingerprint
+    assert cache.lookup('key') == ('fp2', 'new')
+    assert cache.lookup('other') == (None, None)
+    # corrupted
+    for name in os.listdir(path):
+        tmpdir.join('cache', name).write('garbage')
+    assert cache.get('key', 'fp2') is None
+
+
+def test_fingerprint_cache_eviction(tmpdir):
+    path = str(tmpdir.join('cache'))
+    value = 'x' * 1000
+    cache = FingerprintCache(path, max_size=3500)
+    for i in range(3):
+        cache.set(i, 'fp', value)
+        # make the order of use unambiguous
+        os.utime(cache._get_file(i), (i, i))
+    # recently used
+    assert cache.get(0, 'fp') == value
+    cache.set(3, 'fp', value)
+    assert len(os.listdir(path)) == 3
+    assert cache.get(1, 'fp') is None
+    assert [cache.get(i, 'fp') for i in (0, 2, 3)] == [value] * 3
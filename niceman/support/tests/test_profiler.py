@@ -0,0 +1,51 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+from ..profiler import Profiler
+
+
+def test_profiler():
+    profiler = Profiler()
+    # nothing is recorded unless enabled
+    with profiler.phase('phase'):
+        profiler.record_command(['ls', '-l'], 0.5, 10)
+    assert profiler.get_report() == {'phases': {}, 'commands': {}}
+
+    profiler.enabled = True
+    with profiler.phase('outer'):
+        profiler.record_command(['ls', '-l'], 0.5, 10)
+        with profiler.phase('inner'):
+            profiler.record_command(['/bin/ls'], 0.25, 5)
+            profiler.record_subprocess(['/bin/ls'], 0.2)
+    profiler.record_command('cat /etc/hosts', 0.125, 100)
+
+    report = profiler.get_report()
+    assert list(report['phases']) == ['outer', 'inner']
+    outer = report['phases']['outer']
+    assert outer['calls'] == 1
+    assert outer['commands'] == 2
+    assert outer['subprocesses'] == 1
+    assert outer['command_wall'] == 0.75
+    assert outer['bytes_in'] == len('ls -l ') + len('/bin/ls ')
+    assert outer['bytes_out'] == 15
+    assert outer['wall'] >= 0
+    inner = report['phases']['inner']
+    assert inner['commands'] == 1
+    assert inner['subprocess_wall'] == 0.2
+
+    assert report['commands']['ls']['commands'] == 2
+    assert report['commands']['ls']['subprocesses'] == 1
+    assert report['commands']['cat']['bytes_out'] == 100
+
+    table = profiler.format_report()
+    assert 'outer' in table
+    assert 'cat' in table
+
+    profiler.reset()
+    assert profiler.get_report() == {'phases': {}, 'commands': {}}
@@ -44,7 +44,7 @@ from ..utils import on_windows
 from ..utils import _path_
 from ..utils import to_unicode
 from ..utils import generate_unique_name
-from ..utils import PathRoot, is_subpath
+from ..utils import PathRoot, PathTrie, is_subpath
 
 from nose.tools import ok_, eq_, assert_false, assert_equal, assert_true
 
@@ -472,6 +472,65 @@ def test_pathroot():
     assert proot("/root/x/child_root") == "/root/x/child_root"
 
 
+def test_pathroot_find_many():
+    calls = []
+
+    def are_roots(paths):
+        calls.append(paths)
+        return [p for p in paths if p.endswith("root")]
+
+    proot = PathRoot(lambda s: s.endswith("root"), are_roots)
+    assert proot("/root/cached") == "/root"
+    assert proot.find_many(
+        ["/root/a/b", "/root/x/child_root/a", "/not_a_r_oot/a", "/", "b/c",
+         "/root/cached"]) == {
+        "/root/a/b": "/root",
+        "/root/x/child_root/a": "/root/x/child_root",
+        "/not_a_r_oot/a": None,
+        "/": None,
+        "b/c": None,
+        "/root/cached": "/root"}
+    # all checked at once, without the cached paths
+    assert calls == [["/not_a_r_oot", "/not_a_r_oot/a", "/root/a",
+                      "/root/a/b", "/root/x", "/root/x/child_root",
+                      "/root/x/child_root/a", "b", "b/c"]]
+    # and then cached
+    assert proot.find_many(["/root/a/b", "/root/x/child_root"]) == {
+        "/root/a/b": "/root",
+        "/root/x/child_root": "/root/x/child_root"}
+    assert proot("/root/x/child_root/a") == "/root/x/child_root"
+    assert len(calls) == 1
+
+    # the predicate is used without a batch one
+    proot = PathRoot(lambda s: s.endswith("root"))
+    assert proot.find_many(["/root/a", "/b"]) == {"/root/a": "/root",
+                                                  "/b": None}
+
+
+def test_pathtrie():
+    trie = PathTrie(["/root", "/root/x/child_root/"])
+    trie.add("/other", value="other")
+    assert trie.find("/") == (None, None)
+    assert trie.find("/roo") == (None, None)
+    assert trie.find("/root_not") == (None, None)
+    assert trie.find("/root") == ("/root", ".")
+    assert trie.find("/root/") == ("/root", ".")
+    assert trie.find("/root/a/b") == ("/root", "a/b")
+    assert trie.find("/root/x/child_root/a") == ("/root/x/child_root/", "a")
+    assert trie.find("/other/a") == ("other", "a")
+    assert trie.find_all("/root/x/child_root/a") == [
+        ("/root/x/child_root/", "a"), ("/root", "x/child_root/a")]
+    assert trie.find_all("/none") == []
+    assert trie.group(["/root/a", "/other/a", "/root/x/child_root/b",
+                       "/none", "/root/b"]) == {
+        "/root": {"/root/a": "a", "/root/b": "b"},
+        "/root/x/child_root/": {"/root/x/child_root/b": "b"},
+        "other": {"/other/a": "a"}}
+
+    assert PathTrie(["/"]).find("/a/b") == ("/", "a/b")
+    assert PathTrie(["a/b"]).find("a/b/c") == ("a/b", "c")
+
+
 def test_is_subpath(tmpdir):
     tmpdir = str(tmpdir)
 
@@ -1061,9 +1061,11 @@ def execute_command_batch(session, command, args, exception_filter=None):
         that is in the list of expected exceptions
 
     """
+    args = list(args)  # we might get in with a set
+    if not args:
+        return
     cmd_length = sum(map(len, command)) + len(command)
     num_args = get_cmd_batch_len(args, cmd_length)
-    args = list(args)  # we might get in with a set
     while args:
         batch, args = args[:num_args], args[num_args:]
         try:
@@ -1171,9 +1173,15 @@ class PathRoot(object):
     predicate : callable
         A callable that will be passed a path and should return true
         if that path should be considered a root.
+    batch_predicate : callable, optional
+        A callable that will be passed a list of paths and should return
+        the collection of those which should be considered roots.  If
+        provided, it is used by `find_many` to check all the candidate
+        paths at once (e.g. in a single command run in a session).
     """
-    def __init__(self, predicate):
+    def __init__(self, predicate, batch_predicate=None):
         self._pred = predicate
+        self._batch_pred = batch_predicate
         self._cache = {}  # path -> root
 
     def __call__(self, path):
@@ -1205,6 +1213,45 @@ class PathRoot(object):
             self._cache[pth] = root
         return root
 
+    def find_many(self, paths):
+        """Find roots of multiple paths.
+
+        If a batch predicate was provided, all the not yet cached parent
+        directories of the paths are checked with a single call to it,
+        rather than calling the predicate on each of them.
+
+        Parameters
+        ----------
+        paths : iterable of str
+
+        Returns
+        -------
+        dict
+            path -> root (or None)
+        """
+        paths = set(paths)
+        if self._batch_pred is None:
+            return {path: self(path) for path in paths}
+
+        to_check = set()
+        for path in paths:
+            for pth in self._walk_up(path):
+                if pth in self._cache or pth in to_check:
+                    # so are all its parent directories
+                    break
+                to_check.add(pth)
+
+        if to_check:
+            roots = set(self._batch_pred(sorted(to_check)))
+            # A parent path is shorter than its children, so its root is
+            # known by the time its children are considered
+            for pth in sorted(to_check, key=len):
+                if pth in roots:
+                    self._cache[pth] = pth
+                else:
+                    self._cache[pth] = self._cache.get(os.path.dirname(pth))
+        return {path: self._cache.get(path) for path in paths}
+
     @staticmethod
     def _walk_up(path):
         """Yield PATH, chopping off the right-most directory each iteration.
@@ -1218,6 +1265,109 @@ class PathRoot(object):
             path = os.path.dirname(path)
 
 
+class PathTrie(object):
+    """Trie of root paths to find the deepest root a path is below.
+
+    Paths are split into their components, so finding the root of a path
+    does not depend on the number of roots.  As opposed to `is_subpath`,
+    paths are not normalized, so the roots and the paths looked up should
+    be consistently normalized (and all absolute or relative to the same
+    directory).
+
+    Parameters
+    ----------
+    roots : iterable of str, optional
+        Roots to add, with themselves as the values.
+    """
+    _VALUE = object()  # key to store the value of a root within its node
+
+    def __init__(self, roots=()):
+        self._trie = {}
+        for root in roots:
+            self.add(root)
+
+    @staticmethod
+    def _split(path):
+        return path.rstrip(os.path.sep).split(os.path.sep)
+
+    def add(self, root, value=None):
+        """Add a root.
+
+        Parameters
+        ----------
+        root : str
+        value : optional
+            Value to return for the paths below the root.  The root itself
+            if not specified.
+        """
+        node = self._trie
+        for part in self._split(root):
+            node = node.setdefault(part, {})
+        node[self._VALUE] = root if value is None else value
+
+    def find(self, path):
+        """Find the deepest root `path` is below (or is itself).
+
+        Parameters
+        ----------
+        path : str
+
+        Returns
+        -------
+        (value, relpath) or (None, None)
+            Value of the root and `path` relative to the root (os.curdir for
+            the root itself).
+        """
+        found = self.find_all(path)
+        return found[0] if found else (None, None)
+
+    def find_all(self, path):
+        """Find all the roots `path` is below (or is itself).
+
+        Parameters
+        ----------
+        path : str
+
+        Returns
+        -------
+        list of (value, relpath)
+            As returned by `find`, for the deepest root first.
+        """
+        parts = self._split(path)
+        node = self._trie
+        found = []
+        for i, part in enumerate(parts):
+            node = node.get(part)
+            if node is None:
+                break
+            if self._VALUE in node:
+                found.append(
+                    (node[self._VALUE],
+                     os.path.sep.join(parts[i + 1:]) or os.path.curdir))
+        found.reverse()
+        return found
+
+    def group(self, paths):
+        """Group paths by the deepest root they are below.
+
+        Parameters
+        ----------
+        paths : iterable of str
+
+        Returns
+        -------
+        dict
+            Value of a root -> {path: path relative to the root}.  Paths
+            not below any root are not included.
+        """
+        groups = {}
+        for path in paths:
+            value, relpath = self.find(path)
+            if value is not None:
+                groups.setdefault(value, {})[path] = relpath
+        return groups
+
+
 def is_subpath(path, directory):
     """Test whether `path` is below (or is itself) `directory`.
 
@@ -100,6 +100,7 @@ requires.update({
     ],
     'devel-utils': [
         'line-profiler',
+        'pytest-benchmark',  # for tools/benchmarks
         # necessary for accessing SecretStorage keyring (system wide Gnome
         # keyring)  but not installable on travis, IIRC since it needs connectivity
         # to the dbus whenever installed or smth like that, thus disabled here
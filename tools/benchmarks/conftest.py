@@ -0,0 +1,78 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Configuration of the benchmarks (run with py.test tools/benchmarks)
+"""
+
+from collections import Counter
+from collections import OrderedDict
+import os.path as op
+
+import pytest
+
+from replay import ReplaySession
+from replay import SyntheticHost
+
+SIZES = (1000, 10000, 100000)
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--session-latency", type=float, default=0.,
+        help="seconds each command in the replayed session takes")
+    parser.addoption(
+        "--max-files", type=int, default=max(SIZES),
+        help="skip benchmarks with synthetic file sets larger than this")
+
+
+@pytest.fixture(scope="module", params=SIZES, ids=lambda n: "%dfiles" % n)
+def host(request):
+    if request.param > request.config.getoption("--max-files"):
+        pytest.skip("more than --max-files files")
+    return SyntheticHost(request.param)
+
+
+@pytest.fixture
+def replay(request, benchmark, host):
+    """Benchmark a function of a fresh ReplaySession on every round
+
+    Number of the session round-trips (in total and per command) is
+    stored within the benchmark's extra_info and reported at the end.
+    """
+    latency = request.config.getoption("--session-latency")
+
+    def run(func, rounds=3):
+        sessions = []
+
+        def setup():
+            sessions.append(ReplaySession(host, latency=latency))
+            return (sessions[-1],), {}
+
+        result = benchmark.pedantic(func, setup=setup, rounds=rounds)
+        commands = sessions[-1].commands
+        benchmark.extra_info["round_trips"] = len(commands)
+        benchmark.extra_info["commands"] = dict(Counter(
+            op.basename((c if isinstance(c, list) else c.split())[0])
+            for c in commands))
+        request.config._round_trips[request.node.nodeid] = len(commands)
+        return result
+
+    return run
+
+
+def pytest_configure(config):
+    config._round_trips = OrderedDict()
+
+
+def pytest_terminal_summary(terminalreporter):
+    round_trips = terminalreporter.config._round_trips
+    if not round_trips:
+        return
+    terminalreporter.write_sep("-", "session round-trips")
+    for nodeid, count in round_trips.items():
+        terminalreporter.write_line("%-70s %8d" % (nodeid, count))
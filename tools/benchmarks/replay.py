@@ -0,0 +1,333 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""A synthetic host and a session replaying its canned command outputs
+
+The host is a Debian system with a virtualenv, a git repository and a
+Docker engine, which answers the (subset of) dpkg/apt/pip/git/docker/coreutils
+commands the tracers run.
+"""
+
+import json
+import os.path as op
+import shlex
+import time
+
+from six import string_types
+
+from niceman.distributions.piputils import _FILE_MARKER
+from niceman.distributions.vcs import _GIT_METADATA_SCRIPT
+from niceman.resource.session import POSIXSession
+from niceman.support.exceptions import CommandError
+
+VENV_PATH = '/opt/synthetic/venv'
+SITE_PACKAGES = VENV_PATH + '/lib/python3.6/site-packages'
+DATA_PATH = '/opt/synthetic/data'
+REPO_PATH = '/opt/synthetic/repo'
+APT_SOURCE = 'http://deb.debian.org/debian stretch/main amd64 Packages'
+MTIME = 1514764800  # 2018-01-01
+
+
+class SyntheticHost(object):
+    """A host with Debian packages, a virtualenv, a git repository and images
+
+    The files are split among Debian packages (60%), pip packages within the
+    virtualenv (20%), the git repository (15%) and files not belonging to
+    anything (5%), with `files_per_package` files per package.  Names of
+    `ndocker_images` Docker images are traced along with the files.
+
+    Parameters
+    ----------
+    nfiles : int
+      Number of files to generate
+    files_per_package : int, optional
+    """
+
+    def __init__(self, nfiles, files_per_package=20, ndocker_images=2):
+        self.nfiles = nfiles
+        self.files = []          # files to be traced
+        self.paths = {}          # path -> 'file' or 'dir'
+        self.contents = {}       # path -> content of the file
+        self.deb_packages = {}   # name -> list of paths
+        self.pip_packages = {}   # name -> list of paths within site-packages
+        self.repo_path = REPO_PATH
+        self.repo_files = []     # paths relative to repo_path
+        self.docker_images = {}  # name -> id
+
+        ndeb = int(nfiles * 0.6)
+        npip = int(nfiles * 0.2)
+        ngit = int(nfiles * 0.15)
+        for i in range(0, ndeb, files_per_package):
+            name = 'debpkg%05d' % (i // files_per_package)
+            pkgdir = '/usr/share/' + name
+            files = [pkgdir + '/file%03d' % j
+                     for j in range(min(files_per_package, ndeb - i))]
+            self.deb_packages[name] = ['/.', '/usr', '/usr/share', pkgdir] \
+                + files
+            self._add_files(files)
+        for i in range(0, npip, files_per_package):
+            name = 'pippkg%05d' % (i // files_per_package)
+            self.pip_packages[name] = [
+                '%s/mod%03d.py' % (name, j)
+                for j in range(min(files_per_package, npip - i))]
+            self._add_files(op.join(SITE_PACKAGES, f)
+                            for f in self.pip_packages[name])
+        for i in range(ngit):
+            self.repo_files.append('src/d%03d/file%03d.c' % (i // 100, i % 100))
+        self._add_files(op.join(self.repo_path, f) for f in self.repo_files)
+        self._add_files(DATA_PATH + '/file%06d.dat' % i
+                        for i in range(nfiles - ndeb - npip - ngit))
+        for i in range(ndocker_images):
+            name = 'synthetic/image%d:latest' % i
+            self.docker_images[name] = 'sha256:%064x' % i
+            self.files.append(name)
+
+        self.paths[self.repo_path + '/.git'] = 'dir'
+        self.paths[VENV_PATH + '/bin/activate'] = 'file'
+        for path in '/etc/os-release', '/var/lib/dpkg/diversions':
+            self.paths[path] = 'file'
+        self.contents.update({
+            '/etc/debian_version': '9.4\n',
+            '/var/lib/dpkg/diversions': '',
+            '/var/lib/dpkg/status': ''.join(
+                'Package: %s\nStatus: install ok installed\n'
+                'Architecture: amd64\nVersion: 1.0-1\n'
+                'Installed-Size: 100\n\n' % name
+                for name in sorted(self.deb_packages)),
+        })
+        self._dpkg_lists = None
+
+    def _add_files(self, files):
+        for f in files:
+            self.files.append(f)
+            self.paths[f] = 'file'
+            d = op.dirname(f)
+            while d not in self.paths:
+                self.paths[d] = 'dir'
+                d = op.dirname(d)
+
+    def run(self, command, cwd=None):
+        """Return (out, err) of the command or raise CommandError"""
+        args = shlex.split(command) \
+            if isinstance(command, string_types) else list(command)
+        if args[:2] == ['bash', '-c']:
+            args = shlex.split(args[2])
+        name = op.basename(args[0])
+        if args[0].startswith(VENV_PATH + '/bin/'):
+            name = 'venv_' + name
+        handler = getattr(self, '_run_' + name.replace('-', '_'), None)
+        result = handler(args[1:], cwd) if handler else None
+        if result is None:
+            result = 127, '', '%s: command not found\n' % args[0]
+        if len(result) == 2:
+            return result
+        code, out, err = result
+        raise CommandError(
+            str(command), "Failed to run %r. Exit code=%d" % (command, code),
+            code, out, err)
+
+    def _run_cat(self, args, cwd):
+        if args[0] not in self.contents:
+            return 1, '', 'cat: %s: No such file or directory\n' % args[0]
+        return self.contents[args[0]], ''
+
+    def _run_test(self, args, cwd):
+        type_ = self.paths.get(args[1])
+        if type_ and (args[0] == '-e' or type_ == 'dir'):
+            return 'Found\n', ''
+        return 1, '', ''
+
+    def _run_grep(self, args, cwd):
+        if args == ['-q', 'VIRTUAL_ENV', VENV_PATH + '/bin/activate']:
+            return '', ''
+        if args[:3] == ['-l', '-s', 'VIRTUAL_ENV']:
+            found = VENV_PATH + '/bin/activate'
+            out = found + '\n' if found in args[3:] else ''
+            missing = any(f not in self.paths for f in args[3:])
+            if missing or not out:
+                return 2 if missing else 1, out, ''
+            return out, ''
+        if args[-1] == '/etc/os-release':
+            return 'ID=debian\n', ''
+        return 2, '', 'grep: %s: No such file or directory\n' % args[-1]
+
+    def _run_ls(self, args, cwd):
+        if args == ['-ld', '/etc/apt']:
+            return 'drwxr-xr-x 6 root root 4096 Jan  1  2018 /etc/apt\n', ''
+
+    def _run_find(self, args, cwd):
+        if args[0] != '/var/lib/dpkg/info':
+            return
+        if self._dpkg_lists is None:
+            self._dpkg_lists = ''.join(
+                '/var/lib/dpkg/info/%s:amd64.list:%s\n' % (name, path)
+                for name, paths in sorted(self.deb_packages.items())
+                for path in paths)
+        return self._dpkg_lists, ''
+
+    def _run_stat(self, args, cwd):
+        out = []
+        for path in args[2:]:
+            name = op.basename(path).split(':')[0][:-len('.list')]
+            if path.endswith('.list') and name in self.deb_packages:
+                out.append('%s: %d\n' % (path, MTIME))
+        return ''.join(out), ''
+
+    def _run_python3(self, args, cwd):
+        # stat_many script
+        if args[0] != '-c' or 'stat' not in args[1]:
+            return
+        return json.dumps([
+            [p, self.paths.get(p), 4096 if self.paths.get(p) else None,
+             MTIME if self.paths.get(p) else None, None]
+            for p in args[3:]]), ''
+
+    def _run_apt_cache(self, args, cwd):
+        if args == ['policy']:
+            return ('Package files:\n'
+                    ' 100 /var/lib/dpkg/status\n'
+                    '     release a=now\n'
+                    ' 500 %s\n'
+                    '     release v=9.4,o=Debian,a=stable,n=stretch,l=Debian,'
+                    'c=main,b=amd64\n'
+                    '     origin deb.debian.org\n'
+                    'Pinned packages:\n' % APT_SOURCE), ''
+        if args[0] == 'policy':
+            return ''.join(
+                '%s:\n'
+                '  Installed: 1.0-1\n'
+                '  Candidate: 1.0-1\n'
+                '  Version table:\n'
+                ' *** 1.0-1 500\n'
+                '        500 %s\n'
+                '        100 /var/lib/dpkg/status\n'
+                % (query.split(':')[0], APT_SOURCE)
+                for query in args[1:]), ''
+        if args[0] == 'show':
+            return ''.join(
+                'Package: %s\nSource: %s-src (1.0-1)\nVersion: 1.0-1\n'
+                'Architecture: amd64\nSize: 1024\nMD5sum: %s\n'
+                'SHA256: %s\n\n'
+                % (query.split(':')[0], query.split(':')[0],
+                   '0' * 32, '0' * 64)
+                for query in args[1:]), ''
+
+    def _run_venv_pip(self, args, cwd):
+        if args[:2] == ['list', '--format=legacy']:
+            return ''.join('%s (1.0)\n' % name
+                           for name in sorted(self.pip_packages)), ''
+        if args[:2] == ['show', '-f']:
+            return '\n---\n'.join(
+                'Metadata-Version: 2.0\nName: %s\nVersion: 1.0\n'
+                'Location: %s\nFiles:\n%s'
+                % (name, SITE_PACKAGES,
+                   ''.join('  %s\n' % f for f in self.pip_packages[name]))
+                for name in args[2:]), ''
+
+    def _run_sh(self, args, cwd):
+        # dump of the packages metadata by piputils
+        if args[0] != '-c' or _FILE_MARKER not in args[1]:
+            return
+        if args[1] == _GIT_METADATA_SCRIPT:
+            return self._dump_git_metadata(args[-1])
+        if args[-1] != VENV_PATH:
+            return '', ''
+        out = ['\n%s%s/pyvenv.cfg\ninclude-system-site-packages = false\n'
+               % (_FILE_MARKER, VENV_PATH)]
+        for name, files in sorted(self.pip_packages.items()):
+            dist_info = '%s/%s-1.0.dist-info' % (SITE_PACKAGES, name)
+            out.append('\n%s%s/METADATA\nName: %s\nVersion: 1.0\n'
+                       % (_FILE_MARKER, dist_info, name))
+            out.append('\n%s%s/RECORD\n%s' % (
+                _FILE_MARKER, dist_info,
+                ''.join('%s,sha256=,1\n' % f for f in files)))
+        return ''.join(out), ''
+
+    def _dump_git_metadata(self, path):
+        if path != self.repo_path:
+            return 1, '', ''
+        files = [
+            ('HEAD', 'ref: refs/heads/master\n'),
+            ('config', '[core]\n\tbare = false\n'
+                       '[remote "origin"]\n'
+                       '\turl = https://example.com/repo.git\n'
+                       '[branch "master"]\n\tremote = origin\n'),
+            ('refs/heads/master', '1' * 40 + '\n'),
+            ('refs/remotes/origin/master', '1' * 40 + '\n'),
+        ]
+        return ''.join('\n%s%s\n%s' % (_FILE_MARKER, name, content)
+                       for name, content in files), ''
+
+    def _run_docker(self, args, cwd):
+        if args[:2] != ['image', 'inspect']:
+            return
+        name = args[2]
+        if name not in self.docker_images:
+            return 1, '', 'Error: No such image: %s\n' % name
+        return json.dumps([{
+            'Id': self.docker_images[name],
+            'Architecture': 'amd64',
+            'Os': 'linux',
+            'DockerVersion': '18.03.1-ce',
+            'RepoDigests': [name.split(':')[0] + '@sha256:' + '0' * 64],
+            'RepoTags': [name],
+            'Created': '2018-01-01T00:00:00Z',
+        }]), ''
+
+    def _run_venv_python(self, args, cwd):
+        return 'Python 3.6.5\n', ''
+
+    def _run_virtualenv(self, args, cwd):
+        return '15.1.0\n', ''
+
+    def _run_which(self, args, cwd):
+        if args == ['virtualenv']:
+            return '/usr/bin/virtualenv\n', ''
+        return 1, '', ''
+
+    def _run_svn(self, args, cwd):
+        return 1, '', "svn: E155007: '%s' is not a working copy\n" % cwd
+
+    def _run_git(self, args, cwd):
+        if not cwd or op.commonprefix([cwd, self.repo_path]) != self.repo_path:
+            return 128, '', 'fatal: Not a git repository\n'
+        out = {
+            'rev-parse --show-toplevel': self.repo_path,
+            'ls-files -z': ''.join(f + '\0' for f in self.repo_files),
+            'rev-parse HEAD': '1' * 40,
+            'symbolic-ref --short HEAD': 'master',
+            'status --porcelain=v2 -z --untracked-files=no': '',
+            'config branch.master.remote': 'origin',
+            'for-each-ref --contains %s --format=%%(refname:strip=2) '
+            'refs/remotes' % ('1' * 40): 'origin/master',
+            'remote': 'origin',
+            'config remote.origin.url': 'https://example.com/repo.git',
+        }.get(' '.join(args))
+        if out is None:
+            return 1, '', ''
+        return out if out.endswith('\0') else out + '\n', ''
+
+
+class ReplaySession(POSIXSession):
+    """Session running the commands on a SyntheticHost
+
+    Every command is recorded and takes (at least) `latency` seconds to
+    simulate round-trips to a remote resource.
+    """
+
+    def __init__(self, host, latency=0):
+        super(ReplaySession, self).__init__()
+        self._host = host
+        self.latency = latency
+        self.commands = []
+
+    def _execute_command(self, command, env=None, cwd=None):
+        self.commands.append(command)
+        if self.latency:
+            time.sleep(self.latency)
+        return self._host.run(command, cwd=cwd)
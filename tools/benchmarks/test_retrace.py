@@ -0,0 +1,53 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the niceman package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Benchmarks of the tracers on synthetic hosts
+
+Run with
+
+    py.test tools/benchmarks [--session-latency=0.001] [--max-files=10000]
+
+Wall times are reported by pytest-benchmark, and the numbers of session
+round-trips are stored within extra_info of the benchmarks (see
+--benchmark-json) and summarized at the end.
+"""
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from niceman.distributions.conda import CondaTracer
+from niceman.distributions.debian import DebTracer
+from niceman.distributions.docker import DockerTracer
+from niceman.distributions.vcs import VCSTracer
+from niceman.distributions.venv import VenvTracer
+from niceman.interface.retrace import identify_distributions
+
+from replay import DATA_PATH
+
+
+def test_identify_distributions(replay, host):
+    dists, unknown_files = replay(
+        lambda session: identify_distributions(host.files, session=session))
+    dists = dict((d.name, d) for d in dists if d.name != 'venv')
+    assert len(dists['debian'].packages) == len(host.deb_packages)
+    assert len(dists['git'].packages) == 1
+    assert len(dists['docker'].images) == len(host.docker_images)
+    assert unknown_files == set(
+        f for f in host.files if f.startswith(DATA_PATH))
+
+
+@pytest.mark.parametrize(
+    "Tracer", [DebTracer, CondaTracer, VenvTracer, VCSTracer, DockerTracer],
+    ids=lambda t: t.__name__)
+def test_tracer(replay, host, Tracer):
+    def trace(session):
+        return list(Tracer(session=session).identify_distributions(
+            set(host.files)))
+    dists = replay(trace)
+    assert len(dists) == (0 if Tracer is CondaTracer else 1)